@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+健康・習慣・集中時間・日記の気分を横断して分析するモジュール
+各データを日付でそろえたNumPy配列にして、移動平均・前週比・曜日×時間帯の
+ヒートマップ・相関をまとめてベクトル演算で計算する
+
+日付・日時はPythonのdatetimeに変換せず、1970-01-01からの日数（日時は小数部付き）で受け取る
+"""
+
+import numpy as np
+
+# 気分の数値化（大きいほど良い）
+HEALTH_MOOD_SCORES = {'great': 5, 'good': 4, 'okay': 3, 'bad': 2, 'terrible': 1}
+JOURNAL_MOOD_SCORES = {'happy': 5, 'excited': 4, 'neutral': 3, 'anxious': 2, 'sad': 1}
+
+# (系列A, 系列B, ずらす日数, 説明)
+CORRELATION_PAIRS = [
+    ('sleep_hours', 'pomodoros', 1, '睡眠時間 → 翌日の集中回数'),
+    ('sleep_hours', 'health_mood', 0, '睡眠時間 → 同じ日の気分'),
+    ('exercise_minutes', 'health_mood', 0, '運動時間 → 同じ日の気分'),
+    ('exercise_minutes', 'sleep_hours', 0, '運動時間 → 同じ日の睡眠時間'),
+    ('habit_rate', 'journal_mood', 0, '習慣の達成率 → 日記の気分'),
+    ('focus_minutes', 'journal_mood', 0, '集中時間 → 日記の気分'),
+]
+
+
+def epoch_day(value):
+    """date を1970-01-01からの日数に変換"""
+    return int(np.datetime64(value, 'D').astype(np.int64))
+
+
+def as_array(rows):
+    """クエリ結果の行をfloatの2次元配列に変換（Noneは NaN になる）
+
+    SQLAlchemyのRowをそのままnp.arrayに渡すと1要素ずつ属性を探して遅いので、先にtupleにする
+    """
+    return np.array(list(map(tuple, rows)), dtype=float)
+
+
+def day_index(days, start):
+    """1970-01-01からの日数の列を start からの日数（int配列）に変換"""
+    return np.floor(np.asarray(days, dtype=float)).astype(np.int64) - epoch_day(start)
+
+
+def daily_sum(idx, values, n_days):
+    """日ごとの合計（記録のない日は0）"""
+    mask = (idx >= 0) & (idx < n_days)
+    return np.bincount(idx[mask], weights=np.asarray(values, dtype=float)[mask], minlength=n_days)
+
+
+def daily_mean(idx, values, n_days):
+    """日ごとの平均（記録のない日はNaN）"""
+    values = np.asarray(values, dtype=float)
+    mask = (idx >= 0) & (idx < n_days) & ~np.isnan(values)
+    totals = np.bincount(idx[mask], weights=values[mask], minlength=n_days)
+    counts = np.bincount(idx[mask], minlength=n_days)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, totals / counts, np.nan)
+
+
+def rolling_mean(series, window):
+    """NaNを除いた後方移動平均（窓内に値が1つもなければNaN）"""
+    valid = ~np.isnan(series)
+    sums = np.cumsum(np.where(valid, series, 0.0))
+    counts = np.cumsum(valid)
+    sums[window:] = sums[window:] - sums[:-window]
+    counts[window:] = counts[window:] - counts[:-window]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def week_over_week(series):
+    """直近7日と、その前の7日の平均を比較"""
+    if len(series) < 14:
+        return {'this_week': None, 'last_week': None, 'delta': None, 'delta_pct': None}
+    weeks = series[-14:].reshape(2, 7)
+    valid = ~np.isnan(weeks)
+    counts = valid.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        last_week, this_week = np.where(counts > 0, np.where(valid, weeks, 0.0).sum(axis=1) / counts, np.nan)
+        delta = this_week - last_week
+        delta_pct = delta / abs(last_week) * 100 if last_week else np.nan
+    return {'this_week': to_number(this_week), 'last_week': to_number(last_week),
+            'delta': to_number(delta), 'delta_pct': to_number(delta_pct)}
+
+
+def focus_heatmap(started_days, durations):
+    """曜日(月=0)×時間帯(0-23時)ごとの集中時間（分）の7×24配列"""
+    days = np.asarray(started_days, dtype=float)
+    if days.size == 0:
+        return np.zeros((7, 24))
+    # 1970-01-01は木曜日なので3日ずらすと月曜始まりになる
+    whole_days = np.floor(days)
+    weekday = (whole_days.astype(np.int64) + 3) % 7
+    hour = np.minimum(((days - whole_days) * 24 + 1e-9).astype(np.int64), 23)
+    cells = np.bincount(weekday * 24 + hour, weights=np.asarray(durations, dtype=float), minlength=7 * 24)
+    return cells.reshape(7, 24)
+
+
+def lagged_correlation(x, y, lag=0):
+    """x[t] と y[t + lag] のピアソン相関（両方の値がそろった日だけ使う）"""
+    if lag:
+        x, y = x[:-lag], y[lag:]
+    mask = ~np.isnan(x) & ~np.isnan(y)
+    n = int(mask.sum())
+    if n < 3:
+        return None, n
+    x, y = x[mask], y[mask]
+    x = x - x.mean()
+    y = y - y.mean()
+    denominator = np.sqrt((x * x).sum() * (y * y).sum())
+    if denominator == 0:
+        return None, n
+    return float((x * y).sum() / denominator), n
+
+
+def to_number(value, digits=2):
+    return None if value is None or np.isnan(value) else round(float(value), digits)
+
+
+def to_list(series, digits=2):
+    """JSON用にNaNをNoneにしたリストへ変換"""
+    rounded = np.round(series, digits)
+    return np.where(np.isnan(rounded), None, rounded).tolist()
+
+
+def build_series(start, n_days, health_rows, habit_rows, habit_total, pomodoro_rows, journal_rows,
+                 pomodoro_daily_rows=()):
+    """各モデルのクエリ結果を start から n_days 日分の日付でそろえた配列の辞書にする
+
+    health_rows: (日, 睡眠, 体重, 運動, 水分, 気分)  habit_rows: (日, 達成数)
+    pomodoro_rows: (日, 分, 開始日時)  journal_rows: (日, 気分)
+    pomodoro_daily_rows: アーカイブ済みの日ごとの集計 (日, 回数, 分)
+    """
+    series = {}
+
+    if health_rows:
+        values = as_array(row[:5] for row in health_rows)
+        mood = [row[5] for row in health_rows]
+        idx = day_index(values[:, 0], start)
+        series['sleep_hours'] = daily_mean(idx, values[:, 1], n_days)
+        series['weight'] = daily_mean(idx, values[:, 2], n_days)
+        series['exercise_minutes'] = daily_mean(idx, values[:, 3], n_days)
+        series['water_intake'] = daily_mean(idx, values[:, 4], n_days)
+        series['health_mood'] = daily_mean(
+            idx, np.array([HEALTH_MOOD_SCORES.get(m, np.nan) for m in mood], dtype=float), n_days)
+    else:
+        for name in ('sleep_hours', 'weight', 'exercise_minutes', 'water_intake', 'health_mood'):
+            series[name] = np.full(n_days, np.nan)
+
+    if habit_rows:
+        values = as_array(habit_rows)
+        completed = daily_sum(day_index(values[:, 0], start), values[:, 1], n_days)
+    else:
+        completed = np.zeros(n_days)
+    series['habits_completed'] = completed
+    series['habit_rate'] = completed / habit_total * 100 if habit_total else np.full(n_days, np.nan)
+
+    if pomodoro_rows:
+        values = as_array(pomodoro_rows)
+        idx = day_index(values[:, 0], start)
+        series['pomodoros'] = daily_sum(idx, np.ones(len(idx)), n_days)
+        series['focus_minutes'] = daily_sum(idx, values[:, 1], n_days)
+    else:
+        series['pomodoros'] = np.zeros(n_days)
+        series['focus_minutes'] = np.zeros(n_days)
+    if pomodoro_daily_rows:
+        values = as_array(pomodoro_daily_rows)
+        idx = day_index(values[:, 0], start)
+        series['pomodoros'] += daily_sum(idx, values[:, 1], n_days)
+        series['focus_minutes'] += daily_sum(idx, values[:, 2], n_days)
+
+    if journal_rows:
+        days, mood = zip(*journal_rows)
+        series['journal_mood'] = daily_mean(
+            day_index(days, start), np.array([JOURNAL_MOOD_SCORES.get(m, np.nan) for m in mood], dtype=float),
+            n_days)
+    else:
+        series['journal_mood'] = np.full(n_days, np.nan)
+
+    return series
+
+
+def build_insights(start, n_days, health_rows, habit_rows, habit_total, pomodoro_rows, journal_rows,
+                   pomodoro_daily_rows=(), rolling_window=7):
+    """/insights 用の集計結果（JSONにそのまま渡せる形）を返す"""
+    series = build_series(start, n_days, health_rows, habit_rows, habit_total, pomodoro_rows, journal_rows,
+                          pomodoro_daily_rows)
+    dates = np.arange(np.datetime64(start, 'D'), np.datetime64(start, 'D') + n_days)
+
+    correlations = []
+    for a, b, lag, label in CORRELATION_PAIRS:
+        r, n = lagged_correlation(series[a], series[b], lag)
+        correlations.append({'x': a, 'y': b, 'lag_days': lag, 'label': label,
+                             'r': to_number(r, 3) if r is not None else None, 'samples': n})
+
+    if pomodoro_rows:
+        values = as_array(pomodoro_rows)
+        heatmap = focus_heatmap(values[:, 2], values[:, 1])
+    else:
+        heatmap = np.zeros((7, 24))
+
+    return {
+        'dates': dates.astype(str).tolist(),
+        'series': {name: to_list(values) for name, values in series.items()},
+        'rolling': {name: to_list(rolling_mean(values, rolling_window)) for name, values in series.items()},
+        'rolling_window': rolling_window,
+        'week_over_week': {name: week_over_week(values) for name, values in series.items()},
+        'focus_heatmap': heatmap.round(1).tolist(),
+        'correlations': correlations,
+    }
@@ -1,21 +1,184 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, Response, stream_with_context, g, has_app_context
+from flask import stream_template, get_flashed_messages, has_request_context
+from flask import session as flask_session
 from flask_sqlalchemy import SQLAlchemy
-from flask_wtf.csrf import CSRFProtect
-from datetime import datetime, timedelta
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
+from flask_wtf.csrf import CSRFProtect, generate_csrf
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from werkzeug.http import is_resource_modified
+from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.utils import safe_join
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
 import os
+import re
 import json
+import html
+import csv
+import io
 import shutil
-from io import BytesIO
+import sqlite3
+import calendar
+import threading
+import zlib
+import zipfile
+import gzip
+import hashlib
+import mimetypes
+import posixpath
+import urllib.request
+import time
+import click
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from xml.etree import ElementTree
 import secrets
 from markupsafe import escape
 
-app = Flask(__name__)
+# INSTANCE_PATH: DBなどの保存先（デスクトップ版ではユーザーのデータフォルダを指定する）
+app = Flask(__name__, instance_path=os.environ.get('INSTANCE_PATH') or None)
 # セキュリティ強化: ランダムなシークレットキーを生成
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or secrets.token_hex(32)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///productivity.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# 複数ユーザーでの運用: ユーザーごとに別のSQLiteファイル（シャード）にデータを保存
+app.config['MULTI_USER'] = os.environ.get('MULTI_USER') == '1'
+app.config['SQLALCHEMY_BINDS'] = {'accounts': os.environ.get('ACCOUNTS_DATABASE_URL') or 'sqlite:///accounts.db'}
+app.config['SHARD_DIRECTORY'] = os.environ.get('SHARD_DIRECTORY') or os.path.join(app.instance_path, 'shards')
+app.config['SHARD_MAX_OPEN_ENGINES'] = int(os.environ.get('SHARD_MAX_OPEN_ENGINES', 32))
+# コンパイル済みテンプレートの保存先（gunicornのワーカー間で共有、デスクトップ版ではビルド時に同梱）
+app.config['TEMPLATE_CACHE_DIR'] = os.environ.get('TEMPLATE_CACHE_DIR') or os.path.join(app.instance_path, 'template_cache')
+# importした時点でDBを準備する（gunicorn app:app で起動する場合も含む）。
+# 起動時間を別に計測するデスクトップ版などは 0 にして、自分で init_database() を呼ぶ
+app.config['INIT_DATABASE_ON_IMPORT'] = os.environ.get('INIT_DATABASE_ON_IMPORT', '1') == '1'
+
+# 読み書きの分離: GET/HEADのリクエストは読み取り専用のエンジンで読み、書き込みのロックを待たない
+# （書き込み用のエンジンはWALモードにするので、読み取りと書き込みが互いをブロックしない）
+app.config['SQLITE_READ_ENGINE'] = os.environ.get('SQLITE_READ_ENGINE', '1') == '1'
+READ_ONLY_METHODS = ('GET', 'HEAD')
+
+class ReadOnlyRequestError(RuntimeError):
+    """GET/HEADのリクエストの中でデータを書き換えようとした"""
+
+class ShardedSession(FlaskSQLAlchemySession):
+    """ログイン中のユーザーのデータを、そのユーザーのシャードのエンジンに振り分けるセッション
+    
+    GET/HEADのリクエストでは、同じファイルを読み取り専用で開いたエンジンに振り分ける
+    """
+    
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        if bind is None and has_app_context() and engine is self._db.engines.get(None):
+            if g.get('shard'):
+                engine = shard_engines.get(g.shard)
+            if g.get('read_only'):
+                return read_engines.get(engine)
+        return engine
+
+def use_wal(dbapi_connection, connection_record):
+    """書き込み用の接続をWALモードにする（DBファイルに記録されるので、2回目以降は何もしない）"""
+    dbapi_connection.execute('PRAGMA journal_mode = WAL')
+
+def set_query_only(dbapi_connection, connection_record):
+    # mode=ro に加えて、書き込みの文をSQLiteが実行前に拒否するようにする
+    dbapi_connection.execute('PRAGMA query_only = ON')
+
+def configure_writer_engine(engine):
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', use_wal)
+    return engine
+
+class ReadEngines:
+    """書き込み用のエンジンごとに、同じファイルを読み取り専用（mode=ro）で開くエンジンを保持する"""
+    
+    def __init__(self):
+        self.engines = {}
+        self.lock = threading.Lock()
+    
+    def get(self, writer):
+        path = writer.url.database
+        with self.lock:
+            engine = self.engines.get(path)
+            if engine is None:
+                # 読み取り専用の接続ではWALに切り替えられないので、先に書き込み用の接続で切り替えておく
+                with writer.connect():
+                    pass
+                engine = create_engine(f'sqlite:///file:{path}?mode=ro&uri=true')
+                event.listen(engine, 'connect', set_query_only)
+                self.engines[path] = engine
+            return engine
+    
+    def close(self, path):
+        with self.lock:
+            engine = self.engines.pop(path, None)
+        if engine is not None:
+            engine.dispose()
+
+read_engines = ReadEngines()
+
+@app.before_request
+def route_reads():
+    """以降のクエリを、GET/HEADなら読み取り専用のエンジン、それ以外は書き込み用のエンジンに向ける"""
+    g.read_only = app.config['SQLITE_READ_ENGINE'] and request.method in READ_ONLY_METHODS
+
+@event.listens_for(ShardedSession, 'before_flush')
+def forbid_writes_on_read_requests(session, flush_context, instances):
+    if g.get('read_only') and (session.new or session.dirty or session.deleted):
+        raise ReadOnlyRequestError(f'{request.method} {request.path} でデータを書き換えようとしました（書き込みはPOSTで行う）')
+
+class ShardEngines:
+    """シャードごとのエンジンを、開いておく数に上限を付けて保持する（LRU）"""
+    
+    def __init__(self, max_open):
+        self.max_open = max_open
+        self.engines = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def path(self, shard):
+        return os.path.join(app.config['SHARD_DIRECTORY'], shard)
+    
+    def get(self, shard):
+        with self.lock:
+            engine = self.engines.pop(shard, None)
+            if engine is None:
+                engine = self.open(shard)
+            self.engines[shard] = engine
+            while len(self.engines) > self.max_open:
+                evicted_shard, evicted = self.engines.popitem(last=False)
+                evicted.dispose()  # 使用中の接続は返却時に閉じられる
+                read_engines.close(self.path(evicted_shard))
+            return engine
+    
+    def open(self, shard):
+        os.makedirs(app.config['SHARD_DIRECTORY'], exist_ok=True)
+        engine = configure_writer_engine(create_engine(f'sqlite:///{self.path(shard)}'))
+        migrated = ensure_schema(engine)
+        with engine.begin() as connection:
+            seed_change_log(connection)
+            seed_defaults(connection)
+            if migrated:
+                backfill_local_dates(connection)
+                backfill_pomodoro_status(connection)
+        return engine
+    
+    def close(self, shard):
+        with self.lock:
+            engine = self.engines.pop(shard, None)
+        if engine is not None:
+            engine.dispose()
+        read_engines.close(self.path(shard))
+
+shard_engines = ShardEngines(app.config['SHARD_MAX_OPEN_ENGINES'])
+
+
 # CSRF保護を有効化
+# トークンはセッションの間有効にする（オフライン中にキューに入れた操作を後で再送できるように）
+app.config['WTF_CSRF_TIME_LIMIT'] = None
 csrf = CSRFProtect(app)
 
 # セキュリティヘッダーの設定
@@ -28,7 +191,309 @@ def set_security_headers(response):
     response.headers['Content-Security-Policy'] = "default-src 'self' https://cdn.jsdelivr.net; script-src 'self' 'unsafe-inline' https://cdn.jsdelivr.net; style-src 'self' 'unsafe-inline' https://cdn.jsdelivr.net;"
     return response
 
-db = SQLAlchemy(app)
+# Static Assets
+# CDNから読み込んでいたライブラリを static/vendor に置き、`flask build-assets` で
+# 内容のハッシュ付きファイル名＋gzip/brotli圧縮済みのファイルを static/dist に作る。
+# ビルド前（manifestがない時）は従来どおりCDNのURLを返す
+STATIC_DIST = os.path.join(app.static_folder, 'dist')
+ASSET_MANIFEST = os.path.join(STATIC_DIST, 'manifest.json')
+VENDOR_ASSETS = {
+    'vendor/bootstrap/bootstrap.min.css': 'https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/css/bootstrap.min.css',
+    'vendor/bootstrap/bootstrap.bundle.min.js': 'https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/js/bootstrap.bundle.min.js',
+    'vendor/bootstrap-icons/bootstrap-icons.css': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.8.1/font/bootstrap-icons.css',
+    'vendor/bootstrap-icons/fonts/bootstrap-icons.woff2': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.8.1/font/fonts/bootstrap-icons.woff2',
+    'vendor/bootstrap-icons/fonts/bootstrap-icons.woff': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.8.1/font/fonts/bootstrap-icons.woff',
+    'vendor/chart.js/chart.min.js': 'https://cdn.jsdelivr.net/npm/chart.js@3.9.1/dist/chart.min.js',
+}
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.json', '.txt', '.map', '.webmanifest'}
+COMPRESSIBLE_MIMETYPES = {'text/html', 'text/css', 'text/plain', 'text/calendar', 'text/csv', 'application/json',
+                          'application/javascript', 'image/svg+xml'}
+COMPRESS_MIN_SIZE = 1024  # これより小さいレスポンスは圧縮しても得にならない
+CSS_URL_PATTERN = re.compile(r'url\(\s*(["\']?)([^"\')?#]+)([?#][^"\')]*)?\1\s*\)')
+
+@lru_cache(maxsize=1)
+def load_asset_manifest(mtime):
+    with open(ASSET_MANIFEST, encoding='utf-8') as f:
+        return json.load(f)
+
+def asset_manifest():
+    try:
+        return load_asset_manifest(os.path.getmtime(ASSET_MANIFEST))
+    except OSError:
+        return {}
+
+def asset_url(name):
+    """テンプレート用: ビルド済みならハッシュ付きのURL、未ビルドならCDN（なければ通常の /static）"""
+    hashed = asset_manifest().get(name)
+    if hashed:
+        return url_for('serve_asset', filename=hashed)
+    if name in VENDOR_ASSETS:
+        return VENDOR_ASSETS[name]
+    return url_for('static', filename=name)
+
+app.jinja_env.globals['asset_url'] = asset_url
+
+@app.route('/assets/<path:filename>')
+def serve_asset(filename):
+    """ハッシュ付きファイルは中身が変わらないので1年間キャッシュさせ、圧縮済みがあればそれを返す"""
+    path = safe_join(STATIC_DIST, filename)
+    if path is None or not os.path.isfile(path):
+        return 'Not Found', 404
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = None
+    for candidate, extension in (('br', '.br'), ('gzip', '.gz')):
+        if candidate in request.accept_encodings and os.path.isfile(path + extension):
+            path, encoding = path + extension, candidate
+            break
+    response = send_file(path, mimetype=mimetype, conditional=True, max_age=31536000)
+    response.cache_control.immutable = True
+    response.cache_control.public = True
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.after_request
+def compress_response(response):
+    """HTML・JSONなど動的なレスポンスをgzip圧縮
+
+    ファイル送信（send_file）とストリーミングは対象外。ただし stream_page で描画しながら送るページは、
+    届いた分ずつ圧縮する
+    """
+    response.vary.add('Accept-Encoding')
+    if (response.direct_passthrough or response.status_code < 200
+            or response.status_code in (204, 304) or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES or 'gzip' not in request.accept_encodings):
+        return response
+    if response.is_streamed:
+        if getattr(response, 'compress_stream', False) and response.status_code == 200:
+            response.response = gzip_stream(response.iter_encoded())
+            response.headers['Content-Encoding'] = 'gzip'
+            response.headers.pop('Content-Length', None)
+            weaken_etag(response)
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    weaken_etag(response)
+    return response
+
+def weaken_etag(response):
+    """圧縮後はバイト列が変わるので弱いETagにする"""
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+def gzip_stream(chunks):
+    """ストリーミングのレスポンスを、届いた分ずつflushしながらgzip圧縮する"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+
+def download_vendor_assets():
+    """未取得のライブラリをCDNから static/vendor にダウンロード"""
+    for name, source in VENDOR_ASSETS.items():
+        path = os.path.join(app.static_folder, name)
+        if os.path.exists(path):
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with urllib.request.urlopen(source, timeout=30) as remote:
+            data = remote.read()
+        with open(path, 'wb') as f:
+            f.write(data)
+        click.echo(f'ダウンロード: {name}')
+
+def build_assets():
+    """static以下をハッシュ付きのファイル名で static/dist にコピーし、圧縮版と manifest.json を作る"""
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+    
+    sources = []
+    for root, dirs, files in os.walk(app.static_folder):
+        if os.path.abspath(root).startswith(os.path.abspath(STATIC_DIST)):
+            continue
+        for filename in files:
+            sources.append(os.path.relpath(os.path.join(root, filename), app.static_folder).replace(os.sep, '/'))
+    # CSSが参照するフォントや画像の名前を先に決めてから、CSS内のurl()を書き換える
+    sources.sort(key=lambda name: (name.endswith('.css'), name))
+    
+    shutil.rmtree(STATIC_DIST, ignore_errors=True)
+    manifest = {}
+    for name in sources:
+        with open(os.path.join(app.static_folder, name), 'rb') as f:
+            data = f.read()
+        if name.endswith('.css'):
+            directory = posixpath.dirname(name)
+            
+            def rewrite(match):
+                target = posixpath.normpath(posixpath.join(directory, match.group(2)))
+                if target not in manifest:
+                    return match.group(0)
+                return f'url("{posixpath.relpath(manifest[target], posixpath.dirname(name))}")'
+            data = CSS_URL_PATTERN.sub(rewrite, data.decode('utf-8')).encode('utf-8')
+        
+        stem, extension = posixpath.splitext(name)
+        hashed = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{extension}'
+        manifest[name] = hashed
+        path = os.path.join(STATIC_DIST, hashed)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        if extension in COMPRESSIBLE_EXTENSIONS:
+            with open(path + '.gz', 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=9))
+            if brotli is not None:
+                with open(path + '.br', 'wb') as f:
+                    f.write(brotli.compress(data, quality=11))
+    
+    with open(ASSET_MANIFEST, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+    return manifest
+
+@app.cli.command('build-assets')
+@click.option('--offline', is_flag=True, help='ダウンロードせず、static にあるファイルだけでビルドする')
+def build_assets_command(offline):
+    """ライブラリを取得し、ハッシュ付き・圧縮済みの静的ファイルを static/dist に作る"""
+    if not offline:
+        download_vendor_assets()
+    manifest = build_assets()
+    click.echo(f'{len(manifest)}個のファイルを {STATIC_DIST} に出力しました')
+
+# Templates
+# 一覧が長くなるページは stream_template で描画しながら送り、base.html のヘッダー部分を先に届ける。
+# コンパイル済みのテンプレートはファイルに保存し、起動直後やワーカーごとの再コンパイルを省く
+STREAM_CHUNK_SIZE = 16 * 1024  # これだけたまったら送る（Jinjaは細かい単位で出力するため）
+STREAM_QUERY_BATCH = 500
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    """テンプレート名だけをキーにする（ビルドした場所と実行する場所でパスが違っても使える）"""
+    
+    def get_cache_key(self, name, filename=None):
+        return super().get_cache_key(name)
+    
+    def dump_bytecode(self, bucket):
+        # 同梱したキャッシュが読み取り専用でも、描画は続ける
+        try:
+            super().dump_bytecode(bucket)
+        except OSError:
+            pass
+
+def enable_template_cache():
+    try:
+        os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+    except OSError:
+        return
+    app.jinja_env.bytecode_cache = TemplateBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])
+
+enable_template_cache()
+
+def compile_templates():
+    """すべてのテンプレートをコンパイルしてキャッシュに保存（デスクトップ版のビルド用）"""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
+
+@app.cli.command('compile-templates')
+def compile_templates_command():
+    """テンプレートをコンパイルして TEMPLATE_CACHE_DIR に保存する"""
+    names = compile_templates()
+    click.echo(f'{len(names)}個のテンプレートを {app.config["TEMPLATE_CACHE_DIR"]} に保存しました')
+
+class StreamedRows:
+    """テンプレートに渡すクエリ結果。全件をリストにせず、描画しながら少しずつ読み込む"""
+    
+    def __init__(self, query):
+        self.query = query
+    
+    def __bool__(self):
+        return self.query.first() is not None
+    
+    def __iter__(self):
+        return iter(self.query.yield_per(STREAM_QUERY_BATCH))
+
+def stream_page(template_name, **context):
+    """テンプレートを描画しながら送るレスポンス"""
+    # セッションは最初のバイトを送る前に保存されるので、セッションを書き換える処理は先に済ませる
+    generate_csrf()
+    get_flashed_messages()
+    # リクエストのコンテキストを保ったまま描画するよう、ここ（リクエストの中）で作っておく
+    chunks = stream_template(template_name, **context)
+    
+    def generate():
+        buffer, size = [], 0
+        for chunk in chunks:
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield ''.join(buffer)
+    response = Response(generate(), mimetype='text/html')
+    response.compress_stream = True  # compress_response で届いた分ずつgzip圧縮する
+    return response
+
+# Progressive Web App
+# Service Workerがアプリの骨組み（よく使う画面と静的ファイル）をキャッシュし、
+# オフライン中のポモドーロ・習慣・時間記録の操作をIndexedDBにためて、接続が戻ったら再送する
+PWA_SHELL_PAGES = ['/dashboard', '/pomodoro', '/habits', '/offline']
+PWA_SHELL_ASSETS = ['vendor/bootstrap/bootstrap.min.css', 'vendor/bootstrap/bootstrap.bundle.min.js',
+                    'vendor/bootstrap-icons/bootstrap-icons.css', 'vendor/chart.js/chart.min.js',
+                    'icons/icon.svg']
+# オフライン中にキューに入れて後で再送するPOST
+PWA_QUEUED_PATHS = [r'^/api/pomodoro/', r'^/habits/\d+/toggle$', r'^/timetracking/']
+
+@app.route('/manifest.webmanifest')
+def web_manifest():
+    manifest = {
+        'name': '総合ライフマネジメントアプリ',
+        'short_name': 'ライフ管理',
+        'start_url': url_for('dashboard'),
+        'scope': '/',
+        'display': 'standalone',
+        'background_color': '#667eea',
+        'theme_color': '#667eea',
+        'lang': 'ja',
+        'icons': [{'src': asset_url('icons/icon.svg'), 'sizes': 'any', 'type': 'image/svg+xml', 'purpose': 'any maskable'}],
+        'shortcuts': [
+            {'name': 'ポモドーロ', 'url': url_for('pomodoro')},
+            {'name': '習慣', 'url': url_for('habits')},
+        ],
+    }
+    return Response(json.dumps(manifest, ensure_ascii=False), mimetype='application/manifest+json')
+
+@app.route('/sw.js')
+def service_worker():
+    """スコープを / にするためルートで配信。キャッシュ名は静的ファイルが変わるたびに変わる"""
+    shell_assets = [asset_url(name) for name in PWA_SHELL_ASSETS]
+    version = hashlib.sha256(json.dumps([shell_assets, PWA_SHELL_PAGES]).encode()).hexdigest()[:12]
+    body = render_template('sw.js', version=version, shell_pages=PWA_SHELL_PAGES, shell_assets=shell_assets,
+                           queued_paths=PWA_QUEUED_PATHS, queued_at_header=OFFLINE_QUEUED_AT_HEADER)
+    response = Response(body, mimetype='application/javascript')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/offline')
+def offline():
+    return render_template('offline.html')
+
+db = SQLAlchemy(app, session_options={'class_': ShardedSession})
+with app.app_context():
+    for _engine in db.engines.values():
+        configure_writer_engine(_engine)
 
 # セキュリティ: 入力値のサニタイズ関数
 def sanitize_input(text, max_length=None):
@@ -52,6 +517,16 @@ def validate_integer(value, min_val=None, max_val=None, default=None):
     except (ValueError, TypeError):
         return default
 
+def validate_float(value, min_val=None, max_val=None, default=None):
+    """小数値のバリデーション（範囲外・数値でない値は default）"""
+    try:
+        val = float(value)
+    except (ValueError, TypeError):
+        return default
+    if val != val or (min_val is not None and val < min_val) or (max_val is not None and val > max_val):
+        return default
+    return val
+
 def validate_date(date_string):
     """日付のバリデーション"""
     try:
@@ -59,14 +534,35 @@ def validate_date(date_string):
     except (ValueError, TypeError):
         return None
 
+# オフライン中にキューに入れた操作は、再送時にこのヘッダーで元の操作時刻（UNIX時間のミリ秒）を伝える
+OFFLINE_QUEUED_AT_HEADER = 'X-Offline-Queued-At'
+OFFLINE_QUEUE_MAX_AGE = timedelta(days=7)
+
+def request_time():
+    """操作の時刻（UTC）。オフラインから再送された操作なら元の時刻を、それ以外は現在時刻を返す"""
+    now = datetime.utcnow()
+    queued_at = validate_integer(request.headers.get(OFFLINE_QUEUED_AT_HEADER))
+    if queued_at is None:
+        return now
+    queued = datetime.fromtimestamp(queued_at / 1000, timezone.utc).replace(tzinfo=None)
+    return min(max(queued, now - OFFLINE_QUEUE_MAX_AGE), now)
+
 # Settings Model
+# 日付の区切りに使うタイムゾーン（設定で変更でき、マルチユーザーではユーザーごとのシャードに保存される）
+DEFAULT_TIMEZONE = os.environ.get('APP_TIMEZONE') or 'Asia/Tokyo'
+
 class Settings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     pomodoro_work_duration = db.Column(db.Integer, default=25)
     pomodoro_break_duration = db.Column(db.Integer, default=5)
     pomodoro_long_break_duration = db.Column(db.Integer, default=15)
+    work_day_start_hour = db.Column(db.Integer, default=9)  # 自動スケジュールの作業時間帯
+    work_day_end_hour = db.Column(db.Integer, default=18)
     terms_accepted = db.Column(db.Boolean, default=False)
     terms_accepted_at = db.Column(db.DateTime)
+    calendar_updated_at = db.Column(db.DateTime)  # iCalendarフィードの最終更新
+    last_maintenance_at = db.Column(db.DateTime)  # ANALYZE・incremental_vacuumの最終実行
+    timezone = db.Column(db.String(50), default=DEFAULT_TIMEZONE)  # 「今日」や日ごとの集計の区切り
 
 def get_settings():
     settings = Settings.query.first()
@@ -76,6 +572,40 @@ def get_settings():
         db.session.commit()
     return settings
 
+# Timezone
+# 日時はUTCで保存し、日ごとの集計に使う日付（local_date）は書き込み時に設定のタイムゾーンで一度だけ計算する
+
+@lru_cache(maxsize=None)
+def load_timezone(name):
+    try:
+        return ZoneInfo(name or DEFAULT_TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo(DEFAULT_TIMEZONE)
+
+def current_timezone(connection=None):
+    """設定のタイムゾーン。アプリコンテキストごと（シャードごと）に1回だけ読む"""
+    cache = g.setdefault('timezones', {}) if has_app_context() else {}
+    key = g.get('shard') if has_app_context() else None
+    if key not in cache:
+        name = (connection or db.session).execute(db.select(Settings.timezone).limit(1)).scalar()
+        cache[key] = load_timezone(name)
+    return cache[key]
+
+def to_local_date(utc_datetime, tz=None):
+    """UTCの日時を、設定のタイムゾーンでの日付にする"""
+    return utc_datetime.replace(tzinfo=timezone.utc).astimezone(tz or current_timezone()).date()
+
+def local_today():
+    return to_local_date(datetime.utcnow())
+
+def local_now():
+    """設定のタイムゾーンでの現在時刻（予定と同じnaiveなローカル時刻）"""
+    return datetime.now(current_timezone()).replace(tzinfo=None)
+
+@lru_cache(maxsize=1)
+def timezone_choices():
+    return sorted(available_timezones() | {DEFAULT_TIMEZONE, 'UTC'})
+
 # Models
 class Task(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -88,6 +618,7 @@ class Task(db.Model):
     due_date = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     completed_at = db.Column(db.DateTime)
+    completed_local_date = db.Column(db.Date, index=True)  # completed_at の日付（設定のタイムゾーン）
 
 class PomodoroSession(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -96,6 +627,15 @@ class PomodoroSession(db.Model):
     started_at = db.Column(db.DateTime, default=datetime.utcnow)
     completed = db.Column(db.Boolean, default=False)
     task_id = db.Column(db.Integer, db.ForeignKey('task.id'))
+    client_id = db.Column(db.String(36), unique=True, index=True)  # オフラインで開始したセッションをブラウザ側で識別するID
+    local_date = db.Column(db.Date, index=True)  # started_at の日付（設定のタイムゾーン）
+    status = db.Column(db.String(20), default='running')  # running, paused, completed, abandoned
+    paused_at = db.Column(db.DateTime)
+    paused_seconds = db.Column(db.Integer, default=0)  # 一時停止していた合計
+    ended_at = db.Column(db.DateTime)  # 完了・放棄した時刻（進行中はNULL）
+    
+    # 進行中のセッション（ユーザーごとに高々1件）だけの部分インデックス
+    __table_args__ = (db.Index('ix_pomodoro_session_active', 'status', sqlite_where=db.text('ended_at IS NULL')),)
 
 class Habit(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -103,16 +643,30 @@ class Habit(db.Model):
     description = db.Column(db.Text)
     frequency = db.Column(db.String(20), default='daily')
     color = db.Column(db.String(20), default='primary')
+    days_of_week = db.Column(db.String(20))  # custom用 comma-separated: 0(月)-6(日)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     logs = db.relationship('HabitLog', backref='habit', lazy=True, cascade='all, delete-orphan')
+    bitmaps = db.relationship('HabitBitmap', lazy=True, cascade='all, delete-orphan')
 
 class HabitLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     habit_id = db.Column(db.Integer, db.ForeignKey('habit.id'), nullable=False)
     completed = db.Column(db.Boolean, default=True)
     note = db.Column(db.Text)
-    date = db.Column(db.Date, default=datetime.utcnow)
+    date = db.Column(db.Date, default=datetime.utcnow)  # 達成した日（設定のタイムゾーンでの「今日」）
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.Index('ix_habit_log_habit_date', 'habit_id', 'date'),)
+
+HABIT_BITMAP_BYTES = 46  # 366ビット
+
+class HabitBitmap(db.Model):
+    """習慣ごと・年ごとの達成記録（HabitLogと同期）"""
+    __table_args__ = (db.UniqueConstraint('habit_id', 'year'),)
+    id = db.Column(db.Integer, primary_key=True)
+    habit_id = db.Column(db.Integer, db.ForeignKey('habit.id'), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    bits = db.Column(db.LargeBinary(HABIT_BITMAP_BYTES), nullable=False)
 
 class HealthLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -123,6 +677,9 @@ class HealthLog(db.Model):
     sleep_hours = db.Column(db.Float)
     mood = db.Column(db.String(20))
     note = db.Column(db.Text)
+    
+    # 1日1行。取り込みやフォームの保存は date をキーにしたUPSERTで行う
+    __table_args__ = (db.Index('ux_health_log_date', 'date', unique=True),)
 
 class LearningItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -160,10 +717,28 @@ class Goal(db.Model):
     description = db.Column(db.Text)
     goal_type = db.Column(db.String(20), default='short')  # short, medium, long
     target_date = db.Column(db.DateTime)
-    progress = db.Column(db.Integer, default=0)  # 0-100
+    progress = db.Column(db.Integer, default=0)  # 0-100（項目を紐付けた目標では下の2つから計算）
     status = db.Column(db.String(20), default='active')  # active, completed, abandoned
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     completed_at = db.Column(db.DateTime)
+    # 紐付けた項目の達成度の合計（各項目0〜1）と項目数。項目が記録されるたびに差分だけ加減する
+    progress_done = db.Column(db.Float, default=0)
+    progress_total = db.Column(db.Integer, default=0)
+    links = db.relationship('GoalLink', backref='goal', lazy=True, cascade='all, delete-orphan')
+
+class GoalLink(db.Model):
+    """目標に紐付けたタスク・習慣・学習項目と、その達成度（current / target）"""
+    id = db.Column(db.Integer, primary_key=True)
+    goal_id = db.Column(db.Integer, db.ForeignKey('goal.id'), nullable=False, index=True)
+    item_type = db.Column(db.String(20), nullable=False)  # task, habit, learning
+    item_id = db.Column(db.Integer, nullable=False)
+    metric = db.Column(db.String(20), nullable=False)  # completion, streak, count, hours
+    target = db.Column(db.Float, nullable=False)
+    current = db.Column(db.Float, default=0)
+    since = db.Column(db.Date)  # count: この日以降の達成だけを数える
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.Index('ix_goal_link_item', 'item_type', 'item_id'),)
 
 class Reminder(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -201,6 +776,15 @@ class TimeEntry(db.Model):
     end_time = db.Column(db.DateTime)
     duration_minutes = db.Column(db.Integer)
     is_running = db.Column(db.Boolean, default=False)
+    local_date = db.Column(db.Date)  # start_time の日付（設定のタイムゾーン）
+    
+    __table_args__ = (
+        # 記録中のエントリは常に0〜1件なので、その行だけの部分インデックスにする
+        db.Index('ix_time_entry_running', 'is_running', sqlite_where=db.text('is_running = 1')),
+        # 期間で絞ってプロジェクトごとに集計するクエリが、テーブルを読まずにインデックスだけで済むように
+        db.Index('ix_time_entry_local_report', 'local_date', 'project_name', 'duration_minutes', 'is_running',
+                 'start_time'),
+    )
 
 class CalendarEvent(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -211,25 +795,494 @@ class CalendarEvent(db.Model):
     end_time = db.Column(db.DateTime)
     location = db.Column(db.String(200))
     reminder_sent = db.Column(db.Boolean, default=False)
+    uid = db.Column(db.String(255), index=True)  # iCalendarのUID（インポート時）
+    recurrence_freq = db.Column(db.String(20), index=True)  # None(一回限り), daily, weekly, monthly
+    recurrence_interval = db.Column(db.Integer, default=1)
+    recurrence_byday = db.Column(db.String(20))  # weekly用 comma-separated: 0(月)-6(日)
+    recurrence_until = db.Column(db.DateTime)
+    recurrence_count = db.Column(db.Integer)
+    recurrence_exdates = db.Column(db.Text)  # 除外日 comma-separated: YYYY-MM-DD
+    reminder_sent_until = db.Column(db.DateTime)  # 繰り返し予定で通知済みの最後の発生日時
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ArchiveRollup(db.Model):
+    """アーカイブに移した行の日ごとの集計（source: pomodoro_session, habit_log, time_entry, learning_session）"""
+    id = db.Column(db.Integer, primary_key=True)
+    source = db.Column(db.String(30), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    ref_id = db.Column(db.Integer, nullable=False, default=0)  # task_id, habit_id, learning_item_id（なければ0）
+    label = db.Column(db.String(100), nullable=False, default='')  # time_entryのプロジェクト名
+    count = db.Column(db.Integer, nullable=False, default=0)
+    amount = db.Column(db.Float, nullable=False, default=0)  # 分（学習記録は時間）
+    
+    __table_args__ = (db.UniqueConstraint('source', 'day', 'ref_id', 'label', name='uq_archive_rollup'),)
+
+class ChangeLog(db.Model):
+    """差分同期用の変更履歴。1行につき最新の変更1件だけを残し、seqは単調増加"""
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    table_name = db.Column(db.String(50), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)  # upsert, delete
+    changed_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.Index('ix_change_log_row', 'table_name', 'row_id'), {'sqlite_autoincrement': True})
+
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), default='queued', index=True)  # queued, running, succeeded, failed, cancelled
+    params = db.Column(db.Text)  # JSON
+    message = db.Column(db.String(500))
+    error = db.Column(db.Text)
+    result_path = db.Column(db.String(500))
+    result_name = db.Column(db.String(200))
+    result_mimetype = db.Column(db.String(100))
+    cancel_requested = db.Column(db.Boolean, default=False)
+    progress = db.Column(db.Integer)  # 実行中の進捗（0〜100）。進捗を報告するジョブのみ
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'label': JOB_LABELS.get(self.kind, self.kind),
+            'status': self.status,
+            'message': self.message,
+            'error': self.error,
+            'cancel_requested': bool(self.cancel_requested),
+            'progress': self.progress,
+            'download_url': url_for('download_job', job_id=self.id) if self.status == 'succeeded' and self.result_path else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+# 置き換えたインデックス。既存DBに残っていると書き込みのたびに更新されるので削除する
+DROPPED_INDEXES = (
+    'ix_time_entry_report',  # ix_time_entry_local_report に置き換え
+)
+
+def upgrade_schema(engine=None):
+    """既存DBに不足しているカラムとインデックスを追加する簡易マイグレーション"""
+    engine = engine or db.engine
+    inspector = db.inspect(engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        with engine.begin() as connection:
+            for column in table.columns:
+                if column.name not in existing:
+                    ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}'
+                    if column.default is not None and column.default.is_scalar:
+                        literal = column.type.literal_processor(engine.dialect)
+                        ddl += f' DEFAULT {literal(column.default.arg) if literal else column.default.arg}'
+                    connection.execute(db.text(ddl))
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    with engine.begin() as connection:
+        for name in DROPPED_INDEXES:
+            connection.execute(db.text(f'DROP INDEX IF EXISTS {name}'))
+
+def schema_fingerprint():
+    """モデル定義（テーブル・カラム・インデックス）のハッシュ。PRAGMA user_version に保存して比較する"""
+    parts = []
+    for table in db.metadata.sorted_tables:
+        parts.append(table.name)
+        parts.extend(f'{column.name}:{column.type}' for column in table.columns)
+        parts.extend(sorted(index.name for index in table.indexes))
+    parts.extend(f'-{name}' for name in DROPPED_INDEXES)
+    return zlib.crc32('\n'.join(parts).encode('utf-8')) & 0x7fffffff
+
+def ensure_schema(engine):
+    """モデルが変わっていなければ、テーブル作成とマイグレーションを省いて起動を速くする"""
+    fingerprint = schema_fingerprint()
+    with engine.connect() as connection:
+        if connection.exec_driver_sql('PRAGMA user_version').scalar() == fingerprint:
+            return False
+    with engine.begin() as connection:
+        enable_incremental_vacuum(connection)
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        # 一意インデックスを作る前に、同じ日付の健康記録を1行にまとめる
+        merge_duplicate_health_logs(connection)
+    upgrade_schema(engine)
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f'PRAGMA user_version = {fingerprint}')
+    return True
+
+def init_database():
+    """テーブル作成・マイグレーション・既存データの移行"""
+    if app.config['MULTI_USER']:
+        init_accounts()
+    migrated = ensure_schema(db.engine)
+    seed_change_log(db.session.connection())
+    seed_defaults(db.session.connection())
+    if migrated:
+        backfill_local_dates(db.session.connection())
+        backfill_pomodoro_status(db.session.connection())
+    db.session.commit()
+    fail_interrupted_jobs()
+    if HabitBitmap.query.first() is None and HabitLog.query.first() is not None:
+        rebuild_habit_bitmaps()
+
+# カレンダーフィードに載るデータが変わったら更新日時を記録（ETag/Last-Modified用）
+CALENDAR_FEED_IGNORED_ATTRS = {'reminder_sent', 'reminder_sent_until', 'completed_pomodoros'}
+
+def touch_calendar_feed(mapper, connection, target):
+    connection.execute(Settings.__table__.update().values(calendar_updated_at=datetime.utcnow()))
+
+def touch_calendar_feed_on_update(mapper, connection, target):
+    # 通知済みフラグなどフィードの内容に関係しない更新では無視
+    state = db.inspect(target)
+    if any(state.attrs[attr.key].history.has_changes()
+           for attr in mapper.column_attrs if attr.key not in CALENDAR_FEED_IGNORED_ATTRS):
+        touch_calendar_feed(mapper, connection, target)
+
+for _model in (CalendarEvent, Task, Goal):
+    event.listen(_model, 'after_insert', touch_calendar_feed)
+    event.listen(_model, 'after_update', touch_calendar_feed_on_update)
+    event.listen(_model, 'after_delete', touch_calendar_feed)
+
+# 日ごとに集計する日時の列: モデル → (UTCの日時の列, 日付の列)
+LOCAL_DATE_COLUMNS = {
+    PomodoroSession: ('started_at', 'local_date'),
+    Task: ('completed_at', 'completed_local_date'),
+    TimeEntry: ('start_time', 'local_date'),
+}
+LOCAL_DATE_BATCH_SIZE = 1000
+
+def set_local_date(mapper, connection, target):
+    source, column = LOCAL_DATE_COLUMNS[mapper.class_]
+    state = db.inspect(target)
+    if state.persistent and not state.attrs[source].history.has_changes():
+        return
+    value = getattr(target, source)
+    if value is None and mapper.columns[source].default is not None:
+        # 列のデフォルト（utcnow）はINSERTの実行時に決まるので、ここで先に決めておく
+        value = datetime.utcnow()
+        setattr(target, source, value)
+    setattr(target, column, to_local_date(value, current_timezone(connection)) if value else None)
+
+for _model in LOCAL_DATE_COLUMNS:
+    event.listen(_model, 'before_insert', set_local_date)
+    event.listen(_model, 'before_update', set_local_date)
+
+def backfill_local_dates(connection, recompute=False):
+    """日付の列が未設定の行（recompute=Trueなら全行）を計算し直す。更新した行数を返す"""
+    tz = current_timezone(connection)
+    updated = 0
+    for model, (source, column) in LOCAL_DATE_COLUMNS.items():
+        table = model.__table__
+        condition = table.c[source].isnot(None)
+        if not recompute:
+            condition = condition & table.c[column].is_(None)
+        rows = connection.execute(db.select(table.c.id, table.c[source]).where(condition)).all()
+        statement = table.update().where(table.c.id == db.bindparam('row_id')).values(
+            {column: db.bindparam('value')})
+        for i in range(0, len(rows), LOCAL_DATE_BATCH_SIZE):
+            connection.execute(statement, [{'row_id': row_id, 'value': to_local_date(value, tz)}
+                                           for row_id, value in rows[i:i + LOCAL_DATE_BATCH_SIZE]])
+        updated += len(rows)
+    return updated
+
+# Sync
+# 差分同期の対象（HabitBitmapはHabitLogから作り直せるので含めない）
+SYNC_MODELS = (Settings, Task, PomodoroSession, Habit, HabitLog, HealthLog, LearningItem, LearningSession,
+               JournalEntry, Goal, GoalLink, Reminder, Achievement, Note, TimeEntry, CalendarEvent)
+SYNC_TABLES = {model.__tablename__: model.__table__ for model in SYNC_MODELS}
+SYNC_DEFAULT_LIMIT = 1000
+SYNC_MAX_LIMIT = 5000
+SYNC_FETCH_CHUNK = 500  # SQLiteのバインド変数の上限より小さく
+
+def record_change(connection, table_name, row_id, op):
+    """古い履歴を消してから新しいseqで記録するので、履歴は行数＋削除数以上に増えない"""
+    log = ChangeLog.__table__
+    connection.execute(log.delete().where((log.c.table_name == table_name) & (log.c.row_id == row_id)))
+    connection.execute(log.insert().values(table_name=table_name, row_id=row_id, op=op, changed_at=datetime.utcnow()))
+
+def record_upsert(mapper, connection, target):
+    record_change(connection, mapper.local_table.name, target.id, 'upsert')
+
+def record_delete(mapper, connection, target):
+    record_change(connection, mapper.local_table.name, target.id, 'delete')
+
+for _model in SYNC_MODELS:
+    event.listen(_model, 'after_insert', record_upsert)
+    event.listen(_model, 'after_update', record_upsert)
+    event.listen(_model, 'after_delete', record_delete)
+
+def record_bulk_inserts(connection, model, after_id):
+    """bulk insertではマッパーイベントが発火しないので、after_idより後の行をまとめて記録"""
+    table = model.__table__
+    log = ChangeLog.__table__
+    connection.execute(log.insert().from_select(
+        ['table_name', 'row_id', 'op', 'changed_at'],
+        db.select(db.literal(table.name), table.c.id, db.literal('upsert'), db.literal(datetime.utcnow()))
+        .where(table.c.id > after_id).order_by(table.c.id)))
+
+ACHIEVEMENTS_DATA = [
+    {'name': '初めの一歩', 'description': '最初のポモドーロを完了', 'badge_type': 'pomodoro', 'requirement': 1, 'icon': 'alarm'},
+    {'name': 'ポモドーロ初心者', 'description': '10回のポモドーロを完了', 'badge_type': 'pomodoro', 'requirement': 10, 'icon': 'alarm-fill'},
+    {'name': 'ポモドーロマスター', 'description': '100回のポモドーロを完了', 'badge_type': 'pomodoro', 'requirement': 100, 'icon': 'trophy'},
+    {'name': '習慣の力', 'description': '7日連続で習慣を達成', 'badge_type': 'streak', 'requirement': 7, 'icon': 'fire'},
+    {'name': '継続は力なり', 'description': '30日連続で習慣を達成', 'badge_type': 'streak', 'requirement': 30, 'icon': 'star-fill'},
+    {'name': 'タスクハンター', 'description': '50個のタスクを完了', 'badge_type': 'task', 'requirement': 50, 'icon': 'check-circle-fill'},
+]
+
+def seed_defaults(connection):
+    """設定の行と実績の一覧を、DBを開く時に作っておく（GETのリクエストの中で作らずに済むように）"""
+    settings = Settings.__table__
+    if connection.execute(db.select(settings.c.id).limit(1)).first() is None:
+        connection.execute(settings.insert())
+        record_bulk_inserts(connection, Settings, 0)
+    achievements = Achievement.__table__
+    if connection.execute(db.select(achievements.c.id).limit(1)).first() is None:
+        connection.execute(achievements.insert(), ACHIEVEMENTS_DATA)
+        record_bulk_inserts(connection, Achievement, 0)
+
+def record_bulk_upserts(connection, model, condition):
+    """Core のUPSERTではマッパーイベントが発火しないので、condition に一致する行をまとめて記録"""
+    table = model.__table__
+    log = ChangeLog.__table__
+    ids = db.select(table.c.id).where(condition)
+    connection.execute(log.delete().where(log.c.table_name == table.name, log.c.row_id.in_(ids)))
+    connection.execute(log.insert().from_select(
+        ['table_name', 'row_id', 'op', 'changed_at'],
+        db.select(db.literal(table.name), table.c.id, db.literal('upsert'), db.literal(datetime.utcnow()))
+        .where(condition).order_by(table.c.id)))
+
+def seed_change_log(connection):
+    """変更履歴がまだないDBでは、既存の行をすべて履歴に載せて最初の同期で全件届くようにする"""
+    if connection.execute(db.select(ChangeLog.__table__.c.seq).limit(1)).first() is not None:
+        return
+    for model in SYNC_MODELS:
+        record_bulk_inserts(connection, model, 0)
+
+def sync_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+def load_changes(since, limit):
+    """since より後の変更を最大 limit 件、テーブルごとの列名＋行の配列にまとめる"""
+    entries = (db.session.query(ChangeLog.seq, ChangeLog.table_name, ChangeLog.row_id, ChangeLog.op)
+               .filter(ChangeLog.seq > since).order_by(ChangeLog.seq).limit(limit + 1).all())
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    
+    upserts, deleted = {}, {}
+    for _, table_name, row_id, op in entries:
+        if table_name in SYNC_TABLES:
+            (upserts if op == 'upsert' else deleted).setdefault(table_name, []).append(row_id)
+    
+    tables = {}
+    for table_name, ids in upserts.items():
+        table = SYNC_TABLES[table_name]
+        rows = []
+        for i in range(0, len(ids), SYNC_FETCH_CHUNK):
+            result = db.session.execute(db.select(table).where(table.c.id.in_(ids[i:i + SYNC_FETCH_CHUNK])))
+            rows.extend([sync_value(value) for value in row] for row in result)
+        tables[table_name] = {'columns': [column.name for column in table.columns], 'rows': rows}
+    
+    return {
+        'since': since,
+        'next': entries[-1].seq if entries else since,
+        'has_more': has_more,
+        'tables': tables,
+        'deleted': deleted,
+    }
+
+@app.route('/api/sync')
+def api_sync():
+    """差分同期: ?since=<前回のnext> 以降に変更された行と削除された行のIDを返す"""
+    since = validate_integer(request.args.get('since', 0), min_val=0)
+    limit = validate_integer(request.args.get('limit', SYNC_DEFAULT_LIMIT), min_val=1, max_val=SYNC_MAX_LIMIT,
+                             default=SYNC_DEFAULT_LIMIT)
+    if since is None:
+        return jsonify({'error': 'since は0以上の整数で指定してください'}), 400
+    
+    changes = load_changes(since, limit)
+    
+    if 'application/msgpack' in request.headers.get('Accept', ''):
+        try:
+            import msgpack
+        except ImportError:
+            msgpack = None
+        if msgpack is not None:
+            return Response(msgpack.packb(changes), mimetype='application/msgpack')
+    return Response(json.dumps(changes, ensure_ascii=False, separators=(',', ':')), mimetype='application/json')
+
+# Accounts
+class User(db.Model):
+    """複数ユーザー運用時のアカウント（データ本体は shard のSQLiteファイルに保存）"""
+    __bind_key__ = 'accounts'
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(50), unique=True, nullable=False)
+    email = db.Column(db.String(200))
+    password_hash = db.Column(db.String(255), nullable=False)
+    shard = db.Column(db.String(100), unique=True)
+    feed_token = db.Column(db.String(64), unique=True, default=lambda: secrets.token_urlsafe(32))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+def init_accounts():
+    """アカウントのテーブル（accounts バインド）を作成する。import時の init_database() からも呼ばれる"""
+    db.create_all(bind_key='accounts')
+
+def create_user(username, password, email=None):
+    user = User(username=username, email=email, password_hash=generate_password_hash(password))
+    db.session.add(user)
+    db.session.flush()
+    user.shard = f'user_{user.id:06d}.db'
+    db.session.commit()
+    return user
+
+# ログインせずに開けるページ
+PUBLIC_ENDPOINTS = {'login', 'register', 'terms', 'privacy', 'static', 'serve_asset', 'web_manifest',
+                    'service_worker', 'offline'}
+
+@app.before_request
+def load_current_user():
+    """ログイン中のユーザーを読み込み、以降のクエリをそのユーザーのシャードに向ける"""
+    g.user = None
+    g.shard = None
+    if not app.config['MULTI_USER']:
+        return None
+    
+    user_id = flask_session.get('user_id')
+    if user_id:
+        g.user = db.session.get(User, user_id)
+    elif request.endpoint == 'calendar_feed' and request.args.get('token'):
+        # カレンダーアプリはログインできないので購読用トークンで識別
+        g.user = User.query.filter_by(feed_token=request.args['token']).first()
+    
+    if g.user:
+        g.shard = g.user.shard
+        return None
+    if request.endpoint in PUBLIC_ENDPOINTS:
+        return None
+    return redirect(url_for('login', next=request.full_path.rstrip('?') if request.method == 'GET' else None))
+
+@app.context_processor
+def inject_current_user():
+    return {'current_user': g.get('user'), 'multi_user': app.config['MULTI_USER']}
+
 # Middleware to check terms acceptance
 @app.before_request
 def check_terms_acceptance():
     # 利用規約関連のページと静的ファイルは除外
-    excluded_paths = ['/terms', '/privacy', '/accept_terms', '/decline_terms', '/static/', '/terms-agreement']
+    excluded_paths = ['/terms', '/privacy', '/accept_terms', '/decline_terms', '/static/', '/assets/', '/terms-agreement',
+                      '/sw.js', '/manifest.webmanifest', '/offline',
+                      '/login', '/register']
     if any(request.path.startswith(path) for path in excluded_paths):
         return None
+    # 同意済みならセッションに記録し、以降のリクエスト（状態のポーリングなど）ではDBを読まない
+    shard = g.get('shard') or ''
+    if flask_session.get('terms_accepted_for') == shard:
+        return None
     
     settings = get_settings()
     if not settings.terms_accepted:
         return redirect(url_for('terms_agreement'))
+    flask_session['terms_accepted_for'] = shard
 
 # Routes
 @app.route('/')
 def index():
     return redirect(url_for('dashboard'))
 
+@app.route('/login', methods=['GET', 'POST'])
+def login():
+    if not app.config['MULTI_USER']:
+        return redirect(url_for('dashboard'))
+    
+    if request.method == 'POST':
+        username = (request.form.get('username') or '').strip()
+        user = User.query.filter_by(username=username).first()
+        if not user or not check_password_hash(user.password_hash, request.form.get('password') or ''):
+            flash('ユーザー名またはパスワードが正しくありません', 'error')
+            return redirect(url_for('login'))
+        
+        flask_session.clear()
+        flask_session['user_id'] = user.id
+        next_url = request.args.get('next')
+        # 外部サイトへのリダイレクトは許可しない
+        if not next_url or not next_url.startswith('/') or next_url.startswith('//'):
+            next_url = url_for('dashboard')
+        return redirect(next_url)
+    
+    return render_template('login.html')
+
+@app.route('/register', methods=['GET', 'POST'])
+def register():
+    if not app.config['MULTI_USER']:
+        return redirect(url_for('dashboard'))
+    
+    if request.method == 'POST':
+        username = (request.form.get('username') or '').strip()
+        email = sanitize_input(request.form.get('email'), max_length=200)
+        password = request.form.get('password') or ''
+        
+        if not re.fullmatch(r'[A-Za-z0-9_.-]{3,50}', username):
+            flash('ユーザー名は3〜50文字の半角英数字と _ . - で入力してください', 'error')
+            return redirect(url_for('register'))
+        if len(password) < 8:
+            flash('パスワードは8文字以上にしてください', 'error')
+            return redirect(url_for('register'))
+        if User.query.filter_by(username=username).first():
+            flash('このユーザー名は既に使われています', 'error')
+            return redirect(url_for('register'))
+        
+        user = create_user(username, password, email=str(email) if email else None)
+        flask_session.clear()
+        flask_session['user_id'] = user.id
+        flash('アカウントを作成しました', 'success')
+        return redirect(url_for('dashboard'))
+    
+    return render_template('register.html')
+
+@app.route('/logout', methods=['POST'])
+def logout():
+    flask_session.clear()
+    flash('ログアウトしました', 'info')
+    return redirect(url_for('login'))
+
+@app.cli.command('split-to-shard')
+@click.argument('source')
+@click.argument('username')
+@click.option('--force', is_flag=True, help='既存のシャードを上書きする')
+def split_to_shard_command(source, username, force):
+    """単一ユーザー用のDBファイル(SOURCE)をUSERNAMEのシャードとして取り込む"""
+    if not os.path.exists(source):
+        raise click.ClickException(f'{source} が見つかりません')
+    init_accounts()
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        password = click.prompt(f'{username} のパスワード', hide_input=True, confirmation_prompt=True)
+        user = create_user(username, password)
+    
+    path = shard_engines.path(user.shard)
+    if os.path.exists(path) and os.path.getsize(path) and not force:
+        raise click.ClickException(f'{path} は既に存在します（上書きするには --force）')
+    shard_engines.close(user.shard)
+    os.makedirs(app.config['SHARD_DIRECTORY'], exist_ok=True)
+    
+    # SQLiteのバックアップAPIで、使用中のファイルでも一貫した状態でコピー
+    source_connection = sqlite3.connect(f'file:{source}?mode=ro', uri=True)
+    target_connection = sqlite3.connect(path)
+    with target_connection:
+        source_connection.backup(target_connection)
+    source_connection.close()
+    target_connection.close()
+    
+    shard_engines.get(user.shard)  # 開く時に不足テーブル・カラムを追加
+    g.shard = user.shard
+    if HabitBitmap.query.first() is None and HabitLog.query.first() is not None:
+        rebuild_habit_bitmaps()
+    click.echo(f'{source} を {username} のシャード {path} に取り込みました')
+
 @app.route('/terms-agreement')
 def terms_agreement():
     """初回起動時の利用規約同意ページ"""
@@ -252,31 +1305,22 @@ def decline_terms():
 
 @app.route('/dashboard')
 def dashboard():
-    today = datetime.utcnow().date()
-    today_start = datetime.combine(today, datetime.min.time())
-    today_end = datetime.combine(today, datetime.max.time())
+    today = local_today()
     
-    today_sessions = PomodoroSession.query.filter(
-        PomodoroSession.started_at >= today_start,
-        PomodoroSession.started_at <= today_end,
+    today_sessions, today_minutes = db.session.query(
+        db.func.count(PomodoroSession.id), db.func.coalesce(db.func.sum(PomodoroSession.duration), 0)
+    ).filter(
+        PomodoroSession.local_date == today,
         PomodoroSession.completed == True,
         PomodoroSession.session_type == 'work'
-    ).count()
-    
-    today_minutes = PomodoroSession.query.filter(
-        PomodoroSession.started_at >= today_start,
-        PomodoroSession.started_at <= today_end,
-        PomodoroSession.completed == True,
-        PomodoroSession.session_type == 'work'
-    ).with_entities(db.func.sum(PomodoroSession.duration)).scalar() or 0
+    ).one()
     
     active_tasks = Task.query.filter_by(status='in_progress').order_by(Task.priority.desc()).all()
     pending_tasks = Task.query.filter_by(status='todo').order_by(Task.priority.desc(), Task.due_date).limit(5).all()
     
     completed_today = Task.query.filter(
         Task.status == 'completed',
-        Task.completed_at >= today_start,
-        Task.completed_at <= today_end
+        Task.completed_local_date == today
     ).count()
     
     return render_template('dashboard.html',
@@ -286,19 +1330,246 @@ def dashboard():
                          pending_tasks=pending_tasks,
                          completed_today=completed_today)
 
+# Pomodoro
+# 進行中のセッションの状態（running/paused）はサーバーが持ち、タブや端末はそれに合わせて表示する。
+# 状態の問い合わせはメモリの登録簿から答え、状態の変更はDBにも書く。登録簿はプロセス内のメモリなので、
+# JobRunnerと同じく1プロセス（gunicornの既定のワーカー数）で動かす前提
+POMODORO_ACTIVE_STATUSES = ('running', 'paused')
+POMODORO_GRACE_SECONDS = 10 * 60  # 終了予定を過ぎても完了を待つ時間（通知に気づくまで・オフラインからの再送）
+POMODORO_PAUSE_LIMIT_SECONDS = 60 * 60  # これより長く一時停止したままなら放棄とみなす
+POMODORO_SWEEP_SECONDS = 60
+POMODORO_FULL_SWEEP_SECONDS = 60 * 60  # 全ユーザーのDBを見直す間隔（再起動前から残っているセッション用）
+
+# 操作: (遷移できる状態, 遷移後の状態)
+POMODORO_TRANSITIONS = {
+    'pause': (('running',), 'paused'),
+    'resume': (('paused',), 'running'),
+    'complete': (POMODORO_ACTIVE_STATUSES, 'completed'),
+    'abandon': (POMODORO_ACTIVE_STATUSES, 'abandoned'),
+}
+
+class ActivePomodoro:
+    """進行中のセッションのメモリ上の写し"""
+    
+    def __init__(self, session):
+        self.id = session.id
+        self.client_id = session.client_id
+        self.session_type = session.session_type
+        self.task_id = session.task_id
+        self.duration = session.duration
+        self.started_at = session.started_at
+        self.paused_at = session.paused_at
+        self.paused_seconds = session.paused_seconds or 0
+        self.status = session.status or 'running'
+    
+    def elapsed_seconds(self, now):
+        end = self.paused_at if self.status == 'paused' else now
+        return max((end - self.started_at).total_seconds() - self.paused_seconds, 0)
+    
+    def deadline(self):
+        """この時刻を過ぎても完了しなければ放棄とみなす"""
+        if self.status == 'paused':
+            return self.paused_at + timedelta(seconds=POMODORO_PAUSE_LIMIT_SECONDS)
+        return self.started_at + timedelta(seconds=self.duration * 60 + self.paused_seconds + POMODORO_GRACE_SECONDS)
+    
+    def to_dict(self, now):
+        elapsed = self.elapsed_seconds(now)
+        return {
+            'active': True,
+            'session_id': self.id,
+            'client_id': self.client_id,
+            'status': self.status,
+            'session_type': self.session_type,
+            'task_id': self.task_id,
+            'duration': self.duration,
+            'elapsed_seconds': int(elapsed),
+            'remaining_seconds': max(int(self.duration * 60 - elapsed), 0),
+        }
+
+class PomodoroRegistry:
+    """ユーザー（シャード）ごとの進行中のセッション。一度読み込んだら、なし（None）も含めてメモリから答える"""
+    
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+    
+    def get(self, shard):
+        with self.lock:
+            if shard in self.sessions:
+                return self.sessions[shard]
+        session = PomodoroSession.query.filter(PomodoroSession.ended_at.is_(None)).order_by(
+            PomodoroSession.started_at.desc()).first()
+        with self.lock:
+            return self.sessions.setdefault(shard, ActivePomodoro(session) if session else None)
+    
+    def put(self, shard, session):
+        """登録簿の進行中のセッションか、それより新しいセッションのときだけ置き換える"""
+        with self.lock:
+            active = self.sessions.get(shard)
+            if session.ended_at is None:
+                if active is None or active.id == session.id or session.started_at >= active.started_at:
+                    self.sessions[shard] = ActivePomodoro(session)
+            elif active is not None and active.id == session.id:
+                self.sessions[shard] = None
+    
+    def discard(self, shard, session_ids):
+        with self.lock:
+            active = self.sessions.get(shard)
+            if active and active.id in session_ids:
+                self.sessions[shard] = None
+    
+    def expired_shards(self, now):
+        with self.lock:
+            return [shard for shard, active in self.sessions.items() if active and active.deadline() < now]
+
+pomodoro_registry = PomodoroRegistry()
+
+def pomodoro_state():
+    now = datetime.utcnow()
+    active = pomodoro_registry.get(g.get('shard'))
+    state = active.to_dict(now) if active else {'active': False}
+    state['server_time'] = now.isoformat() + 'Z'
+    return state
+
+def transition_pomodoro(session, action, at):
+    """状態遷移をDBと登録簿に反映する。遷移できない状態なら False を返す"""
+    allowed, status = POMODORO_TRANSITIONS[action]
+    current = session.status or 'running'
+    if current not in allowed:
+        # 放棄とみなした後に届いた完了でも、完了した時刻が期限内なら受け付ける（オフラインからの再送など）。
+        # ただし完了した時刻より前に新しいセッションを開始していたら、そのときに放棄したものとして扱う
+        late_completion = (action == 'complete' and current == 'abandoned'
+                           and at <= ActivePomodoro(session).deadline()
+                           and not db.session.query(PomodoroSession.query.filter(
+                               PomodoroSession.started_at > session.started_at,
+                               PomodoroSession.started_at <= at).exists()).scalar())
+        if not late_completion:
+            return False
+    
+    if action == 'pause':
+        session.paused_at = at
+    elif action == 'resume':
+        session.paused_seconds = (session.paused_seconds or 0) + max(int((at - session.paused_at).total_seconds()), 0)
+        session.paused_at = None
+    else:
+        session.ended_at = max(at, session.started_at)
+        session.completed = action == 'complete'
+        if action == 'complete' and session.task_id and session.session_type == 'work':
+            task = Task.query.get(session.task_id)
+            if task:
+                task.completed_pomodoros += 1
+                if task.status == 'todo':
+                    task.status = 'in_progress'
+    session.status = status
+    db.session.commit()
+    pomodoro_registry.put(g.get('shard'), session)
+    return True
+
+def sweep_abandoned_pomodoros(now=None):
+    """期限を過ぎた進行中のセッションを1回のUPDATEで放棄にする。件数を返す"""
+    now = now or datetime.utcnow()
+    expired = [session.id for session in PomodoroSession.query.filter(PomodoroSession.ended_at.is_(None))
+               if ActivePomodoro(session).deadline() < now]
+    if expired:
+        table = PomodoroSession.__table__
+        db.session.execute(table.update().where(table.c.id.in_(expired)).values(status='abandoned', ended_at=now))
+        # Core のUPDATEなのでマッパーイベントは発火しない。同期用の履歴はここで記録する
+        connection = db.session.connection()
+        for session_id in expired:
+            record_change(connection, table.name, session_id, 'upsert')
+        db.session.commit()
+        pomodoro_registry.discard(g.get('shard'), expired)
+    return len(expired)
+
+def backfill_pomodoro_status(connection, now=None):
+    """状態の列を追加する前の行: 完了したものは completed、終わっていないものは abandoned にする
+
+    列の追加時に既定値の running が入るので、一時停止の記録がなく終了予定（猶予を含む）を過ぎたものも
+    終わっていないとみなす（状態のないアーカイブから戻した行も含む）
+    """
+    now = now or datetime.utcnow()
+    table = PomodoroSession.__table__
+    deadline = db.func.datetime(table.c.started_at, '+' + db.cast(
+        table.c.duration * 60 + db.func.coalesce(table.c.paused_seconds, 0) + POMODORO_GRACE_SECONDS, db.String
+    ) + ' seconds')
+    connection.execute(table.update().where(
+        table.c.ended_at.is_(None) & (
+            (table.c.completed == db.true()) | table.c.status.is_(None)
+            | ((table.c.status == 'running') & table.c.paused_at.is_(None) & (deadline < now))
+        )
+    ).values(
+        status=db.case((table.c.completed == db.true(), 'completed'), else_='abandoned'),
+        ended_at=db.func.datetime(table.c.started_at, '+' + db.cast(table.c.duration, db.String) + ' minutes'),
+    ))
+
+class PomodoroSweeper:
+    """期限切れのセッションを定期的に放棄にするスレッド（進行中のユーザーだけを毎回、全員をたまに見る）"""
+    
+    def __init__(self):
+        self.thread = None
+        self.lock = threading.Lock()
+        self.last_full_sweep = None
+    
+    def start(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    # gunicornのforkより後に起動するよう、最初のリクエストで開始する
+                    self.thread = threading.Thread(target=self.loop, name='pomodoro-sweeper', daemon=True)
+                    self.thread.start()
+    
+    def loop(self):
+        while True:
+            with app.app_context():
+                self.run_once()
+            time.sleep(POMODORO_SWEEP_SECONDS)
+    
+    def run_once(self):
+        now = datetime.utcnow()
+        full = self.last_full_sweep is None or now - self.last_full_sweep >= timedelta(seconds=POMODORO_FULL_SWEEP_SECONDS)
+        shards = archive_targets() if full else pomodoro_registry.expired_shards(now)
+        for shard in shards:
+            g.shard = shard
+            try:
+                sweep_abandoned_pomodoros(now)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('%s のポモドーロの整理に失敗しました', shard or 'default')
+        if full:
+            self.last_full_sweep = now
+
+pomodoro_sweeper = PomodoroSweeper()
+
+@app.before_request
+def start_pomodoro_sweeper():
+    pomodoro_sweeper.start()
+
 @app.route('/pomodoro')
 def pomodoro():
     tasks = Task.query.filter(Task.status.in_(['todo', 'in_progress'])).order_by(Task.priority.desc()).all()
     settings = get_settings()
-    return render_template('pomodoro.html', tasks=tasks, settings=settings)
+    return render_template('pomodoro.html', tasks=tasks, settings=settings, state=pomodoro_state())
+
+@app.route('/api/pomodoro/state')
+def pomodoro_state_api():
+    """進行中のセッションの状態（DBを読まずにメモリから返す）"""
+    return jsonify(pomodoro_state())
 
 @app.route('/api/pomodoro/start', methods=['POST'])
 def start_pomodoro():
     data = request.get_json()
     session_type = data.get('session_type', 'work')
     task_id = data.get('task_id')
+    client_id = data.get('client_id')
     settings = get_settings()
     
+    # オフライン時のキューから再送された場合に二重登録しない
+    if client_id:
+        existing = PomodoroSession.query.filter_by(client_id=client_id).first()
+        if existing:
+            return jsonify({'success': True, 'session_id': existing.id, 'duration': existing.duration,
+                            'state': pomodoro_state()})
+    
     if session_type == 'work':
         duration = settings.pomodoro_work_duration
     elif session_type == 'long_break':
@@ -306,30 +1577,42 @@ def start_pomodoro():
     else:
         duration = settings.pomodoro_break_duration
     
+    now = request_time()
+    # 別のタブや端末で進行中のセッションは放棄にする（進行中は常に1つ）
+    for running in PomodoroSession.query.filter(PomodoroSession.ended_at.is_(None)).all():
+        transition_pomodoro(running, 'abandon', now)
+    
     session = PomodoroSession(
         duration=duration,
         session_type=session_type,
-        task_id=task_id if task_id else None
+        task_id=task_id if task_id else None,
+        started_at=now,
+        status='running',
+        client_id=str(client_id)[:36] if client_id else None
     )
     db.session.add(session)
     db.session.commit()
+    pomodoro_registry.put(g.get('shard'), session)
     
-    return jsonify({'success': True, 'session_id': session.id, 'duration': duration})
+    return jsonify({'success': True, 'session_id': session.id, 'duration': duration, 'state': pomodoro_state()})
 
-@app.route('/api/pomodoro/complete/<int:session_id>', methods=['POST'])
-def complete_pomodoro(session_id):
-    session = PomodoroSession.query.get_or_404(session_id)
-    session.completed = True
-    
-    if session.task_id and session.session_type == 'work':
-        task = Task.query.get(session.task_id)
-        if task:
-            task.completed_pomodoros += 1
-            if task.status == 'todo':
-                task.status = 'in_progress'
-    
-    db.session.commit()
-    return jsonify({'success': True})
+@app.route('/api/pomodoro/<any(complete, pause, resume, abandon):action>/<int:session_id>', methods=['POST'])
+def update_pomodoro(action, session_id):
+    return apply_pomodoro_action(PomodoroSession.query.get_or_404(session_id), action)
+
+@app.route('/api/pomodoro/<any(complete, pause, resume, abandon):action>/client/<client_id>', methods=['POST'])
+def update_pomodoro_by_client(action, client_id):
+    """オフライン中に開始してサーバーのIDをまだ知らないセッションの操作"""
+    return apply_pomodoro_action(PomodoroSession.query.filter_by(client_id=client_id).first_or_404(), action)
+
+def apply_pomodoro_action(session, action):
+    _, status = POMODORO_TRANSITIONS[action]
+    if session.status == status:
+        # 同じ操作の再送
+        return jsonify({'success': True, 'state': pomodoro_state()})
+    if not transition_pomodoro(session, action, request_time()):
+        return jsonify({'success': False, 'error': 'このセッションはすでに終了しています', 'state': pomodoro_state()}), 409
+    return jsonify({'success': True, 'state': pomodoro_state()})
 
 @app.route('/tasks')
 def tasks():
@@ -339,8 +1622,8 @@ def tasks():
     if filter_status != 'all':
         query = query.filter_by(status=filter_status)
     
-    tasks = query.order_by(Task.priority.desc(), Task.created_at.desc()).all()
-    return render_template('tasks.html', tasks=tasks, filter_status=filter_status)
+    tasks = StreamedRows(query.order_by(Task.priority.desc(), Task.created_at.desc()))
+    return stream_page('tasks.html', tasks=tasks, filter_status=filter_status)
 
 @app.route('/tasks/add', methods=['GET', 'POST'])
 def add_task():
@@ -422,44 +1705,38 @@ def delete_task(task_id):
 
 @app.route('/statistics')
 def statistics():
-    today = datetime.utcnow().date()
+    today = local_today()
     week_ago = today - timedelta(days=6)
     
+    # 日付の列でまとめて集計（1日ごとのクエリにしない）
+    pomodoro_by_day = {day: (sessions, minutes) for day, sessions, minutes in db.session.query(
+        PomodoroSession.local_date, db.func.count(PomodoroSession.id), db.func.sum(PomodoroSession.duration)
+    ).filter(
+        PomodoroSession.local_date >= week_ago,
+        PomodoroSession.local_date <= today,
+        PomodoroSession.completed == True,
+        PomodoroSession.session_type == 'work'
+    ).group_by(PomodoroSession.local_date)}
+    tasks_by_day = dict(db.session.query(Task.completed_local_date, db.func.count(Task.id)).filter(
+        Task.status == 'completed',
+        Task.completed_local_date >= week_ago,
+        Task.completed_local_date <= today
+    ).group_by(Task.completed_local_date).all())
+    
     daily_stats = []
     for i in range(7):
         day = week_ago + timedelta(days=i)
-        day_start = datetime.combine(day, datetime.min.time())
-        day_end = datetime.combine(day, datetime.max.time())
-        
-        sessions = PomodoroSession.query.filter(
-            PomodoroSession.started_at >= day_start,
-            PomodoroSession.started_at <= day_end,
-            PomodoroSession.completed == True,
-            PomodoroSession.session_type == 'work'
-        ).count()
-        
-        minutes = PomodoroSession.query.filter(
-            PomodoroSession.started_at >= day_start,
-            PomodoroSession.started_at <= day_end,
-            PomodoroSession.completed == True,
-            PomodoroSession.session_type == 'work'
-        ).with_entities(db.func.sum(PomodoroSession.duration)).scalar() or 0
-        
-        tasks_completed = Task.query.filter(
-            Task.status == 'completed',
-            Task.completed_at >= day_start,
-            Task.completed_at <= day_end
-        ).count()
-        
+        sessions, minutes = pomodoro_by_day.get(day, (0, 0))
         daily_stats.append({
             'date': day,
             'sessions': sessions,
-            'minutes': minutes,
-            'tasks': tasks_completed
+            'minutes': minutes or 0,
+            'tasks': tasks_by_day.get(day, 0)
         })
     
-    total_sessions = PomodoroSession.query.filter_by(completed=True, session_type='work').count()
-    total_minutes = PomodoroSession.query.filter_by(completed=True, session_type='work').with_entities(db.func.sum(PomodoroSession.duration)).scalar() or 0
+    archived_sessions, archived_minutes = rollup_totals('pomodoro_session')
+    total_sessions = PomodoroSession.query.filter_by(completed=True, session_type='work').count() + archived_sessions
+    total_minutes = (PomodoroSession.query.filter_by(completed=True, session_type='work').with_entities(db.func.sum(PomodoroSession.duration)).scalar() or 0) + int(archived_minutes)
     total_tasks = Task.query.filter_by(status='completed').count()
     
     return render_template('statistics.html',
@@ -480,42 +1757,241 @@ def settings():
             request.form.get('break_duration', 5), min_val=1, max_val=30, default=5)
         settings.pomodoro_long_break_duration = validate_integer(
             request.form.get('long_break_duration', 15), min_val=5, max_val=60, default=15)
+        settings.work_day_start_hour = validate_integer(
+            request.form.get('work_day_start_hour', 9), min_val=0, max_val=23, default=9)
+        settings.work_day_end_hour = validate_integer(
+            request.form.get('work_day_end_hour', 18), min_val=settings.work_day_start_hour + 1, max_val=24, default=24)
+        timezone_name = request.form.get('timezone', settings.timezone)
+        timezone_changed = timezone_name in timezone_choices() and timezone_name != settings.timezone
+        if timezone_changed:
+            settings.timezone = timezone_name
+            g.pop('timezones', None)
         
         db.session.commit()
+        if timezone_changed:
+            # 保存済みの記録の日付を新しいタイムゾーンで付け直す
+            job = job_runner.submit('recompute_local_dates')
+            flash('設定が保存されました。記録の日付をタイムゾーンに合わせて再計算しています', 'success')
+            return redirect(url_for('jobs', highlight=job.id))
         flash('設定が保存されました！', 'success')
         return redirect(url_for('settings'))
     
-    return render_template('settings.html', settings=settings)
+    return render_template('settings.html', settings=settings, timezones=timezone_choices())
 
 # Habits
-@app.route('/habits')
-def habits():
-    today = datetime.utcnow().date()
-    all_habits = Habit.query.all()
-    
-    habits_data = []
-    for habit in all_habits:
-        today_log = HabitLog.query.filter_by(habit_id=habit.id, date=today).first()
-        
-        streak = 0
-        check_date = today
-        while True:
-            log = HabitLog.query.filter_by(habit_id=habit.id, date=check_date, completed=True).first()
-            if log:
-                streak += 1
-                check_date = check_date - timedelta(days=1)
-            else:
-                break
-        
-        habits_data.append({
-            'habit': habit,
-            'completed_today': today_log is not None,
-            'streak': streak
-        })
-    
-    return render_template('habits.html', habits_data=habits_data, today=today)
+# 習慣の達成記録ビットマップ（1年=366ビット、bit i = その年の i+1 日目）
+def day_bit(day):
+    return day.timetuple().tm_yday - 1
 
-@app.route('/habits/add', methods=['GET', 'POST'])
+def days_in_year(year):
+    return 366 if calendar.isleap(year) else 365
+
+def set_habit_bit(connection, habit_id, day, completed):
+    """HabitLogの変更と同じトランザクションでビットマップを更新"""
+    table = HabitBitmap.__table__
+    row = connection.execute(db.select(table.c.id, table.c.bits).where(
+        table.c.habit_id == habit_id, table.c.year == day.year)).first()
+    if row is None and not completed:
+        return
+    bits = int.from_bytes(row.bits, 'little') if row else 0
+    bits = bits | (1 << day_bit(day)) if completed else bits & ~(1 << day_bit(day))
+    data = bits.to_bytes(HABIT_BITMAP_BYTES, 'little')
+    if row:
+        connection.execute(table.update().where(table.c.id == row.id).values(bits=data))
+    else:
+        connection.execute(table.insert().values(habit_id=habit_id, year=day.year, bits=data))
+
+@event.listens_for(HabitLog, 'after_insert')
+def habit_log_inserted(mapper, connection, target):
+    if target.completed is not False and target.date:
+        set_habit_bit(connection, target.habit_id, target.date, True)
+
+@event.listens_for(HabitLog, 'after_delete')
+def habit_log_deleted(mapper, connection, target):
+    if target.date:
+        set_habit_bit(connection, target.habit_id, target.date, False)
+
+@event.listens_for(HabitLog, 'after_update')
+def habit_log_updated(mapper, connection, target):
+    state = db.inspect(target)
+    old_dates = state.attrs.date.history.deleted
+    for old_date in old_dates:
+        if old_date:
+            set_habit_bit(connection, target.habit_id, old_date, False)
+    if target.date:
+        set_habit_bit(connection, target.habit_id, target.date, target.completed is not False)
+
+def rebuild_habit_bitmaps():
+    """HabitLogからすべてのビットマップを作り直す（既存データの移行用）"""
+    bitmaps = {}
+    for habit_id, day in db.session.query(HabitLog.habit_id, HabitLog.date).filter(
+            HabitLog.completed == True, HabitLog.date.isnot(None)):
+        key = (habit_id, day.year)
+        bitmaps[key] = bitmaps.get(key, 0) | (1 << day_bit(day))
+    HabitBitmap.query.delete()
+    db.session.bulk_insert_mappings(HabitBitmap, [
+        {'habit_id': habit_id, 'year': year, 'bits': bits.to_bytes(HABIT_BITMAP_BYTES, 'little')}
+        for (habit_id, year), bits in bitmaps.items()
+    ])
+    db.session.commit()
+    return len(bitmaps)
+
+@app.cli.command('rebuild-habit-bitmaps')
+def rebuild_habit_bitmaps_command():
+    """習慣の達成記録ビットマップをHabitLogから作り直す"""
+    click.echo(f'{rebuild_habit_bitmaps()}件のビットマップを作成しました')
+
+def load_habit_bitmaps(habit_ids, first_year, last_year, connection=None):
+    """{(habit_id, year): int} を1クエリで読み込む（行がない年は0）"""
+    if not habit_ids:
+        return {}
+    rows = (connection or db.session).execute(db.select(HabitBitmap.habit_id, HabitBitmap.year, HabitBitmap.bits).where(
+        HabitBitmap.habit_id.in_(habit_ids), HabitBitmap.year >= first_year, HabitBitmap.year <= last_year))
+    return {(habit_id, year): int.from_bytes(bits, 'little') for habit_id, year, bits in rows}
+
+def habit_timeline(bitmaps, habit_id, first_year, last_year):
+    """複数年のビットマップを1つの整数につなげる（bit 0 = first_year の1月1日）"""
+    timeline, offset = 0, 0
+    for year in range(first_year, last_year + 1):
+        timeline |= bitmaps.get((habit_id, year), 0) << offset
+        offset += days_in_year(year)
+    return timeline
+
+def habit_schedule_mask(habit, origin, length):
+    """予定日のビットマスク。daily=毎日、custom=指定した曜日（0=月〜6=日）"""
+    if habit.frequency != 'custom':
+        return (1 << length) - 1
+    weekdays = {int(d) for d in (habit.days_of_week or '').split(',') if d.strip().isdigit()} or set(range(7))
+    # originの曜日から始まる1週間分のパターンを繰り返す
+    week = sum(1 << i for i in range(7) if (origin.weekday() + i) % 7 in weekdays)
+    mask = 0
+    for start in range(0, length, 7):
+        mask |= week << start
+    return mask & ((1 << length) - 1)
+
+def bit_range(bits, start, end):
+    """[start, end) のビットを取り出す（startが負なら0から）"""
+    start = max(start, 0)
+    return (bits >> start) & ((1 << max(end - start, 0)) - 1)
+
+def habit_streak(habit, timeline, origin, today):
+    """今日から遡った連続達成数と、originまで途切れずに届いたかを返す
+
+    今日（weeklyなら今週）がまだ未達成でも途切れたとはみなさない
+    """
+    t = (today - origin).days
+    if habit.frequency == 'weekly':
+        week_start = t - today.weekday()
+        streak = 0
+        for start in range(week_start, -7, -7):
+            if bit_range(timeline, start, start + 7):
+                streak += 1
+            elif start != week_start:
+                return streak, False
+        return streak, True
+    
+    scheduled = habit_schedule_mask(habit, origin, t + 1)
+    if not (timeline >> t) & 1:
+        scheduled &= ~(1 << t)
+    missed = scheduled & ~timeline
+    first = missed.bit_length()  # 最後に達成できなかった予定日の次の日
+    return (scheduled & timeline & ~((1 << first) - 1)).bit_count(), missed == 0
+
+def habit_current_streak(habit, bitmaps, first_year, today, connection=None):
+    """連続記録を計算し、読み込んだ年の初日まで続いていればさらに前の年を読み込む"""
+    year = first_year
+    while True:
+        origin = date(year, 1, 1)
+        timeline = habit_timeline(bitmaps, habit.id, year, today.year)
+        streak, reached_origin = habit_streak(habit, timeline, origin, today)
+        if not (reached_origin and streak and habit.created_at and origin > habit.created_at.date()):
+            return streak
+        year -= 1
+        bitmaps.update(load_habit_bitmaps([habit.id], year, year, connection))
+
+def longest_run(bits):
+    """連続した1の最大長"""
+    run = 0
+    while bits:
+        bits &= bits >> 1
+        run += 1
+    return run
+
+def habit_year_stats(habit, bits, year, today):
+    """1年分の達成数・達成率・最長連続日数"""
+    origin = date(year, 1, 1)
+    length = days_in_year(year)
+    if year > today.year:
+        elapsed = 0
+    elif year == today.year:
+        elapsed = (today - origin).days + 1
+    else:
+        elapsed = length
+    elapsed_mask = (1 << elapsed) - 1
+    completed = (bits & elapsed_mask).bit_count()
+    
+    if habit.frequency == 'weekly':
+        # 1月1日が月曜日でなければ、最初の月曜日までの端数の週も1週として数える
+        first_monday = (7 - origin.weekday()) % 7
+        first_week = first_monday - 7 if first_monday else 0
+        weeks = [bit_range(bits, start, min(start + 7, elapsed)) for start in range(first_week, elapsed, 7)]
+        possible = len(weeks)
+        achieved = sum(1 for week in weeks if week)
+    else:
+        scheduled = habit_schedule_mask(habit, origin, length) & elapsed_mask
+        possible = scheduled.bit_count()
+        achieved = (bits & scheduled).bit_count()
+    
+    return {
+        'completed_days': completed,
+        'completion_rate': round(achieved / possible * 100, 1) if possible else 0,
+        'longest_streak_days': longest_run(bits),
+    }
+
+@app.route('/habits')
+def habits():
+    today = local_today()
+    all_habits = Habit.query.all()
+    
+    # 去年と今年のビットマップだけで今日の状態と連続記録を計算（長い記録は必要な分だけ遡る）
+    first_year = today.year - 1
+    bitmaps = load_habit_bitmaps([habit.id for habit in all_habits], first_year, today.year)
+    
+    habits_data = []
+    for habit in all_habits:
+        habits_data.append({
+            'habit': habit,
+            'completed_today': bool((bitmaps.get((habit.id, today.year), 0) >> day_bit(today)) & 1),
+            'streak': habit_current_streak(habit, bitmaps, first_year, today),
+            'streak_unit': '週' if habit.frequency == 'weekly' else '日'
+        })
+    
+    return render_template('habits.html', habits_data=habits_data, today=today)
+
+@app.route('/api/habits/<int:habit_id>/heatmap')
+def habit_heatmap(habit_id):
+    """1年分の達成状況（GitHub風ヒートマップ用）をビットマップから返す"""
+    habit = Habit.query.get_or_404(habit_id)
+    today = local_today()
+    year = validate_integer(request.args.get('year', today.year), min_val=1970, max_val=9999, default=today.year)
+    
+    bitmaps = load_habit_bitmaps([habit.id], year - 1, year)
+    bits = bitmaps.get((habit.id, year), 0)
+    length = days_in_year(year)
+    stats = habit_year_stats(habit, bits, year, today)
+    if year == today.year:
+        stats['current_streak'] = habit_current_streak(habit, bitmaps, year - 1, today)
+    
+    return jsonify({
+        'habit_id': habit.id,
+        'year': year,
+        'frequency': habit.frequency,
+        'start': date(year, 1, 1).isoformat(),
+        'days': format(bits, f'0{length}b')[::-1],  # i文字目 = i+1日目（'1'=達成）
+        **stats
+    })
+
+@app.route('/habits/add', methods=['GET', 'POST'])
 def add_habit():
     if request.method == 'POST':
         # 入力値のサニタイズ
@@ -523,6 +1999,8 @@ def add_habit():
         description = sanitize_input(request.form.get('description'), max_length=500)
         frequency = request.form.get('frequency', 'daily')
         color = request.form.get('color', 'primary')
+        days_of_week = ','.join(sorted({d for d in request.form.getlist('days_of_week')
+                                        if d in ('0', '1', '2', '3', '4', '5', '6')})) or None
         
         # 頻度の検証
         if frequency not in ['daily', 'weekly', 'custom']:
@@ -536,7 +2014,8 @@ def add_habit():
             flash('習慣名を入力してください', 'error')
             return redirect(url_for('add_habit'))
         
-        habit = Habit(name=name, description=description, frequency=frequency, color=color)
+        habit = Habit(name=name, description=description, frequency=frequency, color=color,
+                      days_of_week=days_of_week if frequency == 'custom' else None)
         db.session.add(habit)
         db.session.commit()
         
@@ -548,7 +2027,7 @@ def add_habit():
 @app.route('/habits/<int:habit_id>/toggle', methods=['POST'])
 def toggle_habit(habit_id):
     habit = Habit.query.get_or_404(habit_id)
-    today = datetime.utcnow().date()
+    today = to_local_date(request_time())
     log = HabitLog.query.filter_by(habit_id=habit_id, date=today).first()
     
     if log:
@@ -577,43 +2056,299 @@ def health():
 @app.route('/health/add', methods=['GET', 'POST'])
 def add_health_log():
     if request.method == 'POST':
-        date_str = request.form.get('date')
-        date = datetime.strptime(date_str, '%Y-%m-%d').date() if date_str else datetime.utcnow().date()
-        
-        existing_log = HealthLog.query.filter_by(date=date).first()
+        parsed = validate_date(request.form.get('date'))
+        day = parsed.date() if parsed else local_today()
         
-        if existing_log:
-            log = existing_log
-        else:
-            log = HealthLog(date=date)
-        
-        weight = request.form.get('weight')
-        if weight:
-            log.weight = float(weight)
-        
-        exercise_minutes = request.form.get('exercise_minutes')
-        if exercise_minutes:
-            log.exercise_minutes = int(exercise_minutes)
-        
-        water_intake = request.form.get('water_intake')
-        if water_intake:
-            log.water_intake = int(water_intake)
-        
-        sleep_hours = request.form.get('sleep_hours')
-        if sleep_hours:
-            log.sleep_hours = float(sleep_hours)
-        
-        log.mood = request.form.get('mood')
-        log.note = request.form.get('note')
+        # 入力された項目だけを上書きする（空欄の項目はその日の既存の値を残す）
+        values = {}
+        for field, (minimum, maximum, label) in HEALTH_FIELD_RANGES.items():
+            raw = (request.form.get(field) or '').strip()
+            if not raw:
+                continue
+            value = validate_float(raw, min_val=minimum, max_val=maximum)
+            if value is None:
+                flash(f'{label}は{minimum}〜{maximum}の数値で入力してください', 'error')
+                return redirect(url_for('add_health_log'))
+            values[field] = int(round(value)) if field in HEALTH_INTEGER_FIELDS else value
+        values['mood'] = request.form.get('mood') or None
+        values['note'] = request.form.get('note') or None
         
-        if not existing_log:
-            db.session.add(log)
+        upsert_health_days(db.session.connection(), [(day, values)])
         db.session.commit()
         
         flash('健康記録が保存されました！', 'success')
         return redirect(url_for('health'))
     
-    return render_template('add_health_log.html')
+    return render_template('add_health_log.html', today=local_today())
+
+# Health Import
+# ヘルスケアアプリの書き出し（Apple Healthの export.xml / export.zip、CSV）を先頭から逐次読み込み、
+# サンプルを日ごとの値にまとめてから、日付をキーにしたUPSERTで数百日ずつ保存する
+HEALTH_FIELD_RANGES = {  # 項目: (最小, 最大, 表示名)
+    'weight': (1, 500, '体重'),
+    'exercise_minutes': (0, 1440, '運動時間'),
+    'water_intake': (0, 20000, '水分摂取量'),
+    'sleep_hours': (0, 24, '睡眠時間'),
+}
+HEALTH_INTEGER_FIELDS = {'exercise_minutes', 'water_intake'}
+HEALTH_IMPORT_BATCH_DAYS = 500
+HEALTH_IMPORT_CHUNK_BYTES = 1 << 20
+HEALTH_IMPORT_PROGRESS_STEP = 2  # 進捗はこの%ごとに保存する
+HEALTH_IMPORT_EXTENSIONS = ('.xml', '.zip', '.csv')
+APPLE_HEALTH_WEIGHT_UNITS = {'kg': 1.0, 'lb': 0.45359237, 'g': 0.001}
+APPLE_HEALTH_WATER_UNITS = {'mL': 1.0, 'L': 1000.0, 'fl_oz_us': 29.5735295625}
+APPLE_HEALTH_MINUTE_UNITS = {'min': 1.0, 's': 1 / 60, 'hr': 60.0}
+APPLE_HEALTH_ASLEEP = 'HKCategoryValueSleepAnalysisAsleep'  # AsleepCore・AsleepDeep などを含む（InBedは除く）
+APPLE_HEALTH_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S %z'
+# CSVの見出し（小文字にして比較）→ 項目
+HEALTH_CSV_COLUMNS = {
+    'date': 'date', '日付': 'date', 'day': 'date', 'startdate': 'date', 'start_date': 'date',
+    'weight': 'weight', '体重': 'weight', 'weight_kg': 'weight', 'body_mass': 'weight',
+    'exercise_minutes': 'exercise_minutes', '運動時間': 'exercise_minutes', 'exercise': 'exercise_minutes',
+    'active_minutes': 'exercise_minutes',
+    'water_intake': 'water_intake', '水分摂取量': 'water_intake', 'water': 'water_intake', 'water_ml': 'water_intake',
+    'sleep_hours': 'sleep_hours', '睡眠時間': 'sleep_hours', 'sleep': 'sleep_hours',
+}
+
+class HealthAggregator:
+    """サンプルを日ごとの値にまとめる。保持するのは日数分だけなので、ファイルの大きさによらない
+    
+    体重はその日の最後の測定、運動・水分は合計、睡眠は記録元（端末）ごとの合計のうち最大
+    （iPhoneとApple Watchの両方が記録していても二重に数えない）
+    """
+    
+    def __init__(self):
+        self.weight = {}  # 日付の文字列 → (測定日時の文字列, kg)
+        self.exercise = {}
+        self.workout = {}  # 運動時間の記録がない日だけ、ワークアウトの時間を使う
+        self.water = {}
+        self.sleep = {}  # 日付の文字列 → {記録元: 時間}
+        self.samples = 0
+        self.skipped = 0
+    
+    def add_weight(self, day, at, kg):
+        if day not in self.weight or at >= self.weight[day][0]:
+            self.weight[day] = (at, kg)
+    
+    @staticmethod
+    def add_to(totals, day, amount):
+        totals[day] = totals.get(day, 0) + amount
+    
+    def add_sleep(self, day, source, hours):
+        sources = self.sleep.setdefault(day, {})
+        sources[source] = sources.get(source, 0) + hours
+    
+    def days(self):
+        """[(date, {項目: 値})] を日付順に返す（日付として読めない日は除く）"""
+        keys = set(self.weight) | set(self.exercise) | set(self.workout) | set(self.water) | set(self.sleep)
+        result = []
+        for key in sorted(keys):
+            day = validate_date(key)
+            if day is None:
+                self.skipped += 1
+                continue
+            values = {}
+            if key in self.weight:
+                values['weight'] = round(self.weight[key][1], 1)
+            minutes = self.exercise.get(key, self.workout.get(key))
+            if minutes is not None:
+                values['exercise_minutes'] = min(int(round(minutes)), 1440)
+            if key in self.water:
+                values['water_intake'] = int(round(self.water[key]))
+            if key in self.sleep:
+                values['sleep_hours'] = round(min(max(self.sleep[key].values()), 24), 2)
+            result.append((day.date(), values))
+        return result
+
+class AppleHealthTarget:
+    """expatのパーサーのターゲット。<Record> と <Workout> の属性だけを読み、要素の木は作らない"""
+    
+    def __init__(self, aggregator):
+        self.aggregator = aggregator
+        self.records = {
+            'HKQuantityTypeIdentifierBodyMass': self.body_mass,
+            'HKQuantityTypeIdentifierAppleExerciseTime': self.exercise_time,
+            'HKQuantityTypeIdentifierDietaryWater': self.water,
+            'HKCategoryTypeIdentifierSleepAnalysis': self.sleep,
+        }
+    
+    def start(self, tag, attrib):
+        if tag == 'Record':
+            handler = self.records.get(attrib.get('type'))
+        elif tag == 'Workout':
+            handler = self.workout
+        else:
+            return
+        if handler is None:
+            return
+        try:
+            handler(attrib)
+        except (KeyError, ValueError, TypeError):
+            self.aggregator.skipped += 1
+        else:
+            self.aggregator.samples += 1
+    
+    def close(self):
+        return self.aggregator
+    
+    def body_mass(self, attrib):
+        kg = float(attrib['value']) * APPLE_HEALTH_WEIGHT_UNITS[attrib.get('unit', 'kg')]
+        self.aggregator.add_weight(attrib['startDate'][:10], attrib['startDate'], kg)
+    
+    def exercise_time(self, attrib):
+        minutes = float(attrib['value']) * APPLE_HEALTH_MINUTE_UNITS[attrib.get('unit', 'min')]
+        self.aggregator.add_to(self.aggregator.exercise, attrib['startDate'][:10], minutes)
+    
+    def water(self, attrib):
+        ml = float(attrib['value']) * APPLE_HEALTH_WATER_UNITS[attrib.get('unit', 'mL')]
+        self.aggregator.add_to(self.aggregator.water, attrib['startDate'][:10], ml)
+    
+    def sleep(self, attrib):
+        if not attrib.get('value', '').startswith(APPLE_HEALTH_ASLEEP):
+            return
+        started = datetime.strptime(attrib['startDate'], APPLE_HEALTH_DATETIME_FORMAT)
+        ended = datetime.strptime(attrib['endDate'], APPLE_HEALTH_DATETIME_FORMAT)
+        # 起きた日の睡眠として数える
+        self.aggregator.add_sleep(attrib['endDate'][:10], attrib.get('sourceName', ''),
+                                  max((ended - started).total_seconds(), 0) / 3600)
+    
+    def workout(self, attrib):
+        minutes = float(attrib['duration']) * APPLE_HEALTH_MINUTE_UNITS[attrib.get('durationUnit', 'min')]
+        self.aggregator.add_to(self.aggregator.workout, attrib['startDate'][:10], minutes)
+
+def read_apple_health(stream, aggregator, on_progress):
+    parser = ElementTree.XMLParser(target=AppleHealthTarget(aggregator))
+    read = 0
+    while True:
+        chunk = stream.read(HEALTH_IMPORT_CHUNK_BYTES)
+        if not chunk:
+            break
+        parser.feed(chunk)
+        read += len(chunk)
+        on_progress(read)
+    parser.close()
+
+def read_health_csv(stream, aggregator, on_progress):
+    """見出しの行で列を判定し、1行ずつ読む（1日1行のまとめでも、1日に複数行のサンプルでもよい）"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline='')
+    reader = csv.reader(text)
+    header = next(reader, None) or []
+    columns = {HEALTH_CSV_COLUMNS[name.strip().lower()]: index for index, name in enumerate(header)
+               if name.strip().lower() in HEALTH_CSV_COLUMNS}
+    if 'date' not in columns:
+        raise ValueError('CSVに日付の列（date・日付）が見つかりません')
+    date_index = columns.pop('date')
+    for line_number, row in enumerate(reader, 1):
+        if len(row) <= date_index:
+            aggregator.skipped += 1
+            continue
+        day = row[date_index].strip()[:10].replace('/', '-')
+        for field, index in columns.items():
+            if index >= len(row) or not row[index].strip():
+                continue
+            minimum, maximum, _ = HEALTH_FIELD_RANGES[field]
+            value = validate_float(row[index].strip(), min_val=minimum, max_val=maximum)
+            if value is None:
+                aggregator.skipped += 1
+            elif field == 'weight':
+                aggregator.add_weight(day, f'{line_number:012d}', value)  # 同じ日なら後の行
+            elif field == 'sleep_hours':
+                aggregator.add_sleep(day, 'csv', value)
+            else:
+                aggregator.add_to(aggregator.exercise if field == 'exercise_minutes' else aggregator.water, day, value)
+            aggregator.samples += 1
+        if line_number % 10000 == 0:
+            on_progress(stream.tell())
+    text.detach()
+
+def open_health_export(path, filename):
+    """(バイナリのストリーム, 読み込む関数, 全体のバイト数)。zipの中の export.xml は展開しながら読む"""
+    extension = os.path.splitext(filename.lower())[1]
+    if extension == '.zip':
+        archive = zipfile.ZipFile(path)
+        members = [info for info in archive.infolist()
+                   if info.filename.lower().endswith(('export.xml', '.csv')) and not info.is_dir()]
+        if not members:
+            archive.close()
+            raise ValueError('zipの中に export.xml またはCSVが見つかりません')
+        # Apple Healthの書き出しには export_cda.xml も入っているので、export.xml を優先する
+        member = next((info for info in members if info.filename.lower().endswith('/export.xml')
+                       or info.filename.lower() == 'export.xml'), members[0])
+        reader = read_health_csv if member.filename.lower().endswith('.csv') else read_apple_health
+        return archive.open(member), reader, member.file_size
+    return open(path, 'rb'), read_health_csv if extension == '.csv' else read_apple_health, os.path.getsize(path)
+
+def upsert_health_days(connection, days):
+    """[(date, {項目: 値})] を date をキーにUPSERT。値のない項目はその日の既存の値を残す"""
+    table = HealthLog.__table__
+    fields = ('weight', 'exercise_minutes', 'water_intake', 'sleep_hours', 'mood', 'note')
+    statement = sqlite_insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=['date'],
+        set_={field: db.func.coalesce(statement.excluded[field], table.c[field]) for field in fields})
+    connection.execute(statement, [{'date': day, **{field: values.get(field) for field in fields}}
+                                   for day, values in days])
+    record_bulk_upserts(connection, HealthLog, table.c.date.in_([day for day, _ in days]))
+
+def merge_duplicate_health_logs(connection):
+    """同じ日付の行を、項目ごとに新しい行（idが大きい方）の値を優先して1行にまとめる"""
+    table = HealthLog.__table__
+    fields = ('weight', 'exercise_minutes', 'water_intake', 'sleep_hours', 'mood', 'note')
+    duplicates = connection.execute(db.select(table.c.date).where(table.c.date.isnot(None))
+                                     .group_by(table.c.date).having(db.func.count() > 1)).scalars().all()
+    for day in duplicates:
+        rows = connection.execute(db.select(table).where(table.c.date == day).order_by(table.c.id)).all()
+        merged = {field: next((row._mapping[field] for row in reversed(rows) if row._mapping[field] is not None), None)
+                  for field in fields}
+        connection.execute(table.update().where(table.c.id == rows[0].id).values(**merged))
+        connection.execute(table.delete().where(table.c.id.in_([row.id for row in rows[1:]])))
+        record_change(connection, table.name, rows[0].id, 'upsert')
+        for row in rows[1:]:
+            record_change(connection, table.name, row.id, 'delete')
+
+def import_health_export(path, filename, on_progress=None):
+    """書き出しファイルを読み込んで日ごとにまとめ、バッチごとにコミットする。(日数, サンプル数, スキップ数) を返す
+    
+    on_progress(0〜100) は読み込み中とバッチごとに呼ばれる（例外を送出すると中止）
+    """
+    aggregator = HealthAggregator()
+    stream, reader, size = open_health_export(path, filename)
+    reported = [-HEALTH_IMPORT_PROGRESS_STEP]
+    
+    def report(percent):
+        if on_progress and percent - reported[0] >= HEALTH_IMPORT_PROGRESS_STEP:
+            reported[0] = percent
+            on_progress(percent)
+    
+    try:
+        # 読み込みを全体の90%、保存を残りの10%として進捗を出す
+        reader(stream, aggregator, lambda read: report(int(read / size * 90) if size else 0))
+    finally:
+        stream.close()
+    days = aggregator.days()
+    for start in range(0, len(days), HEALTH_IMPORT_BATCH_DAYS):
+        upsert_health_days(db.session.connection(), days[start:start + HEALTH_IMPORT_BATCH_DAYS])
+        db.session.commit()
+        report(90 + int(min(start + HEALTH_IMPORT_BATCH_DAYS, len(days)) / len(days) * 10))
+    return len(days), aggregator.samples, aggregator.skipped
+
+@app.route('/health/import', methods=['POST'])
+def import_health():
+    upload = request.files.get('health_file')
+    if not upload or not upload.filename:
+        flash('取り込むファイルを選択してください', 'error')
+        return redirect(url_for('health'))
+    extension = os.path.splitext(upload.filename.lower())[1]
+    if extension not in HEALTH_IMPORT_EXTENSIONS:
+        flash('Apple Healthの書き出し（.zip / .xml）かCSVファイルを選択してください', 'error')
+        return redirect(url_for('health'))
+    
+    # 数百MBのファイルもあるので、保存してからバックグラウンドで取り込む
+    path = job_artifact_path(extension)
+    upload.save(path)
+    job = job_runner.submit('import_health', path=path, filename=upload.filename)
+    flash('健康データの取り込みを開始しました', 'info')
+    return redirect(url_for('jobs', highlight=job.id))
 
 # Learning
 @app.route('/learning')
@@ -676,8 +2411,8 @@ def update_learning_progress(item_id):
 # Journal
 @app.route('/journal')
 def journal():
-    entries = JournalEntry.query.order_by(JournalEntry.date.desc()).all()
-    return render_template('journal.html', entries=entries)
+    entries = StreamedRows(JournalEntry.query.order_by(JournalEntry.date.desc()))
+    return stream_page('journal.html', entries=entries)
 
 @app.route('/journal/add', methods=['GET', 'POST'])
 def add_journal():
@@ -688,7 +2423,7 @@ def add_journal():
         tags = request.form.get('tags')
         date_str = request.form.get('date')
         
-        date = datetime.strptime(date_str, '%Y-%m-%d').date() if date_str else datetime.utcnow().date()
+        date = datetime.strptime(date_str, '%Y-%m-%d').date() if date_str else local_today()
         
         entry = JournalEntry(title=title, content=content, mood=mood, tags=tags, date=date)
         db.session.add(entry)
@@ -713,23 +2448,267 @@ def delete_journal(entry_id):
     return redirect(url_for('journal'))
 
 # Calendar
-@app.route('/calendar')
-def calendar_view():
-    year = request.args.get('year', datetime.utcnow().year, type=int)
-    month = request.args.get('month', datetime.utcnow().month, type=int)
-    
-    # Get all events for the month
+def month_range(year, month):
+    """指定月の [月初, 翌月初) を返す"""
     month_start = datetime(year, month, 1)
     if month == 12:
         month_end = datetime(year + 1, 1, 1)
     else:
         month_end = datetime(year, month + 1, 1)
+    return month_start, month_end
+
+# 繰り返し予定: 1シリーズ1行で保存し、表示する期間の分だけ展開する
+RECURRENCE_FREQUENCIES = ['daily', 'weekly', 'monthly']
+RECURRENCE_CACHE_SIZE = 1024
+
+RecurrenceRule = namedtuple('RecurrenceRule', 'event_id start freq interval byday until count exdates')
+EventOccurrence = namedtuple('EventOccurrence',
+                             'id title description category start_time end_time location is_recurring')
+
+def recurrence_rule(event):
+    """CalendarEventから展開用のハッシュ可能なルールを作る（内容が変わればキャッシュキーも変わる）"""
+    byday = tuple(sorted({int(d) for d in (event.recurrence_byday or '').split(',') if d.strip().isdigit()
+                          and int(d) < 7}))
+    exdates = frozenset(datetime.strptime(d, '%Y-%m-%d').date()
+                        for d in (event.recurrence_exdates or '').split(',') if d.strip())
+    return RecurrenceRule(event.id, event.start_time, event.recurrence_freq, max(event.recurrence_interval or 1, 1),
+                          byday, event.recurrence_until, event.recurrence_count, exdates)
+
+def _iter_recurrence(rule, window_start):
+    """発生日時を昇順に返す。回数指定がなければ期間の手前まで計算で読み飛ばす"""
+    start, step = rule.start, rule.interval
+    skip = rule.count is None and window_start > start
+    if rule.freq == 'daily':
+        n = ((window_start - start).days // step) * step if skip else 0
+        while True:
+            yield start + timedelta(days=n)
+            n += step
+    elif rule.freq == 'weekly':
+        week0 = start - timedelta(days=start.weekday())
+        weekdays = rule.byday or (start.weekday(),)
+        k = ((window_start - week0).days // 7 // step) * step if skip else 0
+        while True:
+            base = week0 + timedelta(weeks=k)
+            for weekday in weekdays:
+                occurrence = base + timedelta(days=weekday)
+                if occurrence >= start:
+                    yield occurrence
+            k += step
+    elif rule.freq == 'monthly':
+        m = ((((window_start.year - start.year) * 12 + window_start.month - start.month) // step) * step
+             if skip else 0)
+        while True:
+            total = start.month - 1 + m
+            year, month = start.year + total // 12, total % 12 + 1
+            # 31日などその月に存在しない日はスキップ（RFC 5545と同じ扱い）
+            if start.day <= calendar.monthrange(year, month)[1]:
+                yield start.replace(year=year, month=month)
+            m += step
+
+@lru_cache(maxsize=RECURRENCE_CACHE_SIZE)
+def expand_recurrence(rule, window_start, window_end):
+    """[window_start, window_end) に開始する発生日時をタプルで返す"""
+    occurrences = []
+    for index, occurrence in enumerate(_iter_recurrence(rule, window_start)):
+        if occurrence >= window_end or (rule.until and occurrence > rule.until):
+            break
+        if rule.count is not None and index >= rule.count:
+            break
+        if occurrence >= window_start and occurrence.date() not in rule.exdates:
+            occurrences.append(occurrence)
+    return tuple(occurrences)
+
+def recurring_series_in_window(window_start, window_end):
+    return CalendarEvent.query.filter(
+        CalendarEvent.recurrence_freq.isnot(None),
+        CalendarEvent.start_time < window_end,
+        db.or_(CalendarEvent.recurrence_until.is_(None), CalendarEvent.recurrence_until >= window_start)
+    ).all()
+
+def events_in_window(window_start, window_end):
+    """一回限りの予定と繰り返し予定の発生分を開始時刻順に返す"""
+    occurrences = [
+        EventOccurrence(e.id, e.title, e.description, e.category, e.start_time, e.end_time, e.location, False)
+        for e in CalendarEvent.query.filter(
+            CalendarEvent.recurrence_freq.is_(None),
+            CalendarEvent.start_time >= window_start,
+            CalendarEvent.start_time < window_end
+        )
+    ]
+    for series in recurring_series_in_window(window_start, window_end):
+        duration = series.end_time - series.start_time if series.end_time else None
+        for start in expand_recurrence(recurrence_rule(series), window_start, window_end):
+            occurrences.append(EventOccurrence(series.id, series.title, series.description, series.category,
+                                               start, start + duration if duration else None,
+                                               series.location, True))
+    occurrences.sort(key=lambda o: o.start_time)
+    return occurrences
+
+# 空き時間の検索と、やることの自動スケジュール
+DEFAULT_EVENT_MINUTES = 60   # 終了時刻のない予定の長さ
+SCHEDULE_MAX_DAYS = 62
+PRIORITY_RANK = {'high': 0, 'medium': 1, 'low': 2}
+
+class BusyIndex:
+    """予定の区間をマージして開始時刻順に持つ索引。重なり・空き時間の検索は O(log n + k)"""
+    
+    def __init__(self, intervals):
+        self.starts, self.ends = [], []
+        for start, end in sorted(intervals):
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+    
+    def overlaps(self, start, end):
+        """[start, end) と重なる予定ブロックを返す"""
+        i = bisect_right(self.ends, start)
+        blocks = []
+        while i < len(self.starts) and self.starts[i] < end:
+            blocks.append((self.starts[i], self.ends[i]))
+            i += 1
+        return blocks
+    
+    def free_slots(self, start, end, min_duration=timedelta(0)):
+        """[start, end) の中で予定が入っていない区間を返す"""
+        slots = []
+        cursor = start
+        for block_start, block_end in self.overlaps(start, end):
+            if block_start - cursor >= max(min_duration, timedelta(microseconds=1)):
+                slots.append((cursor, block_start))
+            cursor = max(cursor, block_end)
+        if end - cursor >= max(min_duration, timedelta(microseconds=1)):
+            slots.append((cursor, end))
+        return slots
+    
+    def reserve(self, start, end):
+        """区間を予定済みとして追加（隣接・重複するブロックとはマージ）"""
+        lo = bisect_left(self.ends, start)
+        hi = bisect_right(self.starts, end)
+        if lo < hi:
+            start = min(start, self.starts[lo])
+            end = max(end, self.ends[hi - 1])
+        self.starts[lo:hi] = [start]
+        self.ends[lo:hi] = [end]
+
+def working_hours(settings, range_start, range_end):
+    """期間内の各日の作業時間帯 [開始, 終了) を返す"""
+    windows = []
+    day = range_start.date()
+    while day < range_end.date() or (day == range_end.date() and range_end.time() > datetime.min.time()):
+        window_start = max(datetime.combine(day, datetime.min.time()) + timedelta(hours=settings.work_day_start_hour),
+                           range_start)
+        window_end = min(datetime.combine(day, datetime.min.time()) + timedelta(hours=settings.work_day_end_hour),
+                         range_end)
+        if window_start < window_end:
+            windows.append((window_start, window_end))
+        day += timedelta(days=1)
+    return windows
+
+def build_busy_index(range_start, range_end):
+    default_length = timedelta(minutes=DEFAULT_EVENT_MINUTES)
+    return BusyIndex((o.start_time, o.end_time if o.end_time and o.end_time > o.start_time
+                      else o.start_time + default_length)
+                     for o in events_in_window(range_start - timedelta(days=1), range_end))
+
+def find_free_slots(busy, settings, range_start, range_end, min_duration=timedelta(0)):
+    slots = []
+    for window_start, window_end in working_hours(settings, range_start, range_end):
+        slots.extend(busy.free_slots(window_start, window_end, min_duration))
+    return slots
+
+def auto_schedule(busy, settings, range_start, range_end):
+    """未完了のやることを期限・優先度順に、ポモドーロ単位で空き時間へ詰めていく"""
+    pomodoro = timedelta(minutes=settings.pomodoro_work_duration)
+    pending = Task.query.filter(Task.status.in_(['todo', 'in_progress'])).all()
+    pending.sort(key=lambda t: (t.due_date is None, t.due_date or datetime.max,
+                                PRIORITY_RANK.get(t.priority, 1), t.created_at or datetime.min))
+    windows = working_hours(settings, range_start, range_end)
+    
+    proposals, unscheduled = [], []
+    for task in pending:
+        remaining = max((task.estimated_pomodoros or 1) - (task.completed_pomodoros or 0), 0)
+        if remaining == 0:
+            continue
+        for window_start, window_end in windows:
+            if remaining == 0:
+                break
+            for slot_start, slot_end in busy.free_slots(window_start, window_end, pomodoro):
+                count = min(remaining, int((slot_end - slot_start) / pomodoro))
+                block_end = slot_start + pomodoro * count
+                busy.reserve(slot_start, block_end)
+                proposals.append({
+                    'task_id': task.id,
+                    'title': task.title,
+                    'priority': task.priority,
+                    'start': slot_start.isoformat(),
+                    'end': block_end.isoformat(),
+                    'pomodoros': count,
+                    'late': bool(task.due_date and block_end > task.due_date + timedelta(days=1)),
+                })
+                remaining -= count
+                if remaining == 0:
+                    break
+        if remaining:
+            unscheduled.append({'task_id': task.id, 'title': task.title, 'remaining_pomodoros': remaining})
+    
+    proposals.sort(key=lambda p: p['start'])
+    return proposals, unscheduled
+
+def schedule_range():
+    """クエリパラメータ start(YYYY-MM-DD) と days から計画する期間を決める"""
+    now = local_now().replace(second=0, microsecond=0)
+    start_date = validate_date(request.args.get('start'))
+    days = validate_integer(request.args.get('days', 7), min_val=1, max_val=SCHEDULE_MAX_DAYS, default=7)
+    range_start = max(start_date or now, now)
+    range_end = datetime.combine((start_date or now).date(), datetime.min.time()) + timedelta(days=days)
+    return range_start, max(range_end, range_start)
+
+@app.route('/api/schedule/free_slots')
+def free_slots_api():
+    """期間内の空き時間を返す"""
+    settings = get_settings()
+    range_start, range_end = schedule_range()
+    min_minutes = validate_integer(request.args.get('min_minutes', 0), min_val=0, max_val=24 * 60, default=0)
+    busy = build_busy_index(range_start, range_end)
+    slots = find_free_slots(busy, settings, range_start, range_end, timedelta(minutes=min_minutes))
+    return jsonify({
+        'start': range_start.isoformat(),
+        'end': range_end.isoformat(),
+        'free_slots': [{'start': s.isoformat(), 'end': e.isoformat(),
+                        'minutes': int((e - s).total_seconds() // 60)} for s, e in slots]
+    })
+
+@app.route('/api/schedule/auto')
+def auto_schedule_api():
+    """やることを空き時間に割り当てた予定案を返す（保存はしない）"""
+    settings = get_settings()
+    range_start, range_end = schedule_range()
+    busy = build_busy_index(range_start, range_end)
+    proposals, unscheduled = auto_schedule(busy, settings, range_start, range_end)
+    return jsonify({
+        'start': range_start.isoformat(),
+        'end': range_end.isoformat(),
+        'pomodoro_minutes': settings.pomodoro_work_duration,
+        'schedule': proposals,
+        'unscheduled': unscheduled
+    })
+
+@app.route('/calendar')
+def calendar_view():
+    today = local_today()
+    year = request.args.get('year', today.year, type=int)
+    month = request.args.get('month', today.month, type=int)
+    
+    # Get all events for the month
+    month_start, month_end = month_range(year, month)
     
     tasks = Task.query.filter(Task.due_date >= month_start, Task.due_date < month_end).all()
     habits = Habit.query.all()
     health_logs = HealthLog.query.filter(HealthLog.date >= month_start.date(), HealthLog.date < month_end.date()).all()
     journal_entries = JournalEntry.query.filter(JournalEntry.date >= month_start.date(), JournalEntry.date < month_end.date()).all()
-    events = CalendarEvent.query.filter(CalendarEvent.start_time >= month_start, CalendarEvent.start_time < month_end).all()
+    events = events_in_window(month_start, month_end)
     
     return render_template('calendar.html', year=year, month=month, tasks=tasks, habits=habits, 
                          health_logs=health_logs, journal_entries=journal_entries, events=events)
@@ -774,13 +2753,28 @@ def add_calendar_event():
             except ValueError:
                 pass
         
+        # 繰り返し設定の検証
+        recurrence_freq = request.form.get('recurrence_freq')
+        if recurrence_freq not in RECURRENCE_FREQUENCIES:
+            recurrence_freq = None
+        recurrence_interval = validate_integer(request.form.get('recurrence_interval', 1), min_val=1, max_val=99, default=1)
+        recurrence_byday = ','.join(sorted({d for d in request.form.getlist('recurrence_byday')
+                                            if d in ('0', '1', '2', '3', '4', '5', '6')})) or None
+        recurrence_until = validate_date(request.form.get('recurrence_until'))
+        if recurrence_until:
+            recurrence_until = recurrence_until.replace(hour=23, minute=59, second=59)
+        
         event = CalendarEvent(
             title=title,
             description=description,
             category=category,
             start_time=start_datetime,
             end_time=end_datetime,
-            location=location
+            location=location,
+            recurrence_freq=recurrence_freq,
+            recurrence_interval=recurrence_interval if recurrence_freq else None,
+            recurrence_byday=recurrence_byday if recurrence_freq == 'weekly' else None,
+            recurrence_until=recurrence_until if recurrence_freq else None
         )
         db.session.add(event)
         db.session.commit()
@@ -798,16 +2792,377 @@ def delete_calendar_event(event_id):
     flash('予定が削除されました', 'info')
     return redirect(url_for('calendar_view'))
 
-@app.route('/api/check_reminders')
+@app.route('/calendar/event/<int:event_id>/skip', methods=['POST'])
+def skip_calendar_occurrence(event_id):
+    """繰り返し予定のうち指定日の1回分だけを削除（除外日に追加）"""
+    event = CalendarEvent.query.get_or_404(event_id)
+    skip_date = validate_date(request.form.get('date'))
+    if not event.recurrence_freq or not skip_date:
+        flash('削除する日付が正しくありません', 'error')
+        return redirect(url_for('calendar_view'))
+    
+    exdates = {d for d in (event.recurrence_exdates or '').split(',') if d}
+    exdates.add(skip_date.strftime('%Y-%m-%d'))
+    event.recurrence_exdates = ','.join(sorted(exdates))
+    db.session.commit()
+    flash('この日の予定を削除しました', 'info')
+    return redirect(url_for('calendar_view', year=skip_date.year, month=skip_date.month))
+
+# iCalendar (RFC 5545)
+ICS_PRODID = '-//remote-productivity//Life Management App//JA'
+ICS_CHUNK_SIZE = 200         # フィード生成時に1回でyieldするVEVENT数
+ICS_IMPORT_BATCH_SIZE = 500  # インポート時の一括INSERT件数
+ICS_VALID_CATEGORIES = ['work', 'meeting', 'personal', 'health', 'study', 'other']
+ICS_WEEKDAYS = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+
+def ics_escape(text):
+    """TEXT値のエスケープ（HTMLエスケープ済みの値は元に戻してから）"""
+    text = html.unescape(str(text or ''))
+    return (text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+def ics_unescape(text):
+    return re.sub(r'\\([\\;,nN])', lambda m: '\n' if m.group(1) in 'nN' else m.group(1), text)
+
+def ics_fold(line):
+    """75オクテットごとに行を折り返す（マルチバイト文字は分割しない）"""
+    if len(line.encode('utf-8')) <= 75:
+        return line + '\r\n'
+    parts = []
+    current, size = '', 0
+    for ch in line:
+        width = len(ch.encode('utf-8'))
+        if size + width > 75:
+            parts.append(current)
+            current, size = ' ', 1
+        current += ch
+        size += width
+    parts.append(current)
+    return '\r\n'.join(parts) + '\r\n'
+
+def ics_rrule(freq, interval=None, byday=None, until=None, count=None):
+    parts = [f'FREQ={freq.upper()}']
+    if interval and interval > 1:
+        parts.append(f'INTERVAL={interval}')
+    if byday:
+        parts.append('BYDAY=' + ','.join(ICS_WEEKDAYS[int(d)] for d in byday.split(',')))
+    if until:
+        parts.append(f'UNTIL={until.strftime("%Y%m%dT%H%M%S")}')
+    if count:
+        parts.append(f'COUNT={count}')
+    return ';'.join(parts)
+
+def ics_vevent(uid, summary, dtstamp, start, end=None, all_day=False, description=None,
+               location=None, category=None, rrule=None, exdates=None):
+    lines = ['BEGIN:VEVENT', f'UID:{uid}', f'DTSTAMP:{dtstamp}', f'SUMMARY:{ics_escape(summary)}']
+    if all_day:
+        lines.append(f'DTSTART;VALUE=DATE:{start.strftime("%Y%m%d")}')
+        lines.append(f'DTEND;VALUE=DATE:{(start + timedelta(days=1)).strftime("%Y%m%d")}')
+        lines.append('TRANSP:TRANSPARENT')
+    else:
+        # 予定は入力されたローカル時刻のまま保存しているのでフローティング時刻で出力
+        lines.append(f'DTSTART:{start.strftime("%Y%m%dT%H%M%S")}')
+        if end:
+            lines.append(f'DTEND:{end.strftime("%Y%m%dT%H%M%S")}')
+        if rrule:
+            lines.append(f'RRULE:{rrule}')
+        if exdates:
+            lines.append('EXDATE:' + ','.join(
+                datetime.strptime(d, '%Y-%m-%d').strftime('%Y%m%d') + start.strftime('T%H%M%S')
+                for d in exdates.split(',') if d))
+    if description:
+        lines.append(f'DESCRIPTION:{ics_escape(description)}')
+    if location:
+        lines.append(f'LOCATION:{ics_escape(location)}')
+    if category:
+        lines.append(f'CATEGORIES:{ics_escape(category.upper())}')
+    lines.append('END:VEVENT')
+    return ''.join(ics_fold(line) for line in lines)
+
+def generate_ics(dtstamp, window=None):
+    """予定・やることの期限・目標の期限をVCALENDARとして少しずつ返す"""
+    yield ('BEGIN:VCALENDAR\r\nVERSION:2.0\r\n' + ics_fold(f'PRODID:{ICS_PRODID}') +
+           'CALSCALE:GREGORIAN\r\nMETHOD:PUBLISH\r\n' + ics_fold('X-WR-CALNAME:生産性アップ'))
+    
+    events = CalendarEvent.query.with_entities(
+        CalendarEvent.id, CalendarEvent.uid, CalendarEvent.title, CalendarEvent.description,
+        CalendarEvent.category, CalendarEvent.start_time, CalendarEvent.end_time, CalendarEvent.location,
+        CalendarEvent.recurrence_freq, CalendarEvent.recurrence_interval, CalendarEvent.recurrence_byday,
+        CalendarEvent.recurrence_until, CalendarEvent.recurrence_count, CalendarEvent.recurrence_exdates)
+    tasks = Task.query.with_entities(Task.id, Task.title, Task.description, Task.due_date).filter(
+        Task.due_date.isnot(None))
+    goals = Goal.query.with_entities(Goal.id, Goal.title, Goal.description, Goal.target_date).filter(
+        Goal.target_date.isnot(None))
+    if window:
+        # 繰り返し予定は期間内に発生があればシリーズごと出力
+        events = events.filter(db.or_(
+            db.and_(CalendarEvent.recurrence_freq.is_(None),
+                    CalendarEvent.start_time >= window[0], CalendarEvent.start_time < window[1]),
+            db.and_(CalendarEvent.recurrence_freq.isnot(None), CalendarEvent.start_time < window[1],
+                    db.or_(CalendarEvent.recurrence_until.is_(None), CalendarEvent.recurrence_until >= window[0]))))
+        tasks = tasks.filter(Task.due_date >= window[0], Task.due_date < window[1])
+        goals = goals.filter(Goal.target_date >= window[0], Goal.target_date < window[1])
+    
+    def vevents():
+        for e in events.order_by(CalendarEvent.id).yield_per(ICS_CHUNK_SIZE):
+            yield ics_vevent(e.uid or f'event-{e.id}@remote-productivity', e.title, dtstamp, e.start_time,
+                             end=e.end_time, description=e.description, location=e.location, category=e.category,
+                             rrule=ics_rrule(e.recurrence_freq, e.recurrence_interval, e.recurrence_byday,
+                                             e.recurrence_until, e.recurrence_count) if e.recurrence_freq else None,
+                             exdates=e.recurrence_exdates)
+        for t in tasks.order_by(Task.id).yield_per(ICS_CHUNK_SIZE):
+            yield ics_vevent(f'task-{t.id}@remote-productivity', f'やること: {html.unescape(t.title)}', dtstamp,
+                             t.due_date.date(), all_day=True, description=t.description)
+        for g in goals.order_by(Goal.id).yield_per(ICS_CHUNK_SIZE):
+            yield ics_vevent(f'goal-{g.id}@remote-productivity', f'目標: {html.unescape(g.title)}', dtstamp,
+                             g.target_date.date(), all_day=True, description=g.description)
+    
+    chunk = []
+    for vevent in vevents():
+        chunk.append(vevent)
+        if len(chunk) >= ICS_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append('END:VCALENDAR\r\n')
+    yield ''.join(chunk)
+
+def iter_ics_lines(stream):
+    """折り返し行を連結しながら1行ずつ返す"""
+    pending = None
+    for raw in stream:
+        line = raw.rstrip('\r\n')
+        if line[:1] in (' ', '\t'):
+            if pending is not None:
+                pending += line[1:]
+            continue
+        if pending:
+            yield pending
+        pending = line
+    if pending:
+        yield pending
+
+def parse_ics_line(line):
+    """'NAME;PARAM=VALUE:値' を (NAME, {PARAM: VALUE}, 値) に分解"""
+    in_quotes = False
+    for i, ch in enumerate(line):
+        if ch == '"':
+            in_quotes = not in_quotes
+        elif ch == ':' and not in_quotes:
+            head, value = line[:i], line[i + 1:]
+            break
+    else:
+        return None, {}, ''
+    name, *raw_params = head.split(';')
+    params = {}
+    for raw_param in raw_params:
+        key, _, param_value = raw_param.partition('=')
+        params[key.upper()] = param_value.strip('"')
+    return name.upper(), params, value
+
+def iter_ics_events(stream):
+    """VEVENTごとにプロパティ辞書を返す（VALARMなど入れ子のコンポーネントは無視）"""
+    current = None
+    nested = 0
+    for line in iter_ics_lines(stream):
+        name, params, value = parse_ics_line(line)
+        if name == 'BEGIN':
+            if current is not None:
+                nested += 1
+            elif value.upper() == 'VEVENT':
+                current = {}
+        elif name == 'END':
+            if nested:
+                nested -= 1
+            elif current is not None and value.upper() == 'VEVENT':
+                yield current
+                current = None
+        elif current is not None and not nested and name == 'EXDATE' and name in current:
+            current[name] = (params, current[name][1] + ',' + value)
+        elif current is not None and not nested and name and name not in current:
+            current[name] = (params, value)
+
+def parse_ics_datetime(params, value):
+    """DTSTART/DTENDを設定のタイムゾーンでのnaiveなdatetimeに変換"""
+    value = value.strip()
+    try:
+        if params.get('VALUE') == 'DATE' or len(value) == 8:
+            return datetime.strptime(value[:8], '%Y%m%d')
+        parsed = datetime.strptime(value[:15], '%Y%m%dT%H%M%S')
+    except ValueError:
+        return None
+    if value.endswith('Z'):
+        return parsed.replace(tzinfo=timezone.utc).astimezone(current_timezone()).replace(tzinfo=None)
+    if 'TZID' in params:
+        try:
+            return parsed.replace(tzinfo=ZoneInfo(params['TZID'])).astimezone(current_timezone()).replace(tzinfo=None)
+        except (ZoneInfoNotFoundError, ValueError):
+            pass
+    return parsed
+
+def parse_ics_duration(value):
+    match = re.fullmatch(r'P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?', value.strip())
+    if not match:
+        return None
+    weeks, days, hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds)
+
+def parse_ics_rrule(value):
+    """対応しているRRULE（DAILY/WEEKLY/MONTHLY）を CalendarEvent の繰り返しカラムに変換"""
+    parts = dict(part.partition('=')[::2] for part in value.upper().split(';') if part)
+    freq = parts.get('FREQ', '').lower()
+    if freq not in RECURRENCE_FREQUENCIES:
+        return {}
+    rule = {'recurrence_freq': freq,
+            'recurrence_interval': validate_integer(parts.get('INTERVAL', 1), min_val=1, max_val=99, default=1)}
+    if 'COUNT' in parts:
+        rule['recurrence_count'] = validate_integer(parts['COUNT'], min_val=1, default=None)
+    if 'UNTIL' in parts:
+        rule['recurrence_until'] = parse_ics_datetime({}, parts['UNTIL'])
+    if freq == 'weekly' and 'BYDAY' in parts:
+        weekdays = {ICS_WEEKDAYS.index(d[-2:]) for d in parts['BYDAY'].split(',') if d[-2:] in ICS_WEEKDAYS}
+        rule['recurrence_byday'] = ','.join(str(d) for d in sorted(weekdays)) or None
+    elif freq == 'monthly' and ('BYDAY' in parts or 'BYMONTHDAY' in parts):
+        # 「第2火曜日」などは未対応なので開始日と同じ日付の繰り返しにしない
+        return {}
+    return rule
+
+def ics_event_to_mapping(props):
+    if 'DTSTART' not in props:
+        return None
+    start = parse_ics_datetime(*props['DTSTART'])
+    if start is None:
+        return None
+    end = None
+    if 'DTEND' in props:
+        end = parse_ics_datetime(*props['DTEND'])
+    elif 'DURATION' in props:
+        duration = parse_ics_duration(props['DURATION'][1])
+        end = start + duration if duration else None
+    if end is not None and end < start:
+        end = None
+    
+    title = ics_unescape(props.get('SUMMARY', ({}, ''))[1]).strip() or '(無題)'
+    category = ics_unescape(props.get('CATEGORIES', ({}, ''))[1]).split(',')[0].strip().lower()
+    if category not in ICS_VALID_CATEGORIES:
+        category = 'other'
+    description = ics_unescape(props['DESCRIPTION'][1]) if 'DESCRIPTION' in props else None
+    location = ics_unescape(props['LOCATION'][1]) if 'LOCATION' in props else None
+    
+    recurrence = parse_ics_rrule(props['RRULE'][1]) if 'RRULE' in props else {}
+    exdates = None
+    if recurrence and 'EXDATE' in props:
+        params, value = props['EXDATE']
+        parsed = (parse_ics_datetime(params, v) for v in value.split(','))
+        exdates = ','.join(sorted({d.strftime('%Y-%m-%d') for d in parsed if d})) or None
+    
+    return {
+        'uid': props['UID'][1][:255] if 'UID' in props else None,
+        'title': str(sanitize_input(title, max_length=200)),
+        'description': str(sanitize_input(description, max_length=1000)) if description else None,
+        'category': category,
+        'start_time': start,
+        'end_time': end,
+        'location': str(sanitize_input(location, max_length=200)) if location else None,
+        'reminder_sent': start < local_now(),
+        'recurrence_freq': recurrence.get('recurrence_freq'),
+        'recurrence_interval': recurrence.get('recurrence_interval'),
+        'recurrence_byday': recurrence.get('recurrence_byday'),
+        'recurrence_until': recurrence.get('recurrence_until'),
+        'recurrence_count': recurrence.get('recurrence_count'),
+        'recurrence_exdates': exdates,
+        'created_at': datetime.utcnow(),
+    }
+
+def import_ics(stream, on_batch=None):
+    """iCalendarを逐次読み込みしてまとめてINSERT。(追加件数, スキップ件数) を返す
+
+    on_batch はバッチごとに呼ばれる（例外を送出すると呼び出し元でロールバックされる）
+    """
+    last_id = db.session.query(db.func.max(CalendarEvent.id)).scalar() or 0
+    known_uids = {uid for (uid,) in db.session.query(CalendarEvent.uid).filter(CalendarEvent.uid.isnot(None))}
+    imported = skipped = 0
+    batch = []
+    for props in iter_ics_events(stream):
+        mapping = ics_event_to_mapping(props)
+        if mapping is None or (mapping['uid'] and mapping['uid'] in known_uids):
+            skipped += 1
+            continue
+        if mapping['uid']:
+            known_uids.add(mapping['uid'])
+        batch.append(mapping)
+        if len(batch) >= ICS_IMPORT_BATCH_SIZE:
+            db.session.bulk_insert_mappings(CalendarEvent, batch)
+            imported += len(batch)
+            batch = []
+            if on_batch:
+                on_batch()
+    if batch:
+        db.session.bulk_insert_mappings(CalendarEvent, batch)
+        imported += len(batch)
+    if imported:
+        # bulk insertではマッパーイベントが発火しないので手動で更新日時と変更履歴を記録
+        db.session.execute(Settings.__table__.update().values(calendar_updated_at=datetime.utcnow()))
+        record_bulk_inserts(db.session.connection(), CalendarEvent, last_id)
+    db.session.commit()
+    return imported, skipped
+
+@app.route('/calendar.ics')
+def calendar_feed():
+    """カレンダーアプリ購読用のiCalendarフィード"""
+    settings = get_settings()
+    updated_at = settings.calendar_updated_at or datetime(2000, 1, 1)
+    
+    window = None
+    year = request.args.get('year', type=int)
+    month = request.args.get('month', type=int)
+    if year and month and 1 <= month <= 12:
+        window = month_range(year, month)
+    
+    # 変更がなければイベントのテーブルには触れずに304を返す
+    etag = f'cal-{updated_at.strftime("%Y%m%d%H%M%S%f")}-{year or 0}-{month or 0}'
+    last_modified = updated_at.replace(microsecond=0)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    else:
+        dtstamp = last_modified.strftime('%Y%m%dT%H%M%SZ')
+        response = Response(stream_with_context(generate_ics(dtstamp, window)),
+                            mimetype='text/calendar')
+        response.headers['Content-Disposition'] = 'inline; filename="productivity.ics"'
+    # 更新日時から作るETagで、gzip圧縮の有無にかかわらず同じ値を返すので弱いETagにする
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/calendar/import', methods=['POST'])
+def import_calendar():
+    upload = request.files.get('ics_file')
+    if not upload or not upload.filename:
+        flash('インポートする .ics ファイルを選択してください', 'error')
+        return redirect(url_for('calendar_view'))
+    
+    # 大きなファイルでもリクエストを待たせないよう、保存してからバックグラウンドで取り込む
+    path = job_artifact_path('.ics')
+    upload.save(path)
+    job = job_runner.submit('import_ics', path=path)
+    flash('カレンダーのインポートを開始しました', 'info')
+    return redirect(url_for('jobs', highlight=job.id))
+
+@app.route('/api/check_reminders', methods=['POST'])
 def check_reminders():
     """30分前のリマインダーをチェック"""
-    now = datetime.utcnow()
+    # 予定の開始日時は設定のタイムゾーンでのローカル時刻で保存している
+    now = local_now()
     reminder_time = now + timedelta(minutes=30)
     
+    window_start = reminder_time - timedelta(minutes=5)
+    window_end = reminder_time + timedelta(minutes=5)
+    
     # 30分後に開始するイベントを取得（±5分の範囲）
     events = CalendarEvent.query.filter(
-        CalendarEvent.start_time >= reminder_time - timedelta(minutes=5),
-        CalendarEvent.start_time <= reminder_time + timedelta(minutes=5),
+        CalendarEvent.recurrence_freq.is_(None),
+        CalendarEvent.start_time >= window_start,
+        CalendarEvent.start_time <= window_end,
         CalendarEvent.reminder_sent == False
     ).all()
     
@@ -821,10 +3176,206 @@ def check_reminders():
             'category': event.category
         })
     
+    # 繰り返し予定は日単位で展開（キャッシュが効くように期間を固定）し、通知済みの発生日時を記録
+    day_start = datetime.combine(window_start.date(), datetime.min.time())
+    day_end = datetime.combine(window_end.date(), datetime.min.time()) + timedelta(days=1)
+    for series in recurring_series_in_window(window_start, window_end + timedelta(seconds=1)):
+        for start in expand_recurrence(recurrence_rule(series), day_start, day_end):
+            if not window_start <= start <= window_end:
+                continue
+            if series.reminder_sent_until and start <= series.reminder_sent_until:
+                continue
+            series.reminder_sent_until = start
+            reminders.append({
+                'id': series.id,
+                'title': series.title,
+                'start_time': start.strftime('%H:%M'),
+                'category': series.category
+            })
+    
     db.session.commit()
     return jsonify({'reminders': reminders})
 
 # Goals
+# 目標にはタスク・習慣・学習項目を紐付けられる。進捗は、タスクの完了・習慣の記録・学習時間の記録と
+# 同じトランザクションで差分だけ更新し、一覧では保存済みの値を表示する（表示のたびに集計しない）
+GOAL_LINK_TYPES = {
+    'task': ('タスク', Task),
+    'habit': ('習慣', Habit),
+    'learning': ('学習', LearningItem),
+}
+GOAL_LINK_METRICS = {
+    'task': {'completion': '完了'},
+    'habit': {'count': '達成回数', 'streak': '連続記録'},
+    'learning': {'hours': '学習時間'},
+}
+GOAL_LINK_MAX_TARGET = 10000
+
+def goal_link_fraction(current, target):
+    """1つの項目の達成度（0〜1）"""
+    return min(max(current or 0, 0) / target, 1.0) if target else 0.0
+
+def apply_goal_progress(connection, deltas):
+    """{goal_id: (達成度の増減, 項目数の増減)} を目標に反映し、100%に達したら達成にする"""
+    goals = Goal.__table__
+    for goal_id, (done_delta, total_delta) in deltas.items():
+        row = connection.execute(db.select(goals.c.progress_done, goals.c.progress_total, goals.c.status)
+                                 .where(goals.c.id == goal_id)).first()
+        if row is None:
+            continue
+        total = max((row.progress_total or 0) + total_delta, 0)
+        # 足し引きを繰り返した誤差で範囲を外れないようにする
+        done = min(max((row.progress_done or 0) + done_delta, 0.0), float(total))
+        values = {'progress_done': done, 'progress_total': total}
+        if total:
+            values['progress'] = int(done / total * 100 + 1e-9)
+            if values['progress'] >= 100 and row.status == 'active':
+                values.update(status='completed', completed_at=datetime.utcnow())
+        connection.execute(goals.update().where(goals.c.id == goal_id).values(**values))
+        record_change(connection, goals.name, goal_id, 'upsert')
+
+def update_goal_links(connection, item_type, item_id, metrics, new_current):
+    """項目に紐付いたリンクの current を new_current(link) に更新し、達成度の差分を目標に反映する
+    
+    new_current が None を返したリンクは変更しない
+    """
+    links = GoalLink.__table__
+    deltas = {}
+    for link in connection.execute(db.select(links).where(
+            links.c.item_type == item_type, links.c.item_id == item_id, links.c.metric.in_(metrics))).all():
+        current = new_current(link)
+        if current is None or current == link.current:
+            continue
+        connection.execute(links.update().where(links.c.id == link.id).values(current=current))
+        record_change(connection, links.name, link.id, 'upsert')
+        change = goal_link_fraction(current, link.target) - goal_link_fraction(link.current, link.target)
+        if change:
+            done, total = deltas.get(link.goal_id, (0.0, 0))
+            deltas[link.goal_id] = (done + change, total)
+    apply_goal_progress(connection, deltas)
+
+def unlink_goal_item(connection, item_type, item_id):
+    """削除された項目のリンクを外し、目標の項目数と達成度から除く"""
+    links = GoalLink.__table__
+    condition = (links.c.item_type == item_type) & (links.c.item_id == item_id)
+    deltas = {}
+    for link in connection.execute(db.select(links).where(condition)).all():
+        done, total = deltas.get(link.goal_id, (0.0, 0))
+        deltas[link.goal_id] = (done - goal_link_fraction(link.current, link.target), total - 1)
+        record_change(connection, links.name, link.id, 'delete')
+    if deltas:
+        connection.execute(links.delete().where(condition))
+        apply_goal_progress(connection, deltas)
+
+def goal_link_added(mapper, connection, target):
+    apply_goal_progress(connection, {target.goal_id: (goal_link_fraction(target.current, target.target), 1)})
+
+def goal_link_removed(mapper, connection, target):
+    apply_goal_progress(connection, {target.goal_id: (-goal_link_fraction(target.current, target.target), -1)})
+
+event.listen(GoalLink, 'after_insert', goal_link_added)
+event.listen(GoalLink, 'after_delete', goal_link_removed)
+
+def task_goal_progress(mapper, connection, target):
+    if db.inspect(target).attrs.status.history.has_changes():
+        completed = 1.0 if target.status == 'completed' else 0.0
+        update_goal_links(connection, 'task', target.id, ('completion',), lambda link: completed)
+
+def habit_streak_now(connection, habit_id):
+    """フラッシュ中（ビットマップの更新後）に、セッションを使わずに現在の連続記録を計算する"""
+    habit = connection.execute(db.select(Habit.__table__).where(Habit.__table__.c.id == habit_id)).first()
+    if habit is None:
+        return 0
+    today = to_local_date(datetime.utcnow(), current_timezone(connection))
+    bitmaps = load_habit_bitmaps([habit_id], today.year - 1, today.year, connection)
+    return habit_current_streak(habit, bitmaps, today.year - 1, today, connection)
+
+def habit_goal_progress(connection, habit_id, changes):
+    """changes: [(記録の日付, +1 または -1)]。count は紐付けた日以降の分だけ数える"""
+    streak = []
+    
+    def new_current(link):
+        if link.metric == 'streak':
+            if not streak:
+                streak.append(habit_streak_now(connection, habit_id))
+            return streak[0]
+        step = sum(sign for day, sign in changes if link.since is None or day >= link.since)
+        return max(link.current + step, 0) if step else None
+    
+    update_goal_links(connection, 'habit', habit_id, ('count', 'streak'), new_current)
+
+def habit_log_goal_inserted(mapper, connection, target):
+    if target.completed is not False and target.date:
+        habit_goal_progress(connection, target.habit_id, [(target.date, 1)])
+
+def habit_log_goal_deleted(mapper, connection, target):
+    if target.completed is not False and target.date:
+        habit_goal_progress(connection, target.habit_id, [(target.date, -1)])
+
+def habit_log_goal_updated(mapper, connection, target):
+    state = db.inspect(target)
+    if not (state.attrs.date.history.has_changes() or state.attrs.completed.history.has_changes()):
+        return
+    old_date = state.attrs.date.history.deleted[0] if state.attrs.date.history.deleted else target.date
+    old_completed = (state.attrs.completed.history.deleted[0] if state.attrs.completed.history.deleted
+                     else target.completed)
+    changes = []
+    if old_completed is not False and old_date:
+        changes.append((old_date, -1))
+    if target.completed is not False and target.date:
+        changes.append((target.date, 1))
+    habit_goal_progress(connection, target.habit_id, changes)
+
+def learning_goal_progress(mapper, connection, target):
+    if db.inspect(target).attrs.total_hours.history.has_changes():
+        hours = target.total_hours or 0
+        update_goal_links(connection, 'learning', target.id, ('hours',), lambda link: hours)
+
+# ビットマップを更新するリスナーより後に登録して、連続記録は更新後のビットマップから計算する
+event.listen(Task, 'after_update', task_goal_progress)
+event.listen(HabitLog, 'after_insert', habit_log_goal_inserted)
+event.listen(HabitLog, 'after_delete', habit_log_goal_deleted)
+event.listen(HabitLog, 'after_update', habit_log_goal_updated)
+event.listen(LearningItem, 'after_update', learning_goal_progress)
+def goal_item_deleted(mapper, connection, target):
+    item_type = next(key for key, (_, model) in GOAL_LINK_TYPES.items() if model is mapper.class_)
+    unlink_goal_item(connection, item_type, target.id)
+
+for _, _model in GOAL_LINK_TYPES.values():
+    event.listen(_model, 'after_delete', goal_item_deleted)
+
+def goal_link_current(item_type, metric, item, since):
+    """紐付けた時点の current"""
+    if item_type == 'task':
+        return 1.0 if item.status == 'completed' else 0.0
+    if item_type == 'learning':
+        return item.total_hours or 0
+    if metric == 'streak':
+        today = local_today()
+        return habit_current_streak(item, load_habit_bitmaps([item.id], today.year - 1, today.year), today.year - 1, today)
+    # count: 紐付けた日から数え始める（その日にすでに記録した分も含める）
+    return HabitLog.query.filter(HabitLog.habit_id == item.id, HabitLog.date >= since,
+                                 db.or_(HabitLog.completed.is_(None), HabitLog.completed == True)).count()
+
+def goal_link_rows(goal):
+    """リンクの一覧を、項目名付きで表示用にまとめる（種類ごとに1クエリ）"""
+    ids = {}
+    for link in goal.links:
+        ids.setdefault(link.item_type, set()).add(link.item_id)
+    names = {}
+    for item_type, item_ids in ids.items():
+        model = GOAL_LINK_TYPES[item_type][1]
+        name_column = model.name if model is Habit else model.title
+        names.update({(item_type, item_id): name for item_id, name in
+                      db.session.query(model.id, name_column).filter(model.id.in_(item_ids))})
+    return [{
+        'link': link,
+        'type_label': GOAL_LINK_TYPES[link.item_type][0],
+        'metric_label': GOAL_LINK_METRICS[link.item_type][link.metric],
+        'name': names.get((link.item_type, link.item_id), '（削除済み）'),
+        'percent': int(goal_link_fraction(link.current, link.target) * 100 + 1e-9),
+    } for link in sorted(goal.links, key=lambda link: link.id)]
+
 @app.route('/goals')
 def goals():
     active_goals = Goal.query.filter_by(status='active').order_by(Goal.target_date).all()
@@ -858,6 +3409,8 @@ def add_goal():
 @app.route('/goals/<int:goal_id>/update', methods=['POST'])
 def update_goal(goal_id):
     goal = Goal.query.get_or_404(goal_id)
+    if goal.progress_total:
+        return jsonify({'success': False, 'error': '紐付けた項目から自動で計算される目標です'}), 409
     data = request.get_json()
     goal.progress = int(data.get('progress', 0))
     
@@ -868,11 +3421,64 @@ def update_goal(goal_id):
     db.session.commit()
     return jsonify({'success': True})
 
+@app.route('/goals/<int:goal_id>/links', methods=['GET', 'POST'])
+def goal_links(goal_id):
+    goal = Goal.query.get_or_404(goal_id)
+    
+    if request.method == 'POST':
+        item_type = request.form.get('item_type')
+        metric = request.form.get('metric')
+        if item_type not in GOAL_LINK_METRICS or metric not in GOAL_LINK_METRICS[item_type]:
+            flash('紐付ける項目の種類が正しくありません', 'error')
+            return redirect(url_for('goal_links', goal_id=goal.id))
+        item = db.session.get(GOAL_LINK_TYPES[item_type][1],
+                              validate_integer(request.form.get(f'{item_type}_id'), min_val=1, default=0))
+        if item is None:
+            flash('紐付ける項目を選択してください', 'error')
+            return redirect(url_for('goal_links', goal_id=goal.id))
+        if GoalLink.query.filter_by(goal_id=goal.id, item_type=item_type, item_id=item.id, metric=metric).first():
+            flash('この項目はすでに紐付けています', 'warning')
+            return redirect(url_for('goal_links', goal_id=goal.id))
+        
+        if item_type == 'task':
+            target = 1.0
+        else:
+            try:
+                target = float(request.form.get('target', ''))
+            except ValueError:
+                target = 0
+            if not 0 < target <= GOAL_LINK_MAX_TARGET:
+                flash(f'目標値は0より大きく{GOAL_LINK_MAX_TARGET}以下で入力してください', 'error')
+                return redirect(url_for('goal_links', goal_id=goal.id))
+            if metric != 'hours':
+                target = float(int(target))
+        
+        since = local_today()
+        db.session.add(GoalLink(goal_id=goal.id, item_type=item_type, item_id=item.id, metric=metric, target=target,
+                                current=goal_link_current(item_type, metric, item, since), since=since))
+        db.session.commit()
+        flash('項目を紐付けました。進捗は項目の記録に合わせて自動で更新されます', 'success')
+        return redirect(url_for('goal_links', goal_id=goal.id))
+    
+    return render_template('goal_links.html', goal=goal, links=goal_link_rows(goal),
+                           metrics=GOAL_LINK_METRICS, max_target=GOAL_LINK_MAX_TARGET,
+                           tasks=Task.query.filter(Task.status != 'completed').order_by(Task.created_at.desc()).all(),
+                           habits=Habit.query.order_by(Habit.name).all(),
+                           learning_items=LearningItem.query.order_by(LearningItem.created_at.desc()).all())
+
+@app.route('/goals/<int:goal_id>/links/<int:link_id>/delete', methods=['POST'])
+def delete_goal_link(goal_id, link_id):
+    link = GoalLink.query.filter_by(id=link_id, goal_id=goal_id).first_or_404()
+    db.session.delete(link)
+    db.session.commit()
+    flash('紐付けを外しました', 'info')
+    return redirect(url_for('goal_links', goal_id=goal_id))
+
 # Notes
 @app.route('/notes')
 def notes():
-    all_notes = Note.query.order_by(Note.is_pinned.desc(), Note.updated_at.desc()).all()
-    return render_template('notes.html', notes=all_notes)
+    all_notes = StreamedRows(Note.query.order_by(Note.is_pinned.desc(), Note.updated_at.desc()))
+    return stream_page('notes.html', notes=all_notes)
 
 @app.route('/notes/add', methods=['GET', 'POST'])
 def add_note():
@@ -899,11 +3505,130 @@ def delete_note(note_id):
     return redirect(url_for('notes'))
 
 # Time Tracking
+TIME_REPORT_DEFAULT_DAYS = 90
+TIME_REPORT_MAX_DAYS = 366 * 5
+
+# 集計の単位: (表示名, 日時の列 → 期間の先頭を表す文字列)
+TIME_REPORT_PERIODS = {
+    'day': ('日', lambda column: db.func.date(column)),
+    'week': ('週', lambda column: db.func.date(column, 'weekday 0', '-6 days')),  # 月曜始まり
+    'month': ('月', lambda column: db.func.strftime('%Y-%m', column)),
+}
+
+def running_time_entries():
+    """記録中のエントリ（部分インデックス ix_time_entry_running と同じ条件で書いてインデックスを使わせる）"""
+    return TimeEntry.query.filter(TimeEntry.is_running == db.true())
+
+def time_entry_minutes(now):
+    """エントリの分数。記録中のものは now までの経過時間をクエリの中で計算する"""
+    elapsed = (db.func.julianday(db.literal(now, db.DateTime)) - db.func.julianday(TimeEntry.start_time)) * 1440
+    return db.case((TimeEntry.is_running == db.true(), db.func.max(elapsed, 0)),
+                   else_=db.func.coalesce(TimeEntry.duration_minutes, 0))
+
+def time_report(period, start_date, end_date, now):
+    """期間×プロジェクトごとの (期間, プロジェクト, 件数, 分) を1回のGROUP BYで求める（アーカイブ済みの分も含む）"""
+    live = db.select(
+        TimeEntry.local_date.label('at'), TimeEntry.project_name.label('project'),
+        db.literal(1).label('entries'), time_entry_minutes(now).label('minutes')
+    ).where(TimeEntry.local_date >= start_date, TimeEntry.local_date <= end_date)
+    archived = db.select(ArchiveRollup.day, ArchiveRollup.label, ArchiveRollup.count, ArchiveRollup.amount).where(
+        ArchiveRollup.source == 'time_entry', ArchiveRollup.day >= start_date, ArchiveRollup.day <= end_date)
+    rows = db.union_all(live, archived).subquery()
+    period_start = TIME_REPORT_PERIODS[period][1](rows.c.at).label('period')
+    minutes = db.func.sum(rows.c.minutes)
+    return db.session.query(period_start, rows.c.project, db.func.sum(rows.c.entries), minutes).group_by(
+        period_start, rows.c.project).order_by(period_start.desc(), minutes.desc()).all()
+
+def summarize_time_report(rows, rate=None):
+    """期間ごとの行をプロジェクト別の合計にまとめる（rateを指定すると時間×単価の金額も付ける）"""
+    projects = {}
+    for _, project, entries, minutes in rows:
+        total = projects.setdefault(project, {'project': project, 'entries': 0, 'minutes': 0})
+        total['entries'] += entries
+        total['minutes'] += minutes
+    all_minutes = sum(total['minutes'] for total in projects.values())
+    summary = sorted(projects.values(), key=lambda total: total['minutes'], reverse=True)
+    for total in summary:
+        total['minutes'] = round(total['minutes'])
+        total['hours'] = round(total['minutes'] / 60, 2)
+        total['share'] = round(total['minutes'] / all_minutes * 100, 1) if all_minutes else 0
+        total['amount'] = round(total['hours'] * rate) if rate is not None else None
+    return summary
+
+def load_time_report(args):
+    """クエリパラメータ（period, start, end, rate）から集計する"""
+    period = args.get('period') if args.get('period') in TIME_REPORT_PERIODS else 'week'
+    end = validate_date(args.get('end'))
+    end_date = end.date() if end else local_today()
+    start = validate_date(args.get('start'))
+    start_date = start.date() if start else end_date - timedelta(days=TIME_REPORT_DEFAULT_DAYS - 1)
+    start_date = min(max(start_date, end_date - timedelta(days=TIME_REPORT_MAX_DAYS - 1)), end_date)
+    rate = validate_integer(args.get('rate'), min_val=0, max_val=10 ** 7)
+    
+    rows = time_report(period, start_date, end_date, datetime.utcnow())
+    periods = []
+    for period_start, project, entries, minutes in rows:
+        if not periods or periods[-1]['period'] != period_start:
+            periods.append({'period': period_start, 'minutes': 0, 'projects': []})
+        periods[-1]['minutes'] += round(minutes)
+        periods[-1]['projects'].append({'project': project, 'entries': entries, 'minutes': round(minutes)})
+    summary = summarize_time_report(rows, rate)
+    return {
+        'period': period,
+        'start': start_date.isoformat(),
+        'end': end_date.isoformat(),
+        'rate': rate,
+        'periods': periods,
+        'projects': summary,
+        'total_minutes': sum(total['minutes'] for total in summary),
+        'total_amount': sum(total['amount'] for total in summary) if rate is not None else None,
+    }
+
 @app.route('/timetracking')
 def timetracking():
     entries = TimeEntry.query.order_by(TimeEntry.start_time.desc()).limit(50).all()
-    running_entry = TimeEntry.query.filter_by(is_running=True).first()
-    return render_template('timetracking.html', entries=entries, running_entry=running_entry)
+    running_entry = running_time_entries().first()
+    running_minutes = None
+    if running_entry:
+        running_minutes = max(int((datetime.utcnow() - running_entry.start_time).total_seconds() / 60), 0)
+    return render_template('timetracking.html', entries=entries, running_entry=running_entry,
+                           running_minutes=running_minutes)
+
+@app.route('/timetracking/report')
+def time_report_view():
+    return render_template('time_report.html', report=load_time_report(request.args),
+                           periods={key: label for key, (label, _) in TIME_REPORT_PERIODS.items()})
+
+@app.route('/api/timetracking/report')
+def time_report_api():
+    return jsonify(load_time_report(request.args))
+
+@app.route('/timetracking/report.csv')
+def time_report_csv():
+    report = load_time_report(request.args)
+    
+    def generate():
+        yield '\ufeff'  # Excelで文字化けしないようBOMを付ける
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        header = ['期間', 'プロジェクト', '件数', '分', '時間']
+        writer.writerow(header + (['金額'] if report['rate'] is not None else []))
+        for period in report['periods']:
+            for project in period['projects']:
+                hours = round(project['minutes'] / 60, 2)
+                row = [period['period'], project['project'], project['entries'], project['minutes'], hours]
+                if report['rate'] is not None:
+                    row.append(round(hours * report['rate']))
+                writer.writerow(row)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    
+    response = Response(stream_with_context(generate()), mimetype='text/csv')
+    filename = f"time_report_{report['start']}_{report['end']}.csv"
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
 
 @app.route('/timetracking/start', methods=['POST'])
 def start_tracking():
@@ -911,14 +3636,16 @@ def start_tracking():
     project_name = data.get('project_name')
     description = data.get('description', '')
     
+    now = request_time()
+    
     # Stop any running entries
-    running = TimeEntry.query.filter_by(is_running=True).all()
+    running = running_time_entries().all()
     for entry in running:
         entry.is_running = False
-        entry.end_time = datetime.utcnow()
+        entry.end_time = max(now, entry.start_time)
         entry.duration_minutes = int((entry.end_time - entry.start_time).total_seconds() / 60)
     
-    entry = TimeEntry(project_name=project_name, description=description, start_time=datetime.utcnow(), is_running=True)
+    entry = TimeEntry(project_name=project_name, description=description, start_time=now, is_running=True)
     db.session.add(entry)
     db.session.commit()
     
@@ -927,8 +3654,10 @@ def start_tracking():
 @app.route('/timetracking/stop/<int:entry_id>', methods=['POST'])
 def stop_tracking(entry_id):
     entry = TimeEntry.query.get_or_404(entry_id)
+    if not entry.is_running:
+        return jsonify({'success': True, 'duration': entry.duration_minutes})
     entry.is_running = False
-    entry.end_time = datetime.utcnow()
+    entry.end_time = max(request_time(), entry.start_time)
     entry.duration_minutes = int((entry.end_time - entry.start_time).total_seconds() / 60)
     db.session.commit()
     
@@ -937,32 +3666,32 @@ def stop_tracking(entry_id):
 # Reports
 @app.route('/reports')
 def reports():
-    today = datetime.utcnow().date()
+    today = local_today()
     week_ago = today - timedelta(days=7)
     month_ago = today - timedelta(days=30)
     
     # Weekly stats
     week_pomodoros = PomodoroSession.query.filter(
-        PomodoroSession.started_at >= datetime.combine(week_ago, datetime.min.time()),
+        PomodoroSession.local_date >= week_ago,
         PomodoroSession.completed == True,
         PomodoroSession.session_type == 'work'
     ).count()
     
     week_tasks = Task.query.filter(
         Task.status == 'completed',
-        Task.completed_at >= datetime.combine(week_ago, datetime.min.time())
+        Task.completed_local_date >= week_ago
     ).count()
     
     # Monthly stats
     month_pomodoros = PomodoroSession.query.filter(
-        PomodoroSession.started_at >= datetime.combine(month_ago, datetime.min.time()),
+        PomodoroSession.local_date >= month_ago,
         PomodoroSession.completed == True,
         PomodoroSession.session_type == 'work'
     ).count()
     
     month_tasks = Task.query.filter(
         Task.status == 'completed',
-        Task.completed_at >= datetime.combine(month_ago, datetime.min.time())
+        Task.completed_local_date >= month_ago
     ).count()
     
     return render_template('reports.html',
@@ -971,39 +3700,104 @@ def reports():
                          month_pomodoros=month_pomodoros,
                          month_tasks=month_tasks)
 
+# Insights
+INSIGHTS_DEFAULT_DAYS = 90
+INSIGHTS_MAX_DAYS = 366 * 5
+JULIAN_DAY_UNIX_EPOCH = 2440587.5
+UNIX_EPOCH = datetime(1970, 1, 1)
+
+def epoch_days(column):
+    """SQLite側で1970-01-01からの日数（小数）にして、datetimeへの変換を省く"""
+    return db.func.julianday(column) - JULIAN_DAY_UNIX_EPOCH
+
+def local_epoch_days(utc_datetime, tz):
+    """UTCの日時を、設定のタイムゾーンでの1970-01-01からの日数（小数）にする"""
+    local = utc_datetime.replace(tzinfo=timezone.utc).astimezone(tz).replace(tzinfo=None)
+    return (local - UNIX_EPOCH).total_seconds() / 86400
+
+def load_insights(days):
+    """モデルごとに1クエリで読み込み、analyticsで日付をそろえて集計する"""
+    # NumPyの読み込みは起動を遅くするので、必要になってから読み込む
+    import analytics
+    
+    end_date = local_today()
+    start_date = end_date - timedelta(days=days - 1)
+    
+    health_rows = db.session.query(
+        epoch_days(HealthLog.date), HealthLog.sleep_hours, HealthLog.weight, HealthLog.exercise_minutes,
+        HealthLog.water_intake, HealthLog.mood
+    ).filter(HealthLog.date >= start_date).all()
+    habit_rows = db.session.query(epoch_days(HabitLog.date), db.func.count(HabitLog.id)).filter(
+        HabitLog.date >= start_date, HabitLog.completed == True
+    ).group_by(HabitLog.date).all()
+    # 日ごとの集計は local_date、曜日×時間帯は開始日時を設定のタイムゾーンに直して使う
+    tz = current_timezone()
+    pomodoro_rows = [
+        (day, duration, local_epoch_days(started_at, tz))
+        for day, duration, started_at in db.session.query(
+            epoch_days(PomodoroSession.local_date), PomodoroSession.duration, PomodoroSession.started_at
+        ).filter(
+            PomodoroSession.local_date >= start_date,
+            PomodoroSession.completed == True,
+            PomodoroSession.session_type == 'work'
+        )
+    ]
+    journal_rows = db.session.query(epoch_days(JournalEntry.date), JournalEntry.mood).filter(
+        JournalEntry.date >= start_date, JournalEntry.mood.isnot(None)
+    ).all()
+    
+    # アーカイブ済みの期間は日ごとの集計で補う
+    rollup_rows = db.session.query(
+        ArchiveRollup.source, epoch_days(ArchiveRollup.day), db.func.sum(ArchiveRollup.count),
+        db.func.sum(ArchiveRollup.amount)
+    ).filter(ArchiveRollup.day >= start_date,
+             ArchiveRollup.source.in_(('habit_log', 'pomodoro_session'))).group_by(
+        ArchiveRollup.source, ArchiveRollup.day).all()
+    habit_rows += [(day, count) for source, day, count, _ in rollup_rows if source == 'habit_log']
+    pomodoro_daily_rows = [(day, count, minutes) for source, day, count, minutes in rollup_rows
+                           if source == 'pomodoro_session']
+    
+    return analytics.build_insights(start_date, days, health_rows, habit_rows, Habit.query.count(),
+                                    pomodoro_rows, journal_rows, pomodoro_daily_rows=pomodoro_daily_rows)
+
+@app.route('/insights')
+def insights():
+    days = validate_integer(request.args.get('days', INSIGHTS_DEFAULT_DAYS), min_val=14, max_val=INSIGHTS_MAX_DAYS,
+                            default=INSIGHTS_DEFAULT_DAYS)
+    return render_template('insights.html', insights=load_insights(days), days=days)
+
+@app.route('/api/insights')
+def insights_api():
+    days = validate_integer(request.args.get('days', INSIGHTS_DEFAULT_DAYS), min_val=14, max_val=INSIGHTS_MAX_DAYS,
+                            default=INSIGHTS_DEFAULT_DAYS)
+    return jsonify(load_insights(days))
+
 # Achievements
 @app.route('/achievements')
 def achievements():
-    # Initialize achievements if not exists
-    if Achievement.query.count() == 0:
-        init_achievements()
-    
+    # 実績の一覧はDBを開く時に用意し、解除はポモドーロやタスクを記録したリクエストの後で行う
     all_achievements = Achievement.query.all()
-    
-    # Check and unlock achievements
-    check_achievements()
-    
     return render_template('achievements.html', achievements=all_achievements)
 
-def init_achievements():
-    achievements_data = [
-        {'name': '初めの一歩', 'description': '最初のポモドーロを完了', 'badge_type': 'pomodoro', 'requirement': 1, 'icon': 'alarm'},
-        {'name': 'ポモドーロ初心者', 'description': '10回のポモドーロを完了', 'badge_type': 'pomodoro', 'requirement': 10, 'icon': 'alarm-fill'},
-        {'name': 'ポモドーロマスター', 'description': '100回のポモドーロを完了', 'badge_type': 'pomodoro', 'requirement': 100, 'icon': 'trophy'},
-        {'name': '習慣の力', 'description': '7日連続で習慣を達成', 'badge_type': 'streak', 'requirement': 7, 'icon': 'fire'},
-        {'name': '継続は力なり', 'description': '30日連続で習慣を達成', 'badge_type': 'streak', 'requirement': 30, 'icon': 'star-fill'},
-        {'name': 'タスクハンター', 'description': '50個のタスクを完了', 'badge_type': 'task', 'requirement': 50, 'icon': 'check-circle-fill'},
-    ]
-    
-    for data in achievements_data:
-        achievement = Achievement(**data)
-        db.session.add(achievement)
-    
-    db.session.commit()
+# 実績の解除の判定に使うモデル。これらを書き換えたリクエストの後で check_achievements() を実行する
+ACHIEVEMENT_SOURCES = (PomodoroSession, Task)
+
+def mark_achievements_stale(session, flush_context):
+    if has_request_context() and any(isinstance(obj, ACHIEVEMENT_SOURCES) for obj in (*session.new, *session.dirty)):
+        g.achievements_stale = True
+
+event.listen(ShardedSession, 'after_flush', mark_achievements_stale)
+
+@app.after_request
+def unlock_achievements(response):
+    if g.pop('achievements_stale', False) and response.status_code < 400:
+        check_achievements()
+    return response
 
 def check_achievements():
     # Check pomodoro achievements
     total_pomodoros = PomodoroSession.query.filter_by(completed=True, session_type='work').count()
+    total_pomodoros += rollup_totals('pomodoro_session')[0]
     for achievement in Achievement.query.filter_by(badge_type='pomodoro', unlocked_at=None).all():
         if total_pomodoros >= achievement.requirement:
             achievement.unlocked_at = datetime.utcnow()
@@ -1016,22 +3810,633 @@ def check_achievements():
     
     db.session.commit()
 
-# Backup and Export
-@app.route('/backup')
-def backup_database():
-    """データベースのバックアップをダウンロード"""
+# Background Jobs
+# 重い処理（バックアップ・エクスポート・インポート・再集計）はリクエストの外でスレッドプールで実行し、
+# 状態と結果はJobテーブルに保存して /jobs/<id> で確認・ダウンロードする
+app.config['JOB_MAX_WORKERS'] = int(os.environ.get('JOB_MAX_WORKERS', 2))
+app.config['JOB_DIRECTORY'] = os.environ.get('JOB_DIRECTORY') or os.path.join(app.instance_path, 'jobs')
+JOB_RETENTION = timedelta(days=1)  # 完了したジョブと成果物を残す期間
+JOB_ACTIVE_STATUSES = ('queued', 'running')
+JOB_LABELS = {
+    'backup': 'データベースバックアップ',
+    'export_json': 'JSONエクスポート',
+    'import_ics': 'カレンダーのインポート',
+    'import_health': '健康データの取り込み',
+    'rebuild_habit_bitmaps': '習慣の記録の再集計',
+    'recompute_local_dates': '記録の日付の再計算',
+}
+
+class JobCancelled(Exception):
+    pass
+
+def check_job_cancelled(job_id):
+    """キャンセルが要求されていたら JobCancelled を送出（処理の区切りごとに呼ぶ）"""
+    if db.session.query(Job.cancel_requested).filter_by(id=job_id).scalar():
+        raise JobCancelled()
+
+def job_artifact_path(extension):
+    os.makedirs(app.config['JOB_DIRECTORY'], exist_ok=True)
+    return os.path.join(app.config['JOB_DIRECTORY'], f'{secrets.token_hex(8)}{extension}')
+
+class JobRunner:
+    """同時実行数に上限のあるスレッドプール。通常のリクエストを処理するワーカーを占有しない"""
+    
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.executor = None
+        self.futures = {}
+        self.lock = threading.Lock()
+    
+    def submit(self, kind, **params):
+        cleanup_jobs()
+        job = Job(kind=kind, params=json.dumps(params, ensure_ascii=False))
+        db.session.add(job)
+        db.session.commit()
+        shard = g.get('shard')
+        with self.lock:
+            if self.executor is None:
+                # gunicornのforkより後に作られるよう、最初のジョブで起動する
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+            self.futures[(shard, job.id)] = self.executor.submit(self.run, job.id, shard)
+        return job
+    
+    def cancel(self, job):
+        job.cancel_requested = True
+        if job.status == 'queued':
+            with self.lock:
+                future = self.futures.get((g.get('shard'), job.id))
+            # 別プロセスで待機中のジョブは、開始時にcancel_requestedを見て中止される
+            if future is None or future.cancel():
+                job.status = 'cancelled'
+                job.finished_at = datetime.utcnow()
+        db.session.commit()
+    
+    def run(self, job_id, shard):
+        with app.app_context():
+            g.shard = shard
+            try:
+                job = db.session.get(Job, job_id)
+                if job is None or job.status != 'queued':
+                    return
+                if job.cancel_requested:
+                    job.status = 'cancelled'
+                    job.finished_at = datetime.utcnow()
+                    db.session.commit()
+                    return
+                job.status = 'running'
+                job.started_at = datetime.utcnow()
+                db.session.commit()
+                
+                try:
+                    result = JOB_HANDLERS[job.kind](job_id, json.loads(job.params or '{}'))
+                except JobCancelled:
+                    db.session.rollback()
+                    job.status = 'cancelled'
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.exception('ジョブ %s (%s) が失敗しました', job_id, job.kind)
+                    job.status = 'failed'
+                    job.error = str(e)
+                else:
+                    job.status = 'succeeded'
+                    job.message = result.get('message')
+                    job.result_path = result.get('path')
+                    job.result_name = result.get('name')
+                    job.result_mimetype = result.get('mimetype')
+                job.finished_at = datetime.utcnow()
+                db.session.commit()
+            finally:
+                with self.lock:
+                    self.futures.pop((shard, job_id), None)
+
+job_runner = JobRunner(app.config['JOB_MAX_WORKERS'])
+
+def cleanup_jobs():
+    """保存期間を過ぎたジョブと成果物ファイルを削除"""
+    expired = Job.query.filter(Job.status.notin_(JOB_ACTIVE_STATUSES),
+                               Job.finished_at < datetime.utcnow() - JOB_RETENTION).all()
+    for job in expired:
+        if job.result_path and os.path.exists(job.result_path):
+            os.remove(job.result_path)
+        db.session.delete(job)
+    if expired:
+        db.session.commit()
+
+def fail_interrupted_jobs():
+    """前回の終了時に実行中・待機中だったジョブは再開できないので失敗扱いにする"""
+    Job.query.filter(Job.status.in_(JOB_ACTIVE_STATUSES)).update(
+        {'status': 'failed', 'error': 'アプリの再起動により中断されました', 'finished_at': datetime.utcnow()},
+        synchronize_session=False)
+    db.session.commit()
+
+def run_backup_job(job_id, params):
+    """SQLiteのバックアップAPIで、書き込み中でも一貫した状態のコピーを作る"""
+    path = job_artifact_path('.db')
+    source = sqlite3.connect(f'file:{current_database_path()}?mode=ro', uri=True)
+    target = sqlite3.connect(path)
+    try:
+        with target:
+            source.backup(target)
+    finally:
+        source.close()
+        target.close()
+    return {'path': path, 'name': f'productivity_backup_{datetime.now().strftime("%Y%m%d_%H%M%S")}.db',
+            'mimetype': 'application/octet-stream'}
+
+def run_export_json_job(job_id, params):
+    data = {'export_date': datetime.now().isoformat()}
+    for key, build in EXPORT_SECTIONS:
+        check_job_cancelled(job_id)
+        data[key] = build()
+    path = job_artifact_path('.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    return {'path': path, 'name': f'productivity_data_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json',
+            'mimetype': 'application/json'}
+
+def run_import_ics_job(job_id, params):
+    path = params['path']
+    try:
+        with open(path, encoding='utf-8-sig', errors='replace', newline='') as stream:
+            imported, skipped = import_ics(stream, on_batch=lambda: check_job_cancelled(job_id))
+    finally:
+        os.remove(path)
+    return {'message': f'{imported}件の予定をインポートしました（スキップ: {skipped}件）'}
+
+def report_job_progress(job_id, progress):
+    """実行中のジョブの進捗（0〜100）を保存する。キャンセルが要求されていれば JobCancelled を送出"""
+    check_job_cancelled(job_id)
+    db.session.execute(Job.__table__.update().where(Job.__table__.c.id == job_id).values(progress=progress))
+    db.session.commit()
+
+def run_import_health_job(job_id, params):
+    path = params['path']
     try:
-        db_path = 'productivity.db'
-        if os.path.exists(db_path):
-            # バックアップファイル名に日時を付ける
-            backup_name = f'productivity_backup_{datetime.now().strftime("%Y%m%d_%H%M%S")}.db'
-            return send_file(db_path, as_attachment=True, download_name=backup_name)
+        days, samples, skipped = import_health_export(path, params.get('filename') or path,
+                                                      on_progress=lambda percent: report_job_progress(job_id, percent))
+    finally:
+        os.remove(path)
+    message = f'{samples}件の記録を{days}日分の健康記録として取り込みました'
+    if skipped:
+        message += f'（読み取れない値: {skipped}件）'
+    return {'message': message}
+
+def run_rebuild_habit_bitmaps_job(job_id, params):
+    return {'message': f'{rebuild_habit_bitmaps()}件のビットマップを作成しました'}
+
+def run_recompute_local_dates_job(job_id, params):
+    updated = backfill_local_dates(db.session.connection(), recompute=True)
+    db.session.commit()
+    return {'message': f'{updated}件の記録の日付を {current_timezone().key} で再計算しました'}
+
+JOB_HANDLERS = {
+    'backup': run_backup_job,
+    'export_json': run_export_json_job,
+    'import_ics': run_import_ics_job,
+    'import_health': run_import_health_job,
+    'rebuild_habit_bitmaps': run_rebuild_habit_bitmaps_job,
+    'recompute_local_dates': run_recompute_local_dates_job,
+}
+
+@app.route('/jobs')
+def jobs():
+    recent = Job.query.order_by(Job.created_at.desc(), Job.id.desc()).limit(20).all()
+    return render_template('jobs.html', jobs=[job.to_dict() for job in recent],
+                           highlight=request.args.get('highlight', type=int))
+
+@app.route('/jobs/<kind>', methods=['POST'])
+def start_job(kind):
+    # 引数が必要なジョブはそれぞれの画面（/calendar/import など）から開始する
+    if kind not in JOB_HANDLERS or kind in ('import_ics', 'import_health', 'archive_restore'):
+        return jsonify({'error': '不明なジョブです'}), 404
+    job = job_runner.submit(kind)
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(job.to_dict()), 202
+    flash(f'{JOB_LABELS[kind]}を開始しました', 'info')
+    return redirect(url_for('jobs', highlight=job.id))
+
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    job = db.get_or_404(Job, job_id)
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<int:job_id>/download')
+def download_job(job_id):
+    job = db.get_or_404(Job, job_id)
+    if job.status != 'succeeded' or not job.result_path or not os.path.exists(job.result_path):
+        flash('ダウンロードできるファイルがありません', 'error')
+        return redirect(url_for('jobs'))
+    return send_file(job.result_path, as_attachment=True, download_name=job.result_name,
+                     mimetype=job.result_mimetype)
+
+@app.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = db.get_or_404(Job, job_id)
+    if job.status in JOB_ACTIVE_STATUSES:
+        job_runner.cancel(job)
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(job.to_dict())
+    flash('キャンセルを受け付けました', 'info')
+    return redirect(url_for('jobs'))
+
+# Database Maintenance
+# 削除の多いテーブル（Task, Note, HabitLogなど）で断片化したファイルと、統計情報のない
+# クエリプランナーを定期的に手入れする。各DBファイルにsqlite3で直接つなぐのでシャードにも使える
+app.config['DB_MAINTENANCE_INTERVAL_HOURS'] = float(os.environ.get('DB_MAINTENANCE_INTERVAL_HOURS', 24))
+DB_MAINTENANCE_IDLE_SECONDS = 300  # 最後のリクエストからこの秒数たったら実行
+DB_MAINTENANCE_CHECK_SECONDS = 60
+DB_MAINTENANCE_VACUUM_PAGES = 1000  # 1回のincremental_vacuumで解放するページ数の上限
+SQLITE_AUTO_VACUUM_INCREMENTAL = 2
+
+def enable_incremental_vacuum(connection):
+    """テーブル作成前の新しいDBでのみ効く（既存DBの切り替えには VACUUM が必要）"""
+    connection.exec_driver_sql('PRAGMA auto_vacuum = INCREMENTAL')
+
+def database_stats(connection, path):
+    page_size = connection.execute('PRAGMA page_size').fetchone()[0]
+    page_count = connection.execute('PRAGMA page_count').fetchone()[0]
+    freelist = connection.execute('PRAGMA freelist_count').fetchone()[0]
+    return {
+        'file_size': os.path.getsize(path),
+        'page_size': page_size,
+        'page_count': page_count,
+        'freelist_pages': freelist,
+        'fragmentation': round(freelist / page_count * 100, 1) if page_count else 0.0,
+    }
+
+def maintain_database(path, vacuum_pages=DB_MAINTENANCE_VACUUM_PAGES, full_vacuum=False):
+    """quick_check・空きページの解放・統計の更新を行い、前後の状態を返す
+
+    full_vacuum=True のときはファイル全体を作り直し、auto_vacuum=INCREMENTAL に切り替える
+    （時間がかかりDBをロックするので、CLIから明示的に実行する場合のみ）
+    """
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        # WALに溜まった書き込みを先に本体へ書き戻し、前後のファイルサイズを同じ条件で比べる
+        connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        report = {'path': path, 'before': database_stats(connection, path)}
+        report['integrity'] = connection.execute('PRAGMA quick_check').fetchone()[0]
+        if report['integrity'] != 'ok':
+            # 壊れたDBを書き換えると悪化しかねないので、ここで止める
+            report['after'] = report['before']
+            return report
+        
+        auto_vacuum = connection.execute('PRAGMA auto_vacuum').fetchone()[0]
+        if full_vacuum:
+            connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            connection.execute('VACUUM')
+        elif auto_vacuum == SQLITE_AUTO_VACUUM_INCREMENTAL and vacuum_pages:
+            # execute()だと1ページしか進まないので、最後までステップするexecutescriptで実行
+            connection.executescript(f'PRAGMA incremental_vacuum({int(vacuum_pages)})')
+        report['auto_vacuum'] = connection.execute('PRAGMA auto_vacuum').fetchone()[0] == SQLITE_AUTO_VACUUM_INCREMENTAL
+        
+        # 統計がまだ一度もなければANALYZE、あれば必要なテーブルだけ更新するoptimize
+        has_stats = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'").fetchone()
+        connection.execute('PRAGMA optimize' if has_stats else 'ANALYZE')
+        connection.execute('UPDATE settings SET last_maintenance_at = ?', (datetime.utcnow().isoformat(' '),))
+        # WALに溜まった書き込みを本体に書き戻して、-walファイルを空にする
+        connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        report['after'] = database_stats(connection, path)
+        return report
+    finally:
+        connection.close()
+
+def maintenance_targets():
+    """メンテナンス対象のDBファイル（複数ユーザー運用時はすべてのシャード）"""
+    if not app.config['MULTI_USER']:
+        return [db.engine.url.database]
+    directory = app.config['SHARD_DIRECTORY']
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith('.db')]
+
+def format_maintenance_report(report):
+    before, after = report['before'], report['after']
+    return (f"{os.path.basename(report['path'])}: 整合性 {report['integrity']} / "
+            f"{before['file_size'] / 1024:.0f}KB → {after['file_size'] / 1024:.0f}KB / "
+            f"空きページ {before['freelist_pages']} → {after['freelist_pages']} / "
+            f"断片化 {before['fragmentation']}% → {after['fragmentation']}%")
+
+class MaintenanceScheduler:
+    """アプリがしばらく使われていない時に、間隔を空けて各DBのメンテナンスを行うスレッド"""
+    
+    def __init__(self):
+        self.last_request = time.monotonic()
+        self.last_run = {}
+        self.thread = None
+        self.lock = threading.Lock()
+    
+    def touch(self):
+        self.last_request = time.monotonic()
+        if self.thread is None and app.config['DB_MAINTENANCE_INTERVAL_HOURS'] > 0:
+            with self.lock:
+                if self.thread is None:
+                    # gunicornのforkより後に起動するよう、最初のリクエストで開始する
+                    self.thread = threading.Thread(target=self.loop, name='db-maintenance', daemon=True)
+                    self.thread.start()
+    
+    def loop(self):
+        while True:
+            time.sleep(DB_MAINTENANCE_CHECK_SECONDS)
+            if time.monotonic() - self.last_request < DB_MAINTENANCE_IDLE_SECONDS:
+                continue
+            with app.app_context():
+                self.run_due()
+    
+    def run_due(self):
+        interval = timedelta(hours=app.config['DB_MAINTENANCE_INTERVAL_HOURS'])
+        for path in maintenance_targets():
+            if time.monotonic() - self.last_request < DB_MAINTENANCE_IDLE_SECONDS:
+                return  # 使われ始めたら中断して次の空き時間に回す
+            if path not in self.last_run:
+                self.last_run[path] = last_maintenance_at(path)
+            if self.last_run[path] and datetime.utcnow() - self.last_run[path] < interval:
+                continue
+            try:
+                app.logger.info(format_maintenance_report(maintain_database(path)))
+            except sqlite3.Error:
+                app.logger.exception('%s のメンテナンスに失敗しました', path)
+            self.last_run[path] = datetime.utcnow()
+
+def last_maintenance_at(path):
+    connection = sqlite3.connect(path, timeout=30)
+    try:
+        row = connection.execute('SELECT last_maintenance_at FROM settings LIMIT 1').fetchone()
+    except sqlite3.Error:
+        return None
+    finally:
+        connection.close()
+    return datetime.fromisoformat(row[0]) if row and row[0] else None
+
+maintenance_scheduler = MaintenanceScheduler()
+
+@app.before_request
+def track_activity():
+    maintenance_scheduler.touch()
+
+def run_db_maintain_job(job_id, params):
+    reports = [maintain_database(current_database_path())]
+    return {'message': ' '.join(format_maintenance_report(report) for report in reports)}
+
+JOB_HANDLERS['db_maintain'] = run_db_maintain_job
+JOB_LABELS['db_maintain'] = 'データベースのメンテナンス'
+
+@app.cli.command('db-maintain')
+@click.option('--vacuum-pages', default=DB_MAINTENANCE_VACUUM_PAGES, show_default=True,
+              help='incremental_vacuum で解放するページ数の上限')
+@click.option('--full', is_flag=True, help='VACUUMでファイル全体を作り直し、auto_vacuumをINCREMENTALにする')
+def db_maintain_command(vacuum_pages, full):
+    """quick_check・空きページの解放・PRAGMA optimize を実行して結果を表示"""
+    targets = maintenance_targets()
+    if not targets:
+        click.echo('メンテナンス対象のデータベースがありません')
+        return
+    for path in targets:
+        report = maintain_database(path, vacuum_pages=vacuum_pages, full_vacuum=full)
+        click.echo(format_maintenance_report(report))
+        if not report['auto_vacuum'] and report['integrity'] == 'ok':
+            click.echo('  auto_vacuum が無効です。--full を付けて実行すると空き領域を少しずつ解放できるようになります')
+
+# Archive
+# 1行1イベントで増え続けるテーブルの古い行を、年ごとのgzip圧縮ファイル（JSON Lines）に移す。
+# 統計が全期間を対象にできるよう、日ごとの集計（ArchiveRollup）を残してから削除する
+app.config['ARCHIVE_AFTER_DAYS'] = int(os.environ.get('ARCHIVE_AFTER_DAYS', 730))
+app.config['ARCHIVE_DIRECTORY'] = os.environ.get('ARCHIVE_DIRECTORY') or os.path.join(app.instance_path, 'archive')
+ARCHIVE_BATCH_SIZE = 1000
+
+def pomodoro_rollup(row):
+    if row.completed and row.session_type == 'work':
+        return row.task_id or 0, '', 1, row.duration or 0
+    return None
+
+def habit_log_rollup(row):
+    return (row.habit_id, '', 1, 0) if row.completed is not False else None
+
+def time_entry_rollup(row):
+    return 0, row.project_name or '', 1, row.duration_minutes or 0
+
+def learning_session_rollup(row):
+    return row.learning_item_id, '', 1, row.duration or 0
+
+# テーブル名: (モデル, 日付の列, 集計関数 → (参照ID, ラベル, 件数, 量) または None)
+ARCHIVE_SOURCES = {
+    'pomodoro_session': (PomodoroSession, PomodoroSession.local_date, pomodoro_rollup),
+    'habit_log': (HabitLog, HabitLog.date, habit_log_rollup),
+    'time_entry': (TimeEntry, TimeEntry.local_date, time_entry_rollup),
+    'learning_session': (LearningSession, LearningSession.date, learning_session_rollup),
+}
+
+def archive_directory():
+    """DBファイルごとのアーカイブ置き場（シャードごとに分かれる）"""
+    name = os.path.splitext(os.path.basename(current_database_path()))[0]
+    return os.path.join(app.config['ARCHIVE_DIRECTORY'], name)
+
+def archive_path(year):
+    return os.path.join(archive_directory(), f'{year}.jsonl.gz')
+
+def archived_years():
+    directory = archive_directory()
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(name.split('.')[0]) for name in os.listdir(directory) if name.endswith('.jsonl.gz'))
+
+def append_archive(year, lines):
+    """gzipのメンバーを追記する（複数回に分けてアーカイブしても1ファイルとして読める）"""
+    os.makedirs(archive_directory(), exist_ok=True)
+    with open(archive_path(year), 'ab') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+            gz.write(''.join(lines).encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+
+def archive_cold_data(cutoff=None):
+    """cutoff より前の行をアーカイブに移す。テーブルごとの移動件数を返す
+
+    ファイルへの書き込みを先に済ませてから、集計の加算と行の削除を同じトランザクションで行う。
+    途中で止まっても行が失われることはなく、重複してファイルに入った行は読み込み時に除かれる
+    """
+    cutoff = cutoff or local_today() - timedelta(days=app.config['ARCHIVE_AFTER_DAYS'])
+    cutoff_time = datetime.combine(cutoff, datetime.min.time())
+    rollup_table = ArchiveRollup.__table__
+    moved = {}
+    for source, (model, date_column, rollup) in ARCHIVE_SOURCES.items():
+        table = model.__table__
+        condition = date_column < (cutoff_time if isinstance(date_column.type, db.DateTime) else cutoff)
+        if model is TimeEntry:
+            condition = condition & (TimeEntry.is_running.isnot(True))
+        moved[source] = 0
+        while True:
+            rows = db.session.execute(
+                db.select(table).where(condition).order_by(table.c.id).limit(ARCHIVE_BATCH_SIZE)).all()
+            if not rows:
+                break
+            
+            lines_by_year, totals = {}, {}
+            for row in rows:
+                day = getattr(row, date_column.key)
+                day = day.date() if isinstance(day, datetime) else day
+                record = {'table': source, 'row': {key: sync_value(value) for key, value in row._mapping.items()}}
+                lines_by_year.setdefault(day.year, []).append(json.dumps(record, ensure_ascii=False) + '\n')
+                values = rollup(row)
+                if values:
+                    ref_id, label, count, amount = values
+                    key = (day, ref_id, label)
+                    total = totals.get(key, (0, 0))
+                    totals[key] = (total[0] + count, total[1] + amount)
+            for year, lines in lines_by_year.items():
+                append_archive(year, lines)
+            
+            for (day, ref_id, label), (count, amount) in totals.items():
+                statement = sqlite_insert(rollup_table).values(
+                    source=source, day=day, ref_id=ref_id, label=label, count=count, amount=amount)
+                db.session.execute(statement.on_conflict_do_update(
+                    index_elements=['source', 'day', 'ref_id', 'label'],
+                    set_={'count': rollup_table.c.count + statement.excluded.count,
+                          'amount': rollup_table.c.amount + statement.excluded.amount}))
+            # Core のDELETEなのでマッパーイベントは発火しない（習慣のビットマップや同期済みの端末のデータは残る）
+            db.session.execute(table.delete().where(table.c.id.in_([row.id for row in rows])))
+            db.session.commit()
+            moved[source] += len(rows)
+    return moved
+
+def parse_archive_value(column, value):
+    if value is None:
+        return None
+    if isinstance(column.type, db.DateTime):
+        return datetime.fromisoformat(value)
+    if isinstance(column.type, db.Date):
+        return date.fromisoformat(value)
+    return value
+
+def read_archive(year, source=None):
+    """アーカイブから {テーブル名: [行の辞書, ...]} を読む（同じIDの重複は1つにまとめる）"""
+    path = archive_path(year)
+    if not os.path.exists(path):
+        return {}
+    rows = {}
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if source and record['table'] != source:
+                continue
+            rows.setdefault(record['table'], {})[record['row']['id']] = record['row']
+    return {name: sorted(by_id.values(), key=lambda row: row['id']) for name, by_id in rows.items()}
+
+def restore_archive(year):
+    """アーカイブした年の行を元のテーブルに戻し、その年の集計とファイルを削除する"""
+    restored = {}
+    for source, rows in read_archive(year).items():
+        table = ARCHIVE_SOURCES[source][0].__table__
+        values = [{column.name: parse_archive_value(column, row.get(column.name)) for column in table.columns}
+                  for row in rows]
+        for i in range(0, len(values), ARCHIVE_BATCH_SIZE):
+            db.session.execute(table.insert().prefix_with('OR IGNORE'), values[i:i + ARCHIVE_BATCH_SIZE])
+        restored[source] = len(values)
+    # 列を追加する前にアーカイブした行は、ここで計算する
+    backfill_local_dates(db.session.connection())
+    backfill_pomodoro_status(db.session.connection())
+    ArchiveRollup.query.filter(ArchiveRollup.day >= date(year, 1, 1),
+                               ArchiveRollup.day <= date(year, 12, 31)).delete(synchronize_session=False)
+    db.session.commit()
+    if os.path.exists(archive_path(year)):
+        os.remove(archive_path(year))
+    return restored
+
+def rollup_totals(source, start=None, end=None):
+    """アーカイブ済みの (件数, 量) の合計"""
+    query = db.session.query(db.func.coalesce(db.func.sum(ArchiveRollup.count), 0),
+                             db.func.coalesce(db.func.sum(ArchiveRollup.amount), 0)).filter(ArchiveRollup.source == source)
+    if start:
+        query = query.filter(ArchiveRollup.day >= start)
+    if end:
+        query = query.filter(ArchiveRollup.day <= end)
+    return query.one()
+
+def format_archive_counts(counts):
+    return '、'.join(f'{ARCHIVE_LABELS[source]} {count}件' for source, count in counts.items())
+
+ARCHIVE_LABELS = {
+    'pomodoro_session': 'ポモドーロ',
+    'habit_log': '習慣の記録',
+    'time_entry': '時間記録',
+    'learning_session': '学習記録',
+}
+
+def run_archive_job(job_id, params):
+    return {'message': f'アーカイブしました: {format_archive_counts(archive_cold_data())}'}
+
+def run_archive_restore_job(job_id, params):
+    return {'message': f"{params['year']}年を復元しました: {format_archive_counts(restore_archive(params['year']))}"}
+
+JOB_HANDLERS['archive'] = run_archive_job
+JOB_HANDLERS['archive_restore'] = run_archive_restore_job
+JOB_LABELS['archive'] = '古い記録のアーカイブ'
+JOB_LABELS['archive_restore'] = 'アーカイブの復元'
+
+@app.route('/archive')
+@app.route('/archive/<int:year>')
+def archive_view(year=None):
+    """アーカイブした古い記録の閲覧（年を選んだ時だけファイルを読む）"""
+    years = archived_years()
+    source = request.args.get('table') if request.args.get('table') in ARCHIVE_SOURCES else 'pomodoro_session'
+    rows = read_archive(year, source).get(source, []) if year in years else []
+    return render_template('archive.html', years=years, year=year, source=source, rows=rows,
+                           labels=ARCHIVE_LABELS, after_days=app.config['ARCHIVE_AFTER_DAYS'])
+
+@app.route('/api/archive/<int:year>')
+def api_archive(year):
+    source = request.args.get('table')
+    if source and source not in ARCHIVE_SOURCES:
+        return jsonify({'error': '不明なテーブルです'}), 400
+    return jsonify(read_archive(year, source))
+
+@app.route('/archive/<int:year>/restore', methods=['POST'])
+def restore_archive_year(year):
+    if year not in archived_years():
+        flash('その年のアーカイブはありません', 'error')
+        return redirect(url_for('archive_view'))
+    job = job_runner.submit('archive_restore', year=year)
+    flash(f'{year}年の記録の復元を開始しました', 'info')
+    return redirect(url_for('jobs', highlight=job.id))
+
+def archive_targets(username=None):
+    """CLIで処理するシャード（単一ユーザー運用では既定のDBのみ）"""
+    if not app.config['MULTI_USER']:
+        return [None]
+    users = User.query.filter_by(username=username) if username else User.query.order_by(User.id)
+    return [user.shard for user in users]
+
+@app.cli.command('archive')
+@click.option('--days', type=int, help='この日数より古い記録を移す（既定は ARCHIVE_AFTER_DAYS）')
+@click.option('--restore', 'restore_year', type=int, help='指定した年のアーカイブを元のテーブルに戻す')
+@click.option('--user', 'username', help='複数ユーザー運用時に対象を1人に絞る')
+def archive_command(days, restore_year, username):
+    """古いポモドーロ・習慣・時間・学習の記録を年ごとの圧縮ファイルに移す"""
+    for shard in archive_targets(username):
+        g.shard = shard
+        prefix = f'{shard}: ' if shard else ''
+        if restore_year:
+            click.echo(f'{prefix}{restore_year}年を復元しました: {format_archive_counts(restore_archive(restore_year))}')
         else:
-            flash('データベースファイルが見つかりません', 'error')
-            return redirect(url_for('settings'))
-    except Exception as e:
-        flash(f'バックアップエラー: {str(e)}', 'error')
+            # 「今日」はユーザーのタイムゾーンで決まるので、シャードごとに計算する
+            cutoff = local_today() - timedelta(days=days) if days else None
+            click.echo(f'{prefix}アーカイブしました: {format_archive_counts(archive_cold_data(cutoff))}')
+
+# Backup and Export
+def current_database_path():
+    """このリクエストのデータが入っているSQLiteファイルのパス"""
+    if g.get('shard'):
+        return shard_engines.path(g.shard)
+    return db.engine.url.database
+
+@app.route('/backup', methods=['POST'])
+def backup_database():
+    """データベースのバックアップをバックグラウンドで作成"""
+    if not os.path.exists(current_database_path()):
+        flash('データベースファイルが見つかりません', 'error')
         return redirect(url_for('settings'))
+    return start_job('backup')
 
 @app.route('/terms')
 def terms():
@@ -1053,48 +4458,41 @@ def faq():
     """よくある質問ページ"""
     return render_template('faq.html')
 
-@app.route('/export/json')
+# JSONエクスポートの各項目（キー, 作成関数）
+EXPORT_SECTIONS = [
+    ('tasks', lambda: [{'id': t.id, 'title': t.title, 'status': t.status,
+                        'priority': t.priority, 'created_at': t.created_at.isoformat() if t.created_at else None}
+                       for t in Task.query.all()]),
+    ('habits', lambda: [{'id': h.id, 'name': h.name, 'frequency': h.frequency}
+                        for h in Habit.query.all()]),
+    ('health_logs', lambda: [{'id': h.id, 'date': h.date.isoformat() if h.date else None,
+                              'weight': h.weight, 'exercise_minutes': h.exercise_minutes}
+                             for h in HealthLog.query.all()]),
+    ('learning_items', lambda: [{'id': l.id, 'title': l.title, 'progress': l.progress,
+                                 'total_hours': l.total_hours}
+                                for l in LearningItem.query.all()]),
+    ('journal_entries', lambda: [{'id': j.id, 'title': j.title, 'date': j.date.isoformat() if j.date else None}
+                                 for j in JournalEntry.query.all()]),
+    ('events', lambda: [{'id': e.id, 'title': e.title, 'category': e.category,
+                         'start_time': e.start_time.isoformat() if e.start_time else None}
+                        for e in CalendarEvent.query.all()]),
+    ('goals', lambda: [{'id': g.id, 'title': g.title, 'progress': g.progress, 'status': g.status}
+                       for g in Goal.query.all()]),
+    ('notes', lambda: [{'id': n.id, 'title': n.title, 'content': n.content}
+                       for n in Note.query.all()]),
+]
+
+@app.route('/export/json', methods=['POST'])
 def export_json():
-    """すべてのデータをJSONでエクスポート"""
-    try:
-        data = {
-            'export_date': datetime.now().isoformat(),
-            'tasks': [{'id': t.id, 'title': t.title, 'status': t.status, 
-                      'priority': t.priority, 'created_at': t.created_at.isoformat() if t.created_at else None}
-                     for t in Task.query.all()],
-            'habits': [{'id': h.id, 'name': h.name, 'frequency': h.frequency}
-                      for h in Habit.query.all()],
-            'health_logs': [{'id': h.id, 'date': h.date.isoformat() if h.date else None,
-                           'weight': h.weight, 'exercise_minutes': h.exercise_minutes}
-                          for h in HealthLog.query.all()],
-            'learning_items': [{'id': l.id, 'title': l.title, 'progress': l.progress,
-                              'total_hours': l.total_hours}
-                             for l in LearningItem.query.all()],
-            'journal_entries': [{'id': j.id, 'title': j.title, 'date': j.date.isoformat() if j.date else None}
-                              for j in JournalEntry.query.all()],
-            'events': [{'id': e.id, 'title': e.title, 'category': e.category,
-                       'start_time': e.start_time.isoformat() if e.start_time else None}
-                      for e in CalendarEvent.query.all()],
-            'goals': [{'id': g.id, 'title': g.title, 'progress': g.progress, 'status': g.status}
-                     for g in Goal.query.all()],
-            'notes': [{'id': n.id, 'title': n.title, 'content': n.content}
-                     for n in Note.query.all()]
-        }
-        
-        # JSONファイルとして返す
-        json_data = json.dumps(data, ensure_ascii=False, indent=2)
-        buffer = BytesIO(json_data.encode('utf-8'))
-        buffer.seek(0)
-        
-        filename = f'productivity_data_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-        return send_file(buffer, as_attachment=True, download_name=filename, mimetype='application/json')
-    except Exception as e:
-        flash(f'エクスポートエラー: {str(e)}', 'error')
-        return redirect(url_for('settings'))
+    """すべてのデータのJSONエクスポートをバックグラウンドで作成"""
+    return start_job('export_json')
 
-if __name__ == '__main__':
+# スキーマが変わっていなければ PRAGMA user_version を読むだけなので、起動のたびに実行しても軽い
+if app.config['INIT_DATABASE_ON_IMPORT']:
     with app.app_context():
-        db.create_all()
+        init_database()
+
+if __name__ == '__main__':
     # 本番環境とローカル環境の両方に対応
     port = int(os.environ.get('PORT', 5001))
     debug = os.environ.get('FLASK_ENV') != 'production'
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+読み書きの分離の効果を測るベンチマーク
+一時フォルダのDBにデータを入れ、同じDBを使うサーバーを2プロセス（gunicornの2ワーカー相当）起動する。
+一方に書き込み（ポモドーロの開始→完了）を連続で送っている間の、もう一方での
+読み取りのページ（統計・カレンダー・日記）の応答時間を計測する
+
+    python bench_concurrency.py                # 分離あり（WAL＋読み取り専用エンジン）と従来の構成を比較
+    python bench_concurrency.py --seconds 10 --writers 4
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+READ_PATHS = ('/statistics', '/calendar', '/journal')
+MODES = {
+    'split': '分離あり（WAL＋読み取り専用エンジン）',
+    'single': '従来（1つのエンジン・ロールバックジャーナル）',
+}
+
+
+def seed(app_module, days):
+    """読み取りのページが実際に集計する程度のデータを入れる"""
+    from datetime import datetime, timedelta
+    A = app_module
+    settings = A.get_settings()
+    settings.terms_accepted = True
+    now = datetime.utcnow()
+    for day in range(days):
+        started = now - timedelta(days=day)
+        A.db.session.add_all(A.PomodoroSession(duration=25, session_type='work', completed=True, status='completed',
+                                               started_at=started - timedelta(hours=hour), ended_at=started)
+                             for hour in range(8))
+        A.db.session.add(A.Task(title=f'タスク{day}', status='completed', completed_at=started))
+        A.db.session.add(A.JournalEntry(title=f'日記{day}', content='今日の振り返り' * 20, date=started.date()))
+        A.db.session.add(A.CalendarEvent(title=f'予定{day}', start_time=started, end_time=started + timedelta(hours=1)))
+    A.db.session.commit()
+
+
+def request(url, data=None):
+    body = None if data is None else json.dumps(data).encode()
+    req = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'} if body else {})
+    with urllib.request.urlopen(req, timeout=30) as response:
+        return response.read()
+
+
+def measure_reads(url, seconds, readers):
+    """readers本のスレッドで読み取りのページを順に開き、応答時間（ミリ秒）を集める"""
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def read_loop(offset):
+        index = offset
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            request(url + READ_PATHS[index % len(READ_PATHS)])
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                latencies.append(elapsed)
+            index += 1
+
+    threads = [threading.Thread(target=read_loop, args=(offset,)) for offset in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def hammer_writes(url, stop, counter):
+    """止めるまでポモドーロの開始→完了を送り続ける"""
+    while not stop.is_set():
+        session_id = json.loads(request(url + '/api/pomodoro/start', {'session_type': 'work'}))['session_id']
+        request(url + f'/api/pomodoro/complete/{session_id}', {})
+        counter.append(1)
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'p50': statistics.median(latencies),
+        'p95': latencies[int(len(latencies) * 0.95) - 1],
+        'max': latencies[-1],
+    }
+
+
+def serve(args):
+    """このプロセスでサーバーを起動し、ポート番号を出力して待つ（--serve で呼ばれる）"""
+    from sqlalchemy import event
+    from werkzeug.serving import make_server
+    import app as A
+
+    A.app.config['WTF_CSRF_ENABLED'] = False
+    with A.app.app_context():
+        if os.environ['SQLITE_READ_ENGINE'] == '0':
+            # 変更前の構成を再現: WALにせず、GETも書き込み用のエンジンで読む
+            event.remove(A.db.engine, 'connect', A.use_wal)
+        A.init_database()
+        if args.days:
+            seed(A, args.days)
+    server = make_server('127.0.0.1', 0, A.app, threaded=True)
+    print(server.server_port, flush=True)
+    server.serve_forever()
+
+
+def start_server(env, days=0):
+    """gunicornのワーカーのように、同じDBファイルを使うサーバーを別プロセスで起動する"""
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', '--days', str(days)],
+                               cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return process, f'http://127.0.0.1:{int(process.stdout.readline())}'
+
+
+def run_mode(mode, args):
+    """読み取り用と書き込み用のサーバープロセスを起動し、書き込みなし・書き込み中の読み取りを計測する"""
+    with tempfile.TemporaryDirectory() as instance_path:
+        # ジョブの成果物やテンプレートのキャッシュも一時フォルダに置き、手元のデータに触れない
+        # WALに切り替える前に接続のフックを外せるよう、importの時点ではDBを準備しない
+        env = dict(os.environ, INSTANCE_PATH=instance_path, SQLITE_READ_ENGINE='1' if mode == 'split' else '0',
+                   INIT_DATABASE_ON_IMPORT='0')
+        reader, read_url = start_server(env, args.days)
+        writer, write_url = start_server(env)
+        try:
+            measure_reads(read_url, 1, args.readers)  # テンプレートのコンパイルなどを済ませる
+            result = {'idle': summarize(measure_reads(read_url, args.seconds, args.readers))}
+            stop, writes = threading.Event(), []
+            threads = [threading.Thread(target=hammer_writes, args=(write_url, stop, writes))
+                       for _ in range(args.writers)]
+            for thread in threads:
+                thread.start()
+            result['writing'] = summarize(measure_reads(read_url, args.seconds, args.readers))
+            stop.set()
+            for thread in threads:
+                thread.join()
+            result['writes_per_second'] = len(writes) / args.seconds
+        finally:
+            for process in (reader, writer):
+                process.terminate()
+                process.wait()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='読み取りのページの応答時間を、書き込みの有無で比較する')
+    parser.add_argument('--seconds', type=float, default=5, help='各計測の時間（秒）')
+    parser.add_argument('--readers', type=int, default=2, help='読み取りを送るスレッド数')
+    parser.add_argument('--writers', type=int, default=2, help='書き込みを送るスレッド数')
+    parser.add_argument('--days', type=int, default=365, help='入れておくデータの日数')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    print(f'読み取り {args.readers}スレッド・書き込み {args.writers}スレッド・各 {args.seconds:g}秒')
+    if (os.cpu_count() or 1) < 3:
+        print('注意: CPUが3コア未満のため、書き込み中はCPUの取り合いでも読み取りが遅くなります')
+    for mode, label in MODES.items():
+        result = run_mode(mode, args)
+        print(f'\n{label}  書き込み {result["writes_per_second"]:.0f}件/秒')
+        for key, phase in (('idle', '書き込みなし'), ('writing', '書き込み中')):
+            stats = result[key]
+            print(f'  {phase:<8} 中央値 {stats["p50"]:7.1f} ms  95% {stats["p95"]:7.1f} ms  '
+                  f'最大 {stats["max"]:7.1f} ms  ({stats["count"]}回)')
+
+
+if __name__ == '__main__':
+    main()
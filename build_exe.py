@@ -2,23 +2,45 @@
 """
 デスクトップアプリ化スクリプト
 PyInstallerを使用してexeファイルを作成
+
+    python build_exe.py            # フォルダ形式（起動が速い・既定）
+    python build_exe.py --onefile  # 1つのexeファイル（起動のたびに展開するので遅い）
 """
 
-import PyInstaller.__main__
+import argparse
 import os
 
+import PyInstaller.__main__
+
 # アプリ名
 app_name = "LifeManagementApp"
 
+parser = argparse.ArgumentParser(description='デスクトップ版をビルド')
+parser.add_argument('--onefile', action='store_true', help='1つのexeファイルにまとめる')
+args = parser.parse_args()
+
+# コンパイル済みのテンプレートを同梱して、起動直後の描画を速くする
+os.environ['TEMPLATE_CACHE_DIR'] = os.path.abspath('template_cache')
+# ビルドするだけなのでDBは作らない
+os.environ['INIT_DATABASE_ON_IMPORT'] = '0'
+
+# オフラインでも画面が崩れないよう、CDNのライブラリを static に取り込んでからビルド
+from app import download_vendor_assets, build_assets, compile_templates
+download_vendor_assets()
+build_assets()
+compile_templates()
+
 # PyInstallerの設定
 PyInstaller.__main__.run([
-    'app.py',                           # メインファイル
+    'desktop.py',                       # メインファイル（サーバーを起動してブラウザを開く）
     '--name=%s' % app_name,             # アプリ名
-    '--onefile',                        # 1つのexeファイルに
+    '--onefile' if args.onefile else '--onedir',  # onedirは一時フォルダへの展開がなく起動が速い
     '--windowed',                       # コンソールウィンドウを非表示
     '--icon=icon.ico',                  # アイコン（作成が必要）
-    '--add-data=templates;templates',   # テンプレートフォルダを含める
-    '--add-data=static;static',         # 静的ファイルを含める（あれば）
+    f'--add-data=templates{os.pathsep}templates',  # テンプレートフォルダを含める
+    f'--add-data=static{os.pathsep}static',        # 静的ファイル（ライブラリとビルド済みのファイル）
+    f'--add-data=template_cache{os.pathsep}template_cache',  # コンパイル済みのテンプレート
+    '--hidden-import=app',
     '--hidden-import=flask',
     '--hidden-import=flask_sqlalchemy',
     '--hidden-import=flask_wtf',
@@ -26,4 +48,7 @@ PyInstaller.__main__.run([
 ])
 
 print("ビルド完了！")
-print(f"実行ファイル: dist/{app_name}.exe")
+if args.onefile:
+    print(f"実行ファイル: dist/{app_name}.exe")
+else:
+    print(f"実行ファイル: dist/{app_name}/{app_name}.exe（フォルダごと配布してください）")
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+デスクトップ版の起動スクリプト
+ローカルでサーバーを起動し、応答できるようになったらブラウザで開く
+
+    python desktop.py                 # 起動してブラウザを開く
+    python desktop.py --profile       # 起動にかかった時間の内訳を表示
+    python desktop.py --importtime    # モジュールごとのimport時間（上位）を表示
+    python desktop.py --benchmark 10  # 起動〜最初の応答までの時間を10回計測
+"""
+
+import time
+
+PROCESS_STARTED = time.perf_counter()
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import urllib.request
+
+# statistics・subprocess・tempfile・webbrowser は起動時間に含めないよう、使う関数の中でimportする
+
+APP_NAME = 'LifeManagementApp'
+STARTUP_TARGET_SECONDS = 1.0
+READY_PATH = '/terms-agreement'  # ログイン不要で、テンプレートとDBの両方を使うページ
+
+
+def data_directory():
+    """OSごとのユーザーデータの保存先"""
+    if sys.platform == 'win32':
+        base = os.environ.get('APPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Application Support')
+    else:
+        base = os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share')
+    return os.path.join(base, APP_NAME)
+
+
+def free_port(preferred):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        try:
+            sock.bind(('127.0.0.1', preferred))
+        except OSError:
+            sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def self_command(*args):
+    """このスクリプトを別プロセスで起動するコマンド（PyInstallerでビルドした実行ファイルにも対応）"""
+    if getattr(sys, 'frozen', False):
+        return [sys.executable, *args]
+    return [sys.executable, os.path.abspath(__file__), *args]
+
+
+def start(port):
+    """サーバーを起動して最初の応答を確認する。(server, thread, url, 起動時間の内訳（秒）) を返す"""
+    os.environ.setdefault('INSTANCE_PATH', data_directory())
+    # DBの準備はimportとは別に計測する
+    os.environ['INIT_DATABASE_ON_IMPORT'] = '0'
+    os.makedirs(os.environ['INSTANCE_PATH'], exist_ok=True)
+    if getattr(sys, 'frozen', False):
+        # ビルド時にコンパイルして同梱したテンプレートを使う
+        os.environ.setdefault('TEMPLATE_CACHE_DIR', os.path.join(sys._MEIPASS, 'template_cache'))
+    timings = {}
+
+    started = time.perf_counter()
+    from werkzeug.serving import make_server
+    from app import app, init_database
+    timings['import'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with app.app_context():
+        init_database()
+    timings['init_database'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f'http://127.0.0.1:{port}'
+    with urllib.request.urlopen(url + READY_PATH, timeout=10) as response:
+        response.read()
+    timings['first_response'] = time.perf_counter() - started
+    timings['total'] = time.perf_counter() - PROCESS_STARTED
+    return server, thread, url, timings
+
+
+def print_profile(timings):
+    print('起動時間の内訳')
+    for key, label in (('import', 'Flask・SQLAlchemy・アプリのimport'), ('init_database', 'DBの準備'),
+                       ('first_response', 'サーバー起動〜最初の応答'), ('total', '合計（スクリプト開始から）')):
+        print(f'  {label:<28} {timings[key] * 1000:8.1f} ms')
+
+
+def print_importtime(limit=15):
+    """python -X importtime の結果を、累積時間の大きいモジュール順に表示"""
+    import subprocess
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = [part.strip() for part in line[len('import time:'):].split('|', 2)]
+        rows.append((int(cumulative_us), int(self_us), name))
+    print(f'{"累積(ms)":>10} {"単体(ms)":>10}  モジュール')
+    for cumulative_us, self_us, name in sorted(rows, reverse=True)[:limit]:
+        print(f'{cumulative_us / 1000:10.1f} {self_us / 1000:10.1f}  {name}')
+
+
+def benchmark(runs):
+    """新しいプロセスで起動〜最初の応答までを計測（1回目はDB作成を含むので別に表示）"""
+    import statistics
+    import subprocess
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as instance_path:
+        env = dict(os.environ, INSTANCE_PATH=instance_path)
+        results = []
+        for _ in range(runs + 1):
+            started = time.perf_counter()
+            output = subprocess.run(self_command('--exit-when-ready', '--json', '--port', '0'),
+                                    env=env, capture_output=True, text=True, check=True).stdout
+            wall = time.perf_counter() - started
+            results.append(dict(json.loads(output.strip().splitlines()[-1]), wall=wall))
+
+    first, rest = results[0], results[1:]
+    print(f'初回（DB作成あり）: {first["wall"] * 1000:.0f} ms')
+    for key, label in (('wall', 'プロセス起動〜最初の応答'), ('import', 'import'), ('init_database', 'DBの準備'),
+                       ('first_response', '最初の応答')):
+        values = [result[key] * 1000 for result in rest]
+        print(f'{label:<20} 中央値 {statistics.median(values):7.1f} ms  最大 {max(values):7.1f} ms')
+    median = statistics.median(result['wall'] for result in rest)
+    print(f'目標 {STARTUP_TARGET_SECONDS:.1f}秒: {"達成" if median < STARTUP_TARGET_SECONDS else "未達"}')
+    return median
+
+
+def main():
+    parser = argparse.ArgumentParser(description='総合ライフマネジメントアプリ（デスクトップ版）')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5001)))
+    parser.add_argument('--no-browser', action='store_true', help='ブラウザを開かない')
+    parser.add_argument('--profile', action='store_true', help='起動時間の内訳を表示')
+    parser.add_argument('--importtime', action='store_true', help='import時間の上位を表示して終了')
+    parser.add_argument('--benchmark', type=int, metavar='N', help='起動時間をN回計測して終了')
+    parser.add_argument('--exit-when-ready', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--json', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if sys.stdout is None:  # PyInstallerの --windowed ではコンソールがない
+        sys.stdout = sys.stderr = open(os.devnull, 'w')
+
+    if args.importtime:
+        print_importtime()
+        return
+    if args.benchmark:
+        benchmark(args.benchmark)
+        return
+
+    server, thread, url, timings = start(free_port(args.port))
+    if args.json:
+        print(json.dumps(timings))
+    elif args.profile:
+        print_profile(timings)
+    if args.exit_when_ready:
+        # shutdown() はserve_foreverのポーリング（0.5秒）を待つので、計測用の終了ではそのまま抜ける
+        server.server_close()
+        return
+
+    if not args.no_browser:
+        import webbrowser
+        webbrowser.open(url)
+    print(f'{url} で起動しました（{timings["total"]:.2f}秒）。終了するには Ctrl+C を押してください')
+    try:
+        thread.join()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+// Service Worker（/sw.js から配信、キャッシュ名は静的ファイルが変わるたびに変わる）
+const VERSION = {{ version|tojson }};
+const SHELL_CACHE = `shell-${VERSION}`;
+const RUNTIME_CACHE = 'runtime';
+const SHELL_PAGES = {{ shell_pages|tojson }};
+const SHELL_ASSETS = {{ shell_assets|tojson }};
+const QUEUED_PATHS = {{ queued_paths|tojson }}.map(pattern => new RegExp(pattern));
+const QUEUED_AT_HEADER = {{ queued_at_header|tojson }};
+const OUTBOX_DB = 'offline-outbox';
+const OUTBOX_STORE = 'requests';
+const SYNC_TAG = 'outbox';
+
+self.addEventListener('install', event => {
+    event.waitUntil(caches.open(SHELL_CACHE).then(cache =>
+        // 1つ取得できなくてもインストールは続ける（CDNに届かない環境や、ログイン画面へのリダイレクトなど）
+        Promise.all([...SHELL_PAGES, ...SHELL_ASSETS].map(url => fetch(url).then(response => {
+            if (response.ok && !response.redirected) {
+                return cache.put(url, response);
+            }
+        }).catch(() => null)))
+    ).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(caches.keys()
+        .then(keys => Promise.all(keys.filter(key => key.startsWith('shell-') && key !== SHELL_CACHE)
+            .map(key => caches.delete(key))))
+        .then(() => self.clients.claim())
+        .then(replayOutbox));
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    const url = new URL(request.url);
+
+    if (request.method === 'POST' && url.origin === location.origin
+            && QUEUED_PATHS.some(pattern => pattern.test(url.pathname))) {
+        event.respondWith(fetchOrQueue(request));
+        return;
+    }
+    if (request.method !== 'GET') {
+        return;
+    }
+    if (request.mode === 'navigate') {
+        event.respondWith(SHELL_PAGES.includes(url.pathname) ? staleWhileRevalidate(request) : networkFirst(request));
+        return;
+    }
+    if (SHELL_ASSETS.includes(url.origin === location.origin ? url.pathname : request.url)
+            || url.pathname.startsWith('/assets/')) {
+        event.respondWith(cacheFirst(request));
+    }
+});
+
+// 骨組みの画面はキャッシュから即座に表示し、裏で最新に更新する
+function staleWhileRevalidate(request) {
+    return caches.open(SHELL_CACHE).then(cache => cache.match(request, {ignoreSearch: true}).then(cached => {
+        const network = fetch(request).then(response => {
+            if (response.ok && !response.redirected) {
+                cache.put(request, response.clone());
+            }
+            return response;
+        });
+        return cached || network.catch(() => caches.match('/offline'));
+    }));
+}
+
+function networkFirst(request) {
+    return fetch(request).then(response => {
+        if (response.ok && !response.redirected) {
+            const copy = response.clone();
+            caches.open(RUNTIME_CACHE).then(cache => cache.put(request, copy));
+        }
+        return response;
+    }).catch(() => caches.match(request).then(cached => cached || caches.match('/offline')));
+}
+
+// ハッシュ付きのファイルは中身が変わらないのでキャッシュを優先
+function cacheFirst(request) {
+    return caches.match(request).then(cached => cached || fetch(request).then(response => {
+        if (response.ok) {
+            const copy = response.clone();
+            caches.open(SHELL_CACHE).then(cache => cache.put(request, copy));
+        }
+        return response;
+    }));
+}
+
+function fetchOrQueue(request) {
+    const copy = request.clone();
+    return fetch(request).catch(() => queueRequest(copy).then(() => {
+        if (self.registration.sync) {
+            self.registration.sync.register(SYNC_TAG).catch(() => null);
+        }
+        if (request.mode === 'navigate') {
+            return Response.redirect(request.referrer || '/offline', 303);
+        }
+        return new Response(JSON.stringify({success: true, queued: true}), {
+            status: 202,
+            headers: {'Content-Type': 'application/json'}
+        });
+    }));
+}
+
+function openOutbox() {
+    return new Promise((resolve, reject) => {
+        const open = indexedDB.open(OUTBOX_DB, 1);
+        open.onupgradeneeded = () => open.result.createObjectStore(OUTBOX_STORE, {keyPath: 'id', autoIncrement: true});
+        open.onsuccess = () => resolve(open.result);
+        open.onerror = () => reject(open.error);
+    });
+}
+
+function outboxTransaction(mode, work) {
+    return openOutbox().then(db => new Promise((resolve, reject) => {
+        const transaction = db.transaction(OUTBOX_STORE, mode);
+        const result = work(transaction.objectStore(OUTBOX_STORE));
+        transaction.oncomplete = () => resolve(result.result);
+        transaction.onerror = () => reject(transaction.error);
+    }));
+}
+
+function queueRequest(request) {
+    return request.text().then(body => outboxTransaction('readwrite', store => store.add({
+        url: request.url,
+        method: request.method,
+        headers: [...request.headers.entries()],
+        body: body,
+        queuedAt: Date.now()
+    })));
+}
+
+let replaying = null;
+
+// キューに入れた順に再送。ネットワークエラーなら残して次の機会に回す
+function replayOutbox() {
+    if (replaying) {
+        return replaying;
+    }
+    replaying = outboxTransaction('readonly', store => store.getAll()).then(entries => entries.reduce(
+        (chain, entry) => chain.then(() => {
+            const headers = new Headers(entry.headers);
+            headers.set(QUEUED_AT_HEADER, String(entry.queuedAt));
+            return fetch(entry.url, {method: entry.method, headers: headers, body: entry.body || undefined,
+                                     credentials: 'same-origin'})
+                // サーバーが応答した（エラーを含む）ものは再送しても結果が変わらないので削除
+                .then(() => outboxTransaction('readwrite', store => store.delete(entry.id)));
+        }), Promise.resolve()
+    )).then(notifyClients, () => null).finally(() => { replaying = null; });
+    return replaying;
+}
+
+function notifyClients() {
+    return self.clients.matchAll().then(clients =>
+        clients.forEach(client => client.postMessage({type: 'outbox-replayed'})));
+}
+
+self.addEventListener('sync', event => {
+    if (event.tag === SYNC_TAG) {
+        event.waitUntil(replayOutbox());
+    }
+});
+
+self.addEventListener('message', event => {
+    if (event.data && event.data.type === 'online') {
+        event.waitUntil(replayOutbox());
+    }
+    if (event.data && event.data.type === 'logout') {
+        // 別のユーザーに前のユーザーの画面を見せないよう、画面のキャッシュを消す
+        event.waitUntil(caches.keys().then(keys => Promise.all(keys.map(key => caches.delete(key)))));
+    }
+});
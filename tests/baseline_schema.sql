@@ -0,0 +1,162 @@
+-- 変更前（データベースのマイグレーションを導入する前）のアプリが作っていたテーブル
+
+CREATE TABLE settings (
+	id INTEGER NOT NULL,
+	pomodoro_work_duration INTEGER,
+	pomodoro_break_duration INTEGER,
+	pomodoro_long_break_duration INTEGER,
+	terms_accepted BOOLEAN,
+	terms_accepted_at DATETIME,
+	PRIMARY KEY (id)
+);
+CREATE TABLE task (
+	id INTEGER NOT NULL,
+	title VARCHAR(200) NOT NULL,
+	description TEXT,
+	priority VARCHAR(20),
+	status VARCHAR(20),
+	estimated_pomodoros INTEGER,
+	completed_pomodoros INTEGER,
+	due_date DATETIME,
+	created_at DATETIME,
+	completed_at DATETIME,
+	PRIMARY KEY (id)
+);
+CREATE TABLE habit (
+	id INTEGER NOT NULL,
+	name VARCHAR(100) NOT NULL,
+	description TEXT,
+	frequency VARCHAR(20),
+	color VARCHAR(20),
+	created_at DATETIME,
+	PRIMARY KEY (id)
+);
+CREATE TABLE health_log (
+	id INTEGER NOT NULL,
+	date DATE,
+	weight FLOAT,
+	exercise_minutes INTEGER,
+	water_intake INTEGER,
+	sleep_hours FLOAT,
+	mood VARCHAR(20),
+	note TEXT,
+	PRIMARY KEY (id)
+);
+CREATE TABLE learning_item (
+	id INTEGER NOT NULL,
+	title VARCHAR(200) NOT NULL,
+	category VARCHAR(50),
+	description TEXT,
+	status VARCHAR(20),
+	progress INTEGER,
+	total_hours FLOAT,
+	target_date DATETIME,
+	created_at DATETIME,
+	completed_at DATETIME,
+	PRIMARY KEY (id)
+);
+CREATE TABLE journal_entry (
+	id INTEGER NOT NULL,
+	title VARCHAR(200),
+	content TEXT NOT NULL,
+	mood VARCHAR(20),
+	tags VARCHAR(200),
+	date DATE,
+	created_at DATETIME,
+	PRIMARY KEY (id)
+);
+CREATE TABLE goal (
+	id INTEGER NOT NULL,
+	title VARCHAR(200) NOT NULL,
+	description TEXT,
+	goal_type VARCHAR(20),
+	target_date DATETIME,
+	progress INTEGER,
+	status VARCHAR(20),
+	created_at DATETIME,
+	completed_at DATETIME,
+	PRIMARY KEY (id)
+);
+CREATE TABLE reminder (
+	id INTEGER NOT NULL,
+	title VARCHAR(200) NOT NULL,
+	description TEXT,
+	reminder_type VARCHAR(20),
+	reminder_time TIME,
+	days_of_week VARCHAR(50),
+	is_active BOOLEAN,
+	created_at DATETIME,
+	PRIMARY KEY (id)
+);
+CREATE TABLE achievement (
+	id INTEGER NOT NULL,
+	name VARCHAR(100) NOT NULL,
+	description TEXT,
+	badge_type VARCHAR(50),
+	requirement INTEGER,
+	icon VARCHAR(50),
+	unlocked_at DATETIME,
+	PRIMARY KEY (id)
+);
+CREATE TABLE note (
+	id INTEGER NOT NULL,
+	title VARCHAR(200),
+	content TEXT NOT NULL,
+	tags VARCHAR(200),
+	is_pinned BOOLEAN,
+	created_at DATETIME,
+	updated_at DATETIME,
+	PRIMARY KEY (id)
+);
+CREATE TABLE time_entry (
+	id INTEGER NOT NULL,
+	project_name VARCHAR(100) NOT NULL,
+	description TEXT,
+	start_time DATETIME NOT NULL,
+	end_time DATETIME,
+	duration_minutes INTEGER,
+	is_running BOOLEAN,
+	PRIMARY KEY (id)
+);
+CREATE TABLE calendar_event (
+	id INTEGER NOT NULL,
+	title VARCHAR(200) NOT NULL,
+	description TEXT,
+	category VARCHAR(50),
+	start_time DATETIME NOT NULL,
+	end_time DATETIME,
+	location VARCHAR(200),
+	reminder_sent BOOLEAN,
+	created_at DATETIME,
+	PRIMARY KEY (id)
+);
+CREATE TABLE pomodoro_session (
+	id INTEGER NOT NULL,
+	duration INTEGER NOT NULL,
+	session_type VARCHAR(20),
+	started_at DATETIME,
+	completed BOOLEAN,
+	task_id INTEGER,
+	PRIMARY KEY (id),
+	FOREIGN KEY(task_id) REFERENCES task (id)
+);
+CREATE TABLE habit_log (
+	id INTEGER NOT NULL,
+	habit_id INTEGER NOT NULL,
+	completed BOOLEAN,
+	note TEXT,
+	date DATE,
+	created_at DATETIME,
+	PRIMARY KEY (id),
+	FOREIGN KEY(habit_id) REFERENCES habit (id)
+);
+CREATE TABLE learning_session (
+	id INTEGER NOT NULL,
+	learning_item_id INTEGER NOT NULL,
+	duration FLOAT NOT NULL,
+	note TEXT,
+	date DATE,
+	created_at DATETIME,
+	PRIMARY KEY (id),
+	FOREIGN KEY(learning_item_id) REFERENCES learning_item (id)
+);
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+テスト共通の準備
+app はimport時に INSTANCE_PATH のDBを使うので、import前に一時フォルダを指定する
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline_schema.sql')
+
+os.environ['INSTANCE_PATH'] = tempfile.mkdtemp(prefix='productivity-test-')
+os.environ['INIT_DATABASE_ON_IMPORT'] = '0'
+os.environ['DB_MAINTENANCE_INTERVAL_HOURS'] = '0'  # 空き時間のメンテナンスのスレッドを起動しない
+os.environ.pop('MULTI_USER', None)
+sys.path.insert(0, ROOT)
+
+import app as app_module  # noqa: E402
+
+
+def database_path():
+    with app_module.app.app_context():
+        return app_module.db.engine.url.database
+
+
+def remove_database():
+    """エンジンの接続を閉じて、DBファイル（-wal・-shm を含む）を削除する"""
+    with app_module.app.app_context():
+        app_module.db.session.remove()
+        path = app_module.db.engine.url.database
+        app_module.read_engines.close(path)
+        app_module.db.engine.dispose()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    app_module.pomodoro_registry.sessions.clear()
+    return path
+
+
+def create_baseline_database(path):
+    """変更前のアプリが作っていたテーブルだけのDBを作る"""
+    connection = sqlite3.connect(path)
+    with open(BASELINE_SCHEMA, encoding='utf-8') as f:
+        connection.executescript(f.read())
+    connection.commit()
+    return connection
+
+
+@pytest.fixture(autouse=True)
+def no_pomodoro_sweeper(monkeypatch):
+    # 期限切れのセッションを整理するスレッドが、テストの途中でDBを書き換えないようにする
+    monkeypatch.setattr(app_module.pomodoro_sweeper, 'start', lambda: None)
+
+
+@pytest.fixture
+def app():
+    """空のDBを用意し、利用規約に同意した状態のアプリ"""
+    remove_database()
+    app_module.app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    with app_module.app.app_context():
+        app_module.init_database()
+        app_module.get_settings().terms_accepted = True
+        app_module.db.session.commit()
+    yield app_module
+    remove_database()
+
+
+@pytest.fixture
+def client(app):
+    return app.app.test_client()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""タスク・習慣・学習項目を紐付けた目標の進捗"""
+
+
+def create(app, *objects):
+    with app.app.app_context():
+        app.db.session.add_all(objects)
+        app.db.session.commit()
+        return [obj.id for obj in objects]
+
+
+def link_currents(app, goal_id):
+    with app.app.app_context():
+        return [link.current for link in app.GoalLink.query.filter_by(goal_id=goal_id)]
+
+
+def goal_state(app, goal_id):
+    with app.app.app_context():
+        goal = app.db.session.get(app.Goal, goal_id)
+        return goal.progress, goal.status
+
+
+def test_task_links_complete_goal(app, client):
+    goal_id, first, second = create(app, app.Goal(title='目標'), app.Task(title='a'), app.Task(title='b'))
+    for task_id in (first, second):
+        client.post(f'/goals/{goal_id}/links', data={'item_type': 'task', 'metric': 'completion', 'task_id': task_id})
+    client.post(f'/tasks/{first}/complete')
+    assert goal_state(app, goal_id) == (50, 'active')
+    client.post(f'/tasks/{second}/complete')
+    assert goal_state(app, goal_id) == (100, 'completed')
+    # 紐付けている間は手動で進捗を変えられない
+    assert client.post(f'/goals/{goal_id}/update', json={'progress': 10}).status_code == 409
+
+
+def test_habit_count_includes_todays_check_in(app, client):
+    goal_id, habit_id = create(app, app.Goal(title='目標'), app.Habit(name='運動'))
+    client.post(f'/habits/{habit_id}/toggle')
+    client.post(f'/goals/{goal_id}/links',
+                data={'item_type': 'habit', 'metric': 'count', 'habit_id': habit_id, 'target': '5'})
+    assert link_currents(app, goal_id) == [1.0]
+    client.post(f'/habits/{habit_id}/toggle')
+    assert link_currents(app, goal_id) == [0.0]
+    client.post(f'/habits/{habit_id}/toggle')
+    assert link_currents(app, goal_id) == [1.0]
+    assert goal_state(app, goal_id) == (20, 'active')
+
+
+def test_habit_count_never_goes_negative(app, client):
+    goal_id, habit_id = create(app, app.Goal(title='目標'), app.Habit(name='運動'))
+    client.post(f'/habits/{habit_id}/toggle')
+    client.post(f'/goals/{goal_id}/links',
+                data={'item_type': 'habit', 'metric': 'count', 'habit_id': habit_id, 'target': '5'})
+    with app.app.app_context():
+        app.db.session.execute(app.GoalLink.__table__.update().values(current=0))
+        app.db.session.commit()
+    client.post(f'/habits/{habit_id}/toggle')
+    assert link_currents(app, goal_id) == [0.0]
+
+
+def test_deleting_linked_item_removes_it_from_goal(app, client):
+    goal_id, first, second = create(app, app.Goal(title='目標'), app.Task(title='a'), app.Task(title='b'))
+    for task_id in (first, second):
+        client.post(f'/goals/{goal_id}/links', data={'item_type': 'task', 'metric': 'completion', 'task_id': task_id})
+    client.post(f'/tasks/{first}/complete')
+    client.post(f'/tasks/{second}/delete')
+    assert goal_state(app, goal_id) == (100, 'completed')
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""習慣の年ごとの統計"""
+
+from datetime import date, timedelta
+
+import pytest
+
+from conftest import app_module
+
+
+class WeeklyHabit:
+    frequency = 'weekly'
+
+
+def weekday_bits(year, weekday):
+    """その年の指定した曜日すべてに1を立てたビット列"""
+    origin, bits = date(year, 1, 1), 0
+    for offset in range(app_module.days_in_year(year)):
+        if (origin + timedelta(days=offset)).weekday() == weekday:
+            bits |= 1 << offset
+    return bits
+
+
+@pytest.mark.parametrize('year', [2024, 2025, 2026])  # 1月1日が月曜・水曜・木曜
+def test_weekly_habit_done_every_week_is_100_percent(year):
+    bits = weekday_bits(year, date(year, 1, 1).weekday())
+    stats = app_module.habit_year_stats(WeeklyHabit(), bits, year, date(year + 1, 1, 1))
+    assert stats['completion_rate'] == 100.0
+
+
+def test_weekly_habit_missing_one_week():
+    bits = weekday_bits(2024, 0) & ~1  # 1月1日（月曜）の週だけ未達成
+    stats = app_module.habit_year_stats(WeeklyHabit(), bits, 2024, date(2025, 1, 1))
+    assert stats['completion_rate'] == round(52 / 53 * 100, 1)
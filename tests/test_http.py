@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""レスポンスの圧縮・ETag と、GETのリクエストの読み取り専用の振り分け"""
+
+import gzip
+import time
+
+import pytest
+
+GZIP = {'Accept-Encoding': 'gzip'}
+
+
+def test_calendar_feed_etag_is_weak_and_revalidates(client):
+    first = client.get('/calendar.ics', headers=GZIP)
+    first.get_data()
+    plain = client.get('/calendar.ics')
+    plain.get_data()
+    assert first.status_code == plain.status_code == 200
+    assert first.headers['ETag'].startswith('W/')
+    assert first.headers['ETag'] == plain.headers['ETag']
+    assert 'Accept-Encoding' in first.headers['Vary']
+
+    cached = client.get('/calendar.ics', headers=dict(GZIP, **{'If-None-Match': first.headers['ETag']}))
+    assert cached.status_code == 304
+    assert cached.headers['ETag'] == first.headers['ETag']
+
+
+def test_streamed_page_is_compressed(app, client):
+    with app.app.app_context():
+        app.db.session.add_all(app.Task(title=f'タスク{i}', description='説明' * 20) for i in range(50))
+        app.db.session.commit()
+    response = client.get('/tasks', headers=GZIP)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'タスク49' in gzip.decompress(response.get_data()).decode('utf-8')
+
+
+def test_file_download_is_not_compressed(client):
+    job_id = int(client.post('/export/json').headers['Location'].rsplit('=', 1)[1])
+    for _ in range(100):
+        job = client.get(f'/jobs/{job_id}').get_json()
+        if job['status'] not in ('queued', 'running'):
+            break
+        time.sleep(0.05)
+    assert job['status'] == 'succeeded'
+
+    response = client.get(job['download_url'], headers=GZIP)
+    body = response.get_data()
+    response.close()
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert body.startswith(b'{')
+
+
+def test_get_request_cannot_write(app):
+    with app.app.test_request_context('/dashboard', method='GET'):
+        app.app.preprocess_request()
+        app.db.session.add(app.Task(title='GETの中の書き込み'))
+        with pytest.raises(app.ReadOnlyRequestError):
+            app.db.session.flush()
+        app.db.session.rollback()
+
+
+def test_post_request_writes_through_writer_engine(app, client):
+    assert client.post('/tasks/add', data={'title': '新しいタスク', 'priority': 'medium'}).status_code == 302
+    with app.app.app_context():
+        assert app.Task.query.filter_by(title='新しいタスク').count() == 1
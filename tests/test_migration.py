@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""変更前のアプリが作ったDBのマイグレーションと、import時のDBの準備"""
+
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+from conftest import ROOT, app_module, create_baseline_database, database_path, remove_database
+
+
+@pytest.fixture
+def baseline(monkeypatch):
+    """変更前のDBに記録を入れ、init_database() でマイグレーションした後のアプリ"""
+    monkeypatch.setitem(app_module.app.config, 'WTF_CSRF_ENABLED', False)
+    connection = create_baseline_database(remove_database())
+    connection.executescript("""
+        INSERT INTO settings (id, pomodoro_work_duration, pomodoro_break_duration, pomodoro_long_break_duration,
+                              terms_accepted) VALUES (1, 25, 5, 15, 1);
+        INSERT INTO task (id, title, priority, status, estimated_pomodoros, completed_pomodoros, created_at)
+            VALUES (1, '古いタスク', 'medium', 'todo', 1, 0, datetime('now', '-10 days'));
+        -- 完了していないまま残ったセッション・完了したセッション・移行の直前に開始したセッション
+        INSERT INTO pomodoro_session (id, duration, session_type, started_at, completed)
+            VALUES (1, 25, 'work', datetime('now', '-3 hours'), 0);
+        INSERT INTO pomodoro_session (id, duration, session_type, started_at, completed)
+            VALUES (2, 25, 'work', datetime('now', '-2 hours'), 1);
+        INSERT INTO pomodoro_session (id, duration, session_type, started_at, completed)
+            VALUES (3, 25, 'work', datetime('now', '-5 minutes'), 0);
+        INSERT INTO time_entry (id, project_name, start_time, end_time, duration_minutes, is_running)
+            VALUES (1, 'A', datetime('now', '-1 day'), datetime('now', '-1 day', '+30 minutes'), 30, 0);
+        -- 置き換えたインデックス（以前のマイグレーションで作られたもの）
+        CREATE INDEX ix_time_entry_report ON time_entry (start_time, project_name);
+    """)
+    connection.close()
+    with app_module.app.app_context():
+        app_module.init_database()
+    yield app_module
+    remove_database()
+
+
+def columns(path, table):
+    connection = sqlite3.connect(path)
+    try:
+        return {row[1] for row in connection.execute(f'PRAGMA table_info({table})')}
+    finally:
+        connection.close()
+
+
+def indexes(path, table):
+    connection = sqlite3.connect(path)
+    try:
+        return {row[1] for row in connection.execute(f'PRAGMA index_list({table})')}
+    finally:
+        connection.close()
+
+
+def test_baseline_columns_are_added(baseline):
+    path = database_path()
+    for model in (baseline.Settings, baseline.Task, baseline.PomodoroSession, baseline.TimeEntry,
+                  baseline.CalendarEvent, baseline.Goal):
+        assert {column.name for column in model.__table__.columns} <= columns(path, model.__tablename__)
+    assert 'ix_time_entry_report' not in indexes(path, 'time_entry')
+    assert 'ix_time_entry_local_report' in indexes(path, 'time_entry')
+
+
+def test_pages_load_after_migration(baseline):
+    client = baseline.app.test_client()
+    for path in ('/dashboard', '/tasks', '/pomodoro', '/settings', '/calendar', '/goals', '/health', '/statistics'):
+        assert client.get(path).status_code == 200, path
+
+
+def test_legacy_pomodoro_sessions_are_backfilled(baseline):
+    with baseline.app.app_context():
+        sessions = {session.id: session for session in baseline.PomodoroSession.query}
+        assert sessions[1].status == 'abandoned' and sessions[1].ended_at is not None
+        assert sessions[2].status == 'completed' and sessions[2].ended_at is not None
+        # 終了予定を過ぎていないセッションは進行中のまま（期限を過ぎたら整理のスレッドが放棄にする）
+        assert sessions[3].status == 'running' and sessions[3].ended_at is None
+        assert sessions[1].local_date is not None
+    state = baseline.app.test_client().get('/api/pomodoro/state').get_json()
+    assert state['active'] and state['session_id'] == 3
+
+
+def test_unchanged_schema_is_not_migrated_again(baseline):
+    with baseline.app.app_context():
+        assert baseline.ensure_schema(baseline.db.engine) is False
+        version = baseline.db.session.execute(baseline.db.text('PRAGMA user_version')).scalar()
+        assert version == baseline.schema_fingerprint()
+
+
+def import_app(instance_path, **env):
+    """gunicorn app:app と同じく、別のプロセスで app をimportするだけ"""
+    env = dict(os.environ, INSTANCE_PATH=instance_path, **env)
+    env.pop('INIT_DATABASE_ON_IMPORT', None)
+    subprocess.run([sys.executable, '-c', 'import app'], cwd=ROOT, env=env, check=True, capture_output=True)
+
+
+def test_import_migrates_and_seeds_existing_database():
+    instance_path = tempfile.mkdtemp(prefix='productivity-import-')
+    path = os.path.join(instance_path, 'productivity.db')
+    create_baseline_database(path).close()
+    import_app(instance_path)
+    assert 'work_day_start_hour' in columns(path, 'settings')
+    connection = sqlite3.connect(path)
+    try:
+        assert connection.execute('SELECT COUNT(*) FROM settings').fetchone()[0] == 1
+        assert connection.execute('SELECT COUNT(*) FROM achievement').fetchone()[0] > 0
+    finally:
+        connection.close()
+
+
+def test_import_creates_accounts_table_for_multi_user():
+    instance_path = tempfile.mkdtemp(prefix='productivity-import-')
+    import_app(instance_path, MULTI_USER='1')
+    connection = sqlite3.connect(os.path.join(instance_path, 'accounts.db'))
+    try:
+        assert connection.execute("SELECT name FROM sqlite_master WHERE name = 'user'").fetchone()
+    finally:
+        connection.close()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""サーバーが持つポモドーロの状態と、期限切れのセッションの整理"""
+
+from datetime import datetime, timedelta, timezone
+
+
+def queued_at(moment):
+    """オフラインのキューから再送された操作のヘッダー（元の操作の時刻）"""
+    return {'X-Offline-Queued-At': str(int(moment.replace(tzinfo=timezone.utc).timestamp() * 1000))}
+
+
+def start(client, **data):
+    return client.post('/api/pomodoro/start', json=dict({'session_type': 'work'}, **data)).get_json()['session_id']
+
+
+def test_starting_a_session_abandons_the_running_one(app, client):
+    first = start(client)
+    second = start(client)
+    with app.app.app_context():
+        assert app.db.session.get(app.PomodoroSession, first).status == 'abandoned'
+    state = client.get('/api/pomodoro/state').get_json()
+    assert state['active'] and state['session_id'] == second
+
+
+def test_late_completion_of_replaced_session_is_rejected(app, client):
+    first = start(client)
+    second = start(client)
+    response = client.post(f'/api/pomodoro/complete/{first}', headers=queued_at(datetime.utcnow()))
+    assert response.status_code == 409
+
+    state = client.get('/api/pomodoro/state').get_json()
+    assert state['active'] and state['session_id'] == second
+    with app.app.app_context():
+        assert app.db.session.get(app.PomodoroSession, first).status == 'abandoned'
+        assert app.pomodoro_registry.expired_shards(datetime.utcnow() + timedelta(hours=2)) == [None]
+
+
+def test_registry_keeps_newer_session(app, client):
+    first = start(client)
+    second = start(client)
+    with app.app.test_request_context():
+        app.pomodoro_registry.put(None, app.db.session.get(app.PomodoroSession, first))
+        assert app.pomodoro_registry.get(None).id == second
+
+
+def test_sweeper_abandons_expired_session_and_late_completion_is_accepted(app, client):
+    with app.app.test_request_context():
+        session = app.PomodoroSession(duration=25, started_at=datetime.utcnow() - timedelta(minutes=40),
+                                      status='running', client_id='offline-1')
+        app.db.session.add(session)
+        app.db.session.commit()
+        assert app.sweep_abandoned_pomodoros() == 1
+        assert session.status == 'abandoned'
+
+    # 期限内に完了していた操作がオフラインから届いたら、完了として受け付ける
+    completed_at = datetime.utcnow() - timedelta(minutes=14)
+    response = client.post('/api/pomodoro/complete/client/offline-1', headers=queued_at(completed_at))
+    assert response.get_json()['success']
+    with app.app.app_context():
+        assert app.PomodoroSession.query.filter_by(client_id='offline-1').one().status == 'completed'
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""設定のタイムゾーンでの日付・時刻の扱い（サーバーのタイムゾーンには依存しない）"""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+
+@pytest.fixture
+def tokyo(app):
+    with app.app.app_context():
+        app.get_settings().timezone = 'Asia/Tokyo'
+        app.db.session.commit()
+    return app
+
+
+def test_focus_heatmap_uses_local_hour(tokyo):
+    with tokyo.app.test_request_context():
+        # 月曜 23:30 UTC は東京では火曜 8:30
+        now = datetime.utcnow()
+        started = datetime.combine(now.date() - timedelta(days=now.weekday() + 7), datetime.min.time()) \
+            + timedelta(hours=23, minutes=30)
+        tokyo.db.session.add(tokyo.PomodoroSession(duration=25, session_type='work', completed=True,
+                                                   status='completed', started_at=started,
+                                                   ended_at=started + timedelta(minutes=25)))
+        tokyo.db.session.commit()
+        heatmap = tokyo.load_insights(30)['focus_heatmap']
+    cells = [(weekday, hour) for weekday, row in enumerate(heatmap) for hour, value in enumerate(row) if value]
+    assert cells == [(1, 8)]
+
+
+def test_ics_times_are_converted_to_configured_timezone(tokyo):
+    with tokyo.app.test_request_context():
+        assert tokyo.parse_ics_datetime({}, '20240101T000000Z') == datetime(2024, 1, 1, 9)
+        assert tokyo.parse_ics_datetime({'TZID': 'America/New_York'}, '20240101T000000') == datetime(2024, 1, 1, 14)
+
+
+def test_reminders_use_local_time(tokyo, client):
+    with tokyo.app.test_request_context():
+        soon = datetime.now(timezone.utc).astimezone(tokyo.current_timezone()).replace(tzinfo=None) \
+            + timedelta(minutes=30)
+        tokyo.db.session.add(tokyo.CalendarEvent(title='単発', start_time=soon))
+        tokyo.db.session.add(tokyo.CalendarEvent(title='毎日', start_time=soon - timedelta(days=3),
+                                                 end_time=soon - timedelta(days=3, minutes=-60),
+                                                 recurrence_freq='daily', recurrence_interval=1))
+        tokyo.db.session.commit()
+    titles = sorted(reminder['title'] for reminder in client.post('/api/check_reminders').get_json()['reminders'])
+    assert titles == ['単発', '毎日']
+    assert client.post('/api/check_reminders').get_json()['reminders'] == []